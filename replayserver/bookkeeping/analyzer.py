@@ -1,4 +1,4 @@
-from fafreplay import ReplayReadError, body_ticks
+from fafreplay import ReplayReadError, body_ticks, body_offset
 from replayserver.errors import BookkeepingError
 
 
@@ -18,3 +18,11 @@ class ReplayAnalyzer:
             return body_ticks(data)
         except ReplayReadError as e:
             raise BookkeepingError(f"Failed to parse replay: {e}")
+
+    def get_full_replay_ticks(self, data):
+        """Like get_replay_ticks, but for replay data including the header."""
+        try:
+            offset = body_offset(data)
+        except ReplayReadError as e:
+            raise BookkeepingError(f"Failed to parse replay header: {e}")
+        return self.get_replay_ticks(data[offset:])
@@ -1,42 +1,264 @@
 from replayserver import config, metrics
 from replayserver.bookkeeping.analyzer import ReplayAnalyzer
 from replayserver.bookkeeping.database import ReplayDatabaseQueries
-from replayserver.bookkeeping.storage import ReplaySaver
-from replayserver.errors import BookkeepingError
+from replayserver.bookkeeping.index import VaultIndex, update_index
+from replayserver.bookkeeping.pending import PendingBookkeeping
+from replayserver.bookkeeping.recompress import IdleRecompressor
+from replayserver.bookkeeping import s3
+from replayserver.bookkeeping.storage import ReplaySaver, LocalReplayStore
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
 from replayserver.logging import logger
 
 
+def storage_backend(value):
+    if value not in ["local", "s3"]:
+        raise ValueError(f"Unknown storage backend {value}")
+    if value == "s3" and s3.boto3 is None:
+        raise ValueError("The s3 storage backend needs boto3 installed")
+    return value
+
+
 class BookkeeperConfig(config.Config):
     _options = {
         "vault_path": {
             "doc": "Root directory for saved replays.",
             "parser": config.is_dir
         },
+        "fsync_batch_delay": {
+            "parser": config.nonnegative_float,
+            "default": "0",
+            "doc": ("Replays are synced to disk before being moved into "
+                    "place. Replays that finish while others are being "
+                    "synced are synced together. Setting this to a value in "
+                    "seconds makes us wait that long to gather more replays "
+                    "to sync at once, trading save latency for fewer disk "
+                    "flushes when many games end at the same time.")
+        },
+        "compression_level": {
+            "parser": int,
+            "default": "19",
+            "doc": ("Zstd compression level for saved replays. When many "
+                    "replays are saved at once, we lower it as far as "
+                    "compression_min_level to keep up.")
+        },
+        "compression_min_level": {
+            "parser": int,
+            "default": "3",
+            "doc": ("Lowest compression level used when we're falling behind "
+                    "on saving replays. Set to compression_level to always "
+                    "use the same level.")
+        },
+        "compression_max_backlog": {
+            "parser": config.positive_float,
+            "default": "30",
+            "doc": ("Compression level for a replay is the highest at which "
+                    "we estimate that we can compress all replays waiting "
+                    "to be saved within this many seconds, based on recent "
+                    "compression speed.")
+        },
+        "recompress_when_idle": {
+            "parser": config.boolean,
+            "default": "false",
+            "doc": ("Whether to recompress replays saved at a level lower "
+                    "than compression_level once we're idle.")
+        },
+        "recompress_idle_time": {
+            "parser": config.positive_float,
+            "default": "300",
+            "doc": ("Time in seconds with no replays being saved after which "
+                    "we start recompressing.")
+        },
+        "compression_dictionary": {
+            "parser": config.optional_file,
+            "default": "",
+            "doc": ("Path to a zstd dictionary to compress replays with, "
+                    "e.g. one trained with faf_replay_train_dictionary. "
+                    "Replays compressed with a dictionary record its ID, and "
+                    "can't be read without it, so keep old dictionaries "
+                    "around. Empty to not use one.")
+        },
+        "vault_index_path": {
+            "parser": str,
+            "default": "",
+            "doc": ("Path to an SQLite database in which to keep an index of "
+                    "saved replays' metadata. Empty to not keep an index. "
+                    "Replays saved before the index was enabled can be "
+                    "added to it with faf_replay_migrate.")
+        },
+        "storage_backend": {
+            "parser": storage_backend,
+            "default": "local",
+            "doc": ("Where to keep saved replays. Either 'local' to keep "
+                    "them in vault_path, or 's3' to upload them to an "
+                    "S3-compatible object store. The vault is still used "
+                    "for journals when using s3.")
+        },
+        "s3_bucket": {
+            "parser": str,
+            "default": "",
+            "doc": "Bucket to upload replays to."
+        },
+        "s3_prefix": {
+            "parser": str,
+            "default": "replays",
+            "doc": ("Prefix of replay object keys. Keys below it follow the "
+                    "same layout as the local vault.")
+        },
+        "s3_endpoint_url": {
+            "parser": str,
+            "default": "",
+            "doc": ("Object store URL, for S3-compatible stores like MinIO. "
+                    "Empty to use AWS.")
+        },
+        "s3_region": {
+            "parser": str,
+            "default": "",
+            "doc": "Object store region. Empty for the boto3 default."
+        },
+        "s3_part_size": {
+            "parser": config.positive_int,
+            "default": "8388608",
+            "doc": ("Size in bytes of parts that large replays are uploaded "
+                    "in, as they are compressed. S3 needs at least 5MiB.")
+        },
+        "s3_upload_concurrency": {
+            "parser": config.positive_int,
+            "default": "8",
+            "doc": "Maximum number of parts uploaded at the same time."
+        },
+        "s3_max_retries": {
+            "parser": config.nonnegative_int,
+            "default": "5",
+            "doc": ("Number of times a failed object store request is "
+                    "retried before giving up.")
+        },
+        "s3_retry_delay": {
+            "parser": config.positive_float,
+            "default": "1",
+            "doc": ("Time in seconds before a failed object store request "
+                    "is retried. Doubles with each attempt.")
+        },
+        "worker_spool_path": {
+            "parser": str,
+            "default": "",
+            "doc": ("Directory to hand finished replays over to a separate "
+                    "bookkeeping worker process in, ran with "
+                    "faf_replay_bookkeeper with the same configuration. "
+                    "The server then only writes replays there, leaving "
+                    "saving them and updating the database to the worker. "
+                    "Empty to save replays in the server process.")
+        },
+        "worker_poll_interval": {
+            "parser": config.positive_float,
+            "default": "1",
+            "doc": "Time in seconds between worker checks for new replays."
+        },
+        "worker_concurrency": {
+            "parser": config.positive_int,
+            "default": "4",
+            "doc": "Number of replays the worker saves at the same time."
+        },
+        "spool_db_failures": {
+            "parser": config.boolean,
+            "default": "false",
+            "doc": ("Whether to keep database operations that failed in a "
+                    "journal in the vault and retry them in the background. "
+                    "Replays that we couldn't get info for are saved with "
+                    "partial info, which is filled in once the database "
+                    "works again.")
+        },
+        "spool_retry_delay": {
+            "parser": config.positive_float,
+            "default": "10",
+            "doc": ("Time in seconds before a failed database operation is "
+                    "retried. Doubles with each failed attempt.")
+        },
+        "spool_max_retry_delay": {
+            "parser": config.positive_float,
+            "default": "600",
+            "doc": "Maximum time in seconds between retries."
+        },
+        "spool_failure_threshold": {
+            "parser": config.positive_int,
+            "default": "3",
+            "doc": ("Number of consecutive database failures after which we "
+                    "stop trying to query the database while saving "
+                    "replays, deferring all work to the journal until "
+                    "the database responds again.")
+        },
+        "spool_entry_lifetime": {
+            "parser": config.positive_float,
+            "default": "604800",
+            "doc": ("Time in seconds after which we give up retrying a "
+                    "database operation.")
+        },
     }
 
 
 class Bookkeeper:
-    def __init__(self, queries, saver, analyzer):
+    def __init__(self, queries, saver, analyzer, pending=None,
+                 recompressor=None, index=None):
         self._queries = queries
         self._saver = saver
         self._analyzer = analyzer
+        self._pending = pending
+        self._recompressor = recompressor
+        self._index = index
 
     @classmethod
     def build(cls, database, config):
         queries = ReplayDatabaseQueries(database)
-        saver = ReplaySaver.build(queries, config)
+        if config.spool_db_failures:
+            pending = PendingBookkeeping.build(config)
+        else:
+            pending = None
+        if config.vault_index_path:
+            index = VaultIndex(config.vault_index_path)
+        else:
+            index = None
+        if config.storage_backend == "s3":
+            store = s3.S3ReplayStore.build(config)
+        else:
+            store = LocalReplayStore.build(config)
+        saver = ReplaySaver.build(queries, store, config, pending, index)
         analyzer = ReplayAnalyzer()
-        return cls(queries, saver, analyzer)
+        if pending is not None:
+            pending.add_handler("replay_info", saver.update_replay_info)
+            pending.add_handler("game_stats", queries.update_game_stats)
+        if config.recompress_when_idle:
+            recompressor = IdleRecompressor.build(saver, config)
+        else:
+            recompressor = None
+        return cls(queries, saver, analyzer, pending, recompressor, index)
+
+    async def start(self):
+        if self._pending is not None:
+            await self._pending.start()
+        if self._recompressor is not None:
+            await self._recompressor.start()
+
+    async def stop(self):
+        if self._pending is not None:
+            await self._pending.stop()
+        if self._recompressor is not None:
+            await self._recompressor.stop()
+        if self._index is not None:
+            self._index.close()
 
     async def save_replay(self, game_id, stream):
+        "Returns whether the replay itself was saved."
         try:
             logger.debug(f"Saving replay {game_id}")
-            await self._saver.save_replay(game_id, stream)
+            entry = await self._saver.save_replay(game_id, stream)
             logger.debug(f"Saved replay {game_id}")
             metrics.saved_replays.inc()
             replay_available = True
+            if self._recompressor is not None:
+                await self._recompressor.replay_saved(
+                    game_id, entry["compression_level"])
         except BookkeepingError as e:
             logger.warning(f"Failed to save replay for game {game_id}: {e}")
+            entry = None
             replay_available = False
 
         try:
@@ -47,4 +269,28 @@ class Bookkeeper:
             logger.warning(f"Failed to analyze replay for game {game_id}: {e}")
             ticks = None
 
-        await self._queries.update_game_stats(game_id, ticks, replay_available)
+        if self._index is not None and entry is not None:
+            await update_index(self._index, dict(entry, ticks=ticks))
+        await self._update_game_stats(game_id, ticks, replay_available)
+        return replay_available
+
+    async def _update_game_stats(self, game_id, ticks, replay_available):
+        if self._pending is None:
+            await self._queries.update_game_stats(game_id, ticks,
+                                                  replay_available)
+            return
+
+        try:
+            await self._pending.attempt(
+                lambda: self._queries.update_game_stats(game_id, ticks,
+                                                        replay_available))
+        except DatabaseUnavailableError as e:
+            logger.warning((f"Failed to update stats for game {game_id}, "
+                            f"will retry later: {e}"))
+            try:
+                await self._pending.defer("game_stats", game_id=game_id,
+                                          replay_ticks=ticks,
+                                          replay_available=replay_available)
+            except BookkeepingError as e:
+                logger.warning(
+                    f"Failed to defer stats update for game {game_id}: {e}")
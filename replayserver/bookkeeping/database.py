@@ -4,7 +4,7 @@ import time
 import aiomysql
 from aiomysql import DatabaseError, create_pool
 from replayserver import config
-from replayserver.errors import BookkeepingError
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
 from replayserver.logging import logger
 
 
@@ -50,7 +50,8 @@ class Database:
 
     async def execute(self, query, params=[]):
         if self._connection_pool is None:
-            raise BookkeepingError("Tried to run query while pool is closed!")
+            raise DatabaseUnavailableError(
+                "Tried to run query while pool is closed!")
         try:
             async with self._connection_pool.acquire() as conn:
                 async with conn.cursor(aiomysql.DictCursor) as cur:
@@ -59,7 +60,8 @@ class Database:
                 await conn.commit()
             return data
         except (DatabaseError, RuntimeError) as e:
-            raise BookkeepingError(f"Failed to run database query: {str(e)}")
+            raise DatabaseUnavailableError(
+                f"Failed to run database query: {str(e)}")
 
     async def stop(self):
         self._connection_pool.close()
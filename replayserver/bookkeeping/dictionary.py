@@ -0,0 +1,105 @@
+"""
+Training zstd dictionaries for replay compression. Replays share a lot of
+structure (command opcodes, unit blueprint names, lua keys in the header), so
+a dictionary trained on a sample of the vault improves compression, most of
+all for short games. Installed as a runnable script. ::
+
+    faf_replay_train_dictionary --vault /path/to/vault --out replays.dict
+
+Dictionaries are identified by an ID stored in replay metadata. Once replays
+were saved with a dictionary, it has to be kept for as long as they are.
+"""
+
+import argparse
+import itertools
+import logging
+import random
+import zstandard as zstd
+
+from replayserver.bookkeeping.storage import ReplayFilePaths, read_replay, \
+    load_dictionary
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger
+
+
+__all__ = ["sample_replays", "train_dictionary", "main"]
+
+
+def sample_replays(paths, count, sample_size, dictionaries={}, rng=random):
+    """
+    Picks up to count random replays out of paths and returns their data, each
+    truncated to sample_size bytes. Unreadable replays are skipped.
+    """
+    # Reservoir sampling, the vault is too large to list in memory
+    chosen = []
+    for i, path in enumerate(paths):
+        if i < count:
+            chosen.append(path)
+            continue
+        j = rng.randrange(i + 1)
+        if j < count:
+            chosen[j] = path
+
+    samples = []
+    for path in chosen:
+        try:
+            _, data = read_replay(path, dictionaries)
+        except (OSError, ValueError, BookkeepingError,
+                zstd.ZstdError) as e:
+            logger.warning(f"Skipping replay {path}: {e}")
+            continue
+        samples.append(data[:sample_size])
+    return samples
+
+
+def train_dictionary(samples, dict_size, level):
+    return zstd.train_dictionary(dict_size, samples, level=level)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Train a zstd dictionary on replays from the vault.")
+    parser.add_argument("--vault", required=True,
+                        help="Replay vault root directory")
+    parser.add_argument("--out", required=True,
+                        help="Path to write the dictionary to")
+    parser.add_argument("--samples", type=int, default=2000,
+                        help="Number of replays to sample")
+    parser.add_argument("--sample-size", type=int, default=128 * 1024,
+                        help="Bytes of each replay to train on")
+    parser.add_argument("--dict-size", type=int, default=112640,
+                        help="Dictionary size in bytes")
+    parser.add_argument("--level", type=int, default=19,
+                        help="Compression level to tune the dictionary for")
+    parser.add_argument("--limit", type=int, default=None,
+                        help=("Only consider this many replays from the "
+                              "vault, for quicker runs on large vaults"))
+    parser.add_argument("--dictionary", action="append", default=[],
+                        help=("Dictionary needed to read sampled replays. "
+                              "Can be given multiple times"))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logger.setLevel(logging.INFO)
+    args = _parse_args(argv)
+    dictionaries = {}
+    for path in args.dictionary:
+        d = load_dictionary(path)
+        dictionaries[d.dict_id()] = d
+
+    paths = ReplayFilePaths.build(args.vault).all_replay_files()
+    if args.limit is not None:
+        paths = itertools.islice(paths, args.limit)
+    samples = sample_replays(paths, args.samples, args.sample_size,
+                             dictionaries)
+    if not samples:
+        logger.error("No replays to train on")
+        return 1
+
+    logger.info(f"Training dictionary on {len(samples)} replays")
+    dictionary = train_dictionary(samples, args.dict_size, args.level)
+    with open(args.out, "wb") as f:
+        f.write(dictionary.as_bytes())
+    logger.info(f"Wrote dictionary {dictionary.dict_id()} to {args.out}")
+    return 0
@@ -0,0 +1,187 @@
+"""
+Local SQLite index of replay metadata, so that finding replays doesn't need
+walking the vault and reading each file. The Bookkeeper keeps it up to date
+as it saves replays; replays saved before it existed can be added with
+``faf_replay_migrate --vault <vault> index --index-path <index>``.
+
+The index is advisory - the vault is the source of truth and a failure to
+update the index doesn't fail saving a replay.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+
+from replayserver.logging import logger, short_exc
+
+
+__all__ = ["VaultIndex", "index_entry", "update_index"]
+
+
+def index_entry(path, info, file_size, checksum, data_size=None,
+                ticks=None):
+    "Creates an index entry for a replay file with given info."
+    try:
+        game_id = int(info["uid"])
+    except (KeyError, TypeError, ValueError):
+        game_id = int(os.path.basename(path).split(".")[0])
+    return {
+        "game_id": game_id,
+        "path": path,
+        "file_size": file_size,
+        "data_size": data_size,
+        "checksum": checksum,
+        "ticks": ticks,
+        "compression": info.get("compression"),
+        "compression_level": info.get("compression_level"),
+        "compression_dictionary": info.get("compression_dictionary"),
+        "mapname": info.get("mapname"),
+        "featured_mod": info.get("featured_mod"),
+        "game_end": info.get("game_end"),
+    }
+
+
+class VaultIndex:
+    """
+    Blocking, but safe to use from multiple threads. Entries are dicts with
+    keys as in index_entry; data_size and ticks may be None if unknown.
+    """
+    COLUMNS = ["game_id", "path", "file_size", "data_size", "checksum",
+               "ticks", "compression", "compression_level",
+               "compression_dictionary", "mapname", "featured_mod",
+               "game_end"]
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS replays (
+            game_id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            file_size INTEGER,
+            data_size INTEGER,
+            checksum TEXT,
+            ticks INTEGER,
+            compression TEXT,
+            compression_level INTEGER,
+            compression_dictionary INTEGER,
+            mapname TEXT,
+            featured_mod TEXT,
+            game_end REAL
+        );
+        CREATE INDEX IF NOT EXISTS replays_mapname ON replays (mapname);
+        CREATE INDEX IF NOT EXISTS replays_compression
+            ON replays (compression, compression_level);
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+        with self._lock, self._conn:
+            # WAL lets tools read the index while we write to it.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def put(self, entry):
+        "Adds or replaces an entry."
+        entry = {c: entry.get(c) for c in self.COLUMNS}
+        columns = ", ".join(self.COLUMNS)
+        values = ", ".join(f":{c}" for c in self.COLUMNS)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO replays ({columns}) "
+                f"VALUES ({values})", entry)
+
+    def merge(self, entry):
+        """
+        Adds an entry, or updates an existing one with its fields that are
+        not None.
+        """
+        with self._lock:
+            if self.get(entry["game_id"]) is None:
+                self.put(entry)
+            else:
+                self.update(entry["game_id"],
+                            **{k: v for k, v in entry.items()
+                               if k != "game_id"})
+
+    def update(self, game_id, **fields):
+        """
+        Updates some fields of an entry. Fields that are None are left as
+        they are. Does nothing if there's no entry.
+        """
+        fields = {k: v for k, v in fields.items() if v is not None}
+        self._check_columns(fields)
+        if not fields:
+            return
+        assignments = ", ".join(f"{c} = :{c}" for c in fields)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE replays SET {assignments} WHERE game_id = :game_id",
+                dict(fields, game_id=game_id))
+
+    def get(self, game_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM replays WHERE game_id = ?",
+                (game_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def remove(self, game_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM replays WHERE game_id = ?",
+                               (game_id,))
+
+    def find(self, missing=(), limit=None, **fields):
+        """
+        Returns entries, ordered by game id, with given field values and
+        with fields listed in missing being unknown, e.g.
+        find(mapname="scmp_009") or find(missing=["ticks"]).
+        """
+        self._check_columns(fields)
+        self._check_columns(missing)
+        conditions = [f"{c} = :{c}" for c in fields]
+        conditions += [f"{c} IS NULL" for c in missing]
+        query = "SELECT * FROM replays"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY game_id"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._conn.execute(query, fields).fetchall()
+        return [dict(row) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM replays").fetchone()[0]
+
+    def _check_columns(self, columns):
+        for c in columns:
+            if c not in self.COLUMNS:
+                raise ValueError(f"Unknown index field {c}")
+
+
+async def update_index(index, entry, replace=True):
+    """
+    Puts an entry in the index in a thread. If replace is False, only
+    updates known fields of an existing entry. Errors are logged and
+    otherwise ignored.
+    """
+    game_id = entry["game_id"]
+
+    def update():
+        if replace:
+            index.put(entry)
+        else:
+            index.update(game_id, **{k: v for k, v in entry.items()
+                                     if k != "game_id"})
+
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, update)
+    except sqlite3.Error as e:
+        logger.warning(
+            f"Failed to update index for replay {game_id}: {short_exc(e)}")
@@ -0,0 +1,398 @@
+"""
+Bulk processing of replays in the vault, spread across a process pool.
+Installed as a runnable script. ::
+
+    faf_replay_migrate --vault /path/to/vault recompress --level 19
+    faf_replay_migrate --vault /path/to/vault migrate --dest /new/vault
+    faf_replay_migrate --vault /path/to/vault --index-path index.db index
+
+"recompress" recompresses replays in place, converting legacy ones to zstd.
+"migrate" copies replays to another vault, optionally recompressing them.
+"index" adds replays to the vault index. With --index-path, the other actions
+also update the index with replays they write.
+
+Progress is checkpointed, so an interrupted run picks up where it left off
+when started again with the same arguments. Reads can be throttled so that
+the vault stays usable while we work on it.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from replayserver.bookkeeping.analyzer import ReplayAnalyzer
+from replayserver.bookkeeping.index import VaultIndex, index_entry
+from replayserver.bookkeeping.storage import ReplayFilePaths, \
+    ReplayCompressor, CompressionLevelPolicy, REPLAY_COMPRESSION_KEYS, \
+    load_dictionary, read_replay_file, write_replay_file, decompress_replay, \
+    commit_file, remove_quietly
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger, short_exc
+
+
+__all__ = ["Checkpoint", "Throttle", "Progress", "migrate_vault", "main"]
+
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+def walk_key(vault, path):
+    """
+    Sort key matching the order of ReplayFilePaths.all_replay_files, so we
+    can tell if a replay was already seen by comparing it with the last
+    checkpointed one.
+    """
+    *dirs, name = os.path.relpath(path, vault).split(os.sep)
+    return tuple((1, d) for d in dirs) + ((0, name),)
+
+
+class ReplayProcessor:
+    """
+    Does the work on a single replay. Created once in each worker process, so
+    it takes dictionary paths rather than loaded dictionaries.
+    """
+
+    def __init__(self, action, level, dictionary, read_dictionaries, dest,
+                 ticks):
+        self._action = action
+        self._ticks = ticks
+        self._analyzer = ReplayAnalyzer()
+        self._dest = None if dest is None else ReplayFilePaths.build(dest)
+        self._read_dictionaries = {}
+        for path in read_dictionaries:
+            d = load_dictionary(path)
+            self._read_dictionaries[d.dict_id()] = d
+        if dictionary is not None:
+            dictionary = load_dictionary(dictionary)
+            self._read_dictionaries[dictionary.dict_id()] = dictionary
+        self._dictionary = dictionary
+        if level is None:
+            self._compressor = None
+        else:
+            self._compressor = ReplayCompressor(
+                CompressionLevelPolicy.fixed(level), dictionary)
+        self._level = level
+
+    def process(self, path):
+        """
+        Returns status, bytes read, bytes written and index entry of the
+        resulting replay file, if any.
+        """
+        if self._action == "index":
+            return self._index(path)
+        info, data = read_replay_file(path)
+        size_in = len(data)
+        data_size = None
+        if self._action == "recompress":
+            target = path
+            replace = True
+        else:
+            game_id = os.path.basename(path).split(".")[0]
+            target = self._dest.replay_file(game_id)
+            replace = False
+            if os.path.exists(target):
+                return SKIPPED, size_in, 0, None
+
+        if self._compressor is not None and self._needs_recompression(info):
+            data = decompress_replay(info, data, self._read_dictionaries)
+            data_size = len(data)
+            data, compression_info = self._compressor.compress(data,
+                                                               self._level)
+            for key in REPLAY_COMPRESSION_KEYS:
+                info.pop(key, None)
+            info.update(compression_info)
+            info['version'] = 2
+        elif self._action == "recompress":
+            return SKIPPED, size_in, 0, None
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(target),
+            prefix=f".{os.path.basename(target)}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            size, checksum = write_replay_file(tmp_file, info, data)
+        except OSError:
+            remove_quietly(tmp_file)
+            raise
+        commit_file(tmp_file, target, replace)
+        return (DONE, size_in, size,
+                index_entry(target, info, size, checksum, data_size))
+
+    def _index(self, path):
+        with open(path, "rb") as f:
+            contents = f.read()
+        checksum = hashlib.sha256(contents).hexdigest()
+        info, data = contents.split(b"\n", 1)
+        info = json.loads(info)
+        data_size = None
+        ticks = None
+        if self._ticks:
+            data = decompress_replay(info, data, self._read_dictionaries)
+            data_size = len(data)
+            try:
+                ticks = self._analyzer.get_full_replay_ticks(data)
+            except BookkeepingError:
+                pass
+        entry = index_entry(path, info, len(contents), checksum, data_size,
+                            ticks)
+        return DONE, len(contents), 0, entry
+
+    def _needs_recompression(self, info):
+        if info.get('compression') != 'zstd':
+            return True
+        if info.get('compression_level') != self._level:
+            return True
+        dict_id = (None if self._dictionary is None
+                   else self._dictionary.dict_id())
+        return info.get('compression_dictionary') != dict_id
+
+
+_processor = None
+
+
+def _init_worker(*args):
+    global _processor
+    _processor = ReplayProcessor(*args)
+
+
+def _process(path):
+    try:
+        return _processor.process(path)
+    except Exception as e:
+        # Don't let one bad replay stop the whole run.
+        return FAILED, 0, 0, short_exc(e)
+
+
+class Checkpoint:
+    """
+    Remembers the last replay such that it and all replays before it were
+    processed, along with progress so far. Saved atomically.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    def load(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+
+class Throttle:
+    "Limits rate of bytes read. Rate of None means no limit."
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self._rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._next = clock()
+
+    def wait(self, nbytes):
+        if self._rate is None:
+            return
+        now = self._clock()
+        if self._next > now:
+            self._sleep(self._next - now)
+        self._next = max(self._next, now) + nbytes / self._rate
+
+
+class Progress:
+    def __init__(self, clock=time.monotonic, state=None):
+        state = state or {}
+        self.counts = collections.Counter(state.get("counts", {}))
+        self.bytes_in = state.get("bytes_in", 0)
+        self.bytes_out = state.get("bytes_out", 0)
+        self._clock = clock
+        self._start = clock()
+        self._session_bytes = 0
+        self._session_files = 0
+
+    def record(self, status, bytes_in, bytes_out):
+        self.counts[status] += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self._session_bytes += bytes_in
+        self._session_files += 1
+
+    def state(self):
+        return {"counts": dict(self.counts), "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out}
+
+    def report(self):
+        elapsed = max(self._clock() - self._start, 1e-6)
+        total = sum(self.counts.values())
+        logger.info(
+            (f"{total} replays ({self.counts[DONE]} done, "
+             f"{self.counts[SKIPPED]} skipped, {self.counts[FAILED]} failed), "
+             f"{self.bytes_in / 2 ** 20:.1f} MiB read, "
+             f"{self.bytes_out / 2 ** 20:.1f} MiB written, "
+             f"{self._session_files / elapsed:.1f} replays/s, "
+             f"{self._session_bytes / 2 ** 20 / elapsed:.2f} MiB/s"))
+
+
+def migrate_vault(vault, paths, processor_args, workers, checkpoint,
+                  throttle, report_interval, description, index=None):
+    """
+    Runs a ReplayProcessor over all given replay paths in a process pool.
+    Paths have to be in all_replay_files order. Resulting replays are added
+    to the index, if given.
+    """
+    state = checkpoint.load()
+    if state is not None and state.get("description") != description:
+        raise BookkeepingError(
+            f"Checkpoint is for a different run: {state.get('description')}")
+    last = None if state is None else state["last"]
+    progress = Progress(state=state)
+    if last is not None:
+        logger.info(f"Resuming after {last}")
+        last_key = walk_key(vault, last)
+        paths = (p for p in paths if walk_key(vault, p) > last_key)
+
+    # Paths in the order we submitted them, so we know how far we got.
+    submitted = collections.OrderedDict()
+    in_flight = {}
+    last_report = time.monotonic()
+
+    def save_checkpoint():
+        checkpoint.save({"description": description, "last": last,
+                         **progress.state()})
+
+    def collect(futures):
+        nonlocal last
+        for future in futures:
+            path = in_flight.pop(future)
+            status, bytes_in, bytes_out, extra = future.result()
+            if status == FAILED:
+                logger.warning(f"Failed to process {path}: {extra}")
+            elif extra is not None and index is not None:
+                index.merge(extra)
+            progress.record(status, bytes_in, bytes_out)
+            submitted[path] = True
+        while submitted and next(iter(submitted.values())):
+            last, _ = submitted.popitem(last=False)
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=processor_args) as pool:
+        try:
+            for path in paths:
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    size = 0
+                throttle.wait(size)
+                while len(in_flight) >= workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                submitted[path] = False
+                in_flight[pool.submit(_process, path)] = path
+
+                if time.monotonic() - last_report >= report_interval:
+                    last_report = time.monotonic()
+                    save_checkpoint()
+                    progress.report()
+            collect(list(in_flight))
+        finally:
+            # On interruption, in-flight work is lost, but we only
+            # checkpoint what's finished, so it'll be redone.
+            save_checkpoint()
+    progress.report()
+    return progress
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Recompress or migrate replays in the vault in bulk.")
+    parser.add_argument("--vault", required=True,
+                        help="Replay vault root directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--checkpoint", default=None,
+                        help=("Checkpoint file, defaults to "
+                              ".migration_checkpoint in the vault"))
+    parser.add_argument("--max-read-rate", type=float, default=None,
+                        help="Limit on replay data read, in MiB/s")
+    parser.add_argument("--report-interval", type=float, default=30,
+                        help="Seconds between progress reports")
+    parser.add_argument("--read-dictionary", action="append", default=[],
+                        help=("Dictionary needed to read existing replays. "
+                              "Can be given multiple times"))
+    parser.add_argument("--dictionary", default=None,
+                        help="Dictionary to compress replays with")
+    parser.add_argument("--index-path", default=None,
+                        help="Vault index to update")
+    actions = parser.add_subparsers(dest="action")
+    actions.required = True
+    recompress = actions.add_parser(
+        "recompress", help="Recompress replays in place")
+    recompress.add_argument("--level", type=int, default=19,
+                            help="Zstd compression level")
+    migrate = actions.add_parser(
+        "migrate", help="Copy replays to another vault")
+    migrate.add_argument("--dest", required=True,
+                         help="Destination vault root directory")
+    migrate.add_argument("--level", type=int, default=None,
+                         help=("Recompress with this zstd level, "
+                               "default is to copy replays as they are"))
+    index = actions.add_parser(
+        "index", help="Add replays to the vault index")
+    index.add_argument("--ticks", action="store_true",
+                       help=("Also find data size and tick count of each "
+                             "replay. Much slower"))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logger.setLevel(logging.INFO)
+    args = _parse_args(argv)
+    level = getattr(args, "level", None)
+    dest = getattr(args, "dest", None)
+    ticks = getattr(args, "ticks", False)
+    if args.action == "index" and args.index_path is None:
+        logger.error("Indexing needs --index-path")
+        return 1
+    checkpoint = Checkpoint(
+        args.checkpoint or
+        os.path.join(args.vault, f".migration_checkpoint_{args.action}"))
+    throttle = Throttle(None if args.max_read_rate is None
+                        else args.max_read_rate * 2 ** 20)
+    description = {"action": args.action, "level": level, "dest": dest,
+                   "dictionary": args.dictionary, "ticks": ticks}
+    index = None if args.index_path is None else VaultIndex(args.index_path)
+
+    paths = ReplayFilePaths.build(args.vault).all_replay_files()
+    try:
+        progress = migrate_vault(
+            args.vault, paths,
+            (args.action, level, args.dictionary, args.read_dictionary,
+             dest, ticks),
+            args.workers, checkpoint, throttle, args.report_interval,
+            description, index)
+    except BookkeepingError as e:
+        logger.error(str(e))
+        return 1
+    except KeyboardInterrupt:
+        logger.info("Interrupted, progress saved")
+        return 1
+    finally:
+        if index is not None:
+            index.close()
+    return 0 if progress.counts[FAILED] == 0 else 1
@@ -0,0 +1,330 @@
+"""
+Deferring bookkeeping work that failed because the database was unavailable.
+Work is kept in an on-disk journal so it survives restarts, and retried in the
+background until it succeeds.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from asyncio.locks import Event
+
+from replayserver import metrics
+from replayserver.bookkeeping.storage import loop_time, run_in_thread
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
+from replayserver.logging import logger, short_exc
+
+
+class PendingJournal:
+    """
+    Append-only journal of pending operations, one JSON object per line. An
+    operation is added with an {"id", "op", "args", "created"} entry and
+    marked as finished with an {"id", "done"} entry. A truncated last line
+    (e.g. from a crash mid-write) is ignored.
+
+    Blocking - run it in an executor.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def load(self):
+        "Returns a list of entries that were not marked as done."
+        entries = {}
+        try:
+            with open(self._path, "rb") as f:
+                lines = f.read().split(b"\n")
+        except FileNotFoundError:
+            lines = []
+
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                entry_id = entry["id"]
+            except (ValueError, TypeError, KeyError):
+                continue
+            self._next_id = max(self._next_id, entry_id + 1)
+            if entry.get("done", False):
+                entries.pop(entry_id, None)
+            else:
+                entries[entry_id] = entry
+        return list(entries.values())
+
+    def compact(self, entries):
+        "Replaces the journal with one containing only given entries."
+        tmp_path = f"{self._path}.tmp"
+        with self._lock:
+            with open(tmp_path, "wb") as f:
+                for entry in entries:
+                    f.write(self._encode(entry))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path)
+
+    def add(self, op, args, created):
+        with self._lock:
+            entry = {"id": self._next_id, "op": op, "args": args,
+                     "created": created}
+            self._next_id += 1
+            self._append(entry)
+        return entry
+
+    def mark_done(self, entry_id):
+        with self._lock:
+            self._append({"id": entry_id, "done": True})
+
+    def _append(self, entry):
+        with open(self._path, "ab") as f:
+            f.write(self._encode(entry))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _encode(self, entry):
+        return json.dumps(entry).encode() + b"\n"
+
+
+class CircuitBreaker:
+    """
+    Stops us from waiting out database failures inline. After a number of
+    consecutive failures the breaker opens and refuses requests for a while,
+    backing off exponentially each time it opens again. Once that time passes
+    a single request is let through; if it succeeds, the breaker closes.
+    """
+
+    def __init__(self, failure_threshold, retry_delay, max_retry_delay,
+                 clock):
+        self._failure_threshold = failure_threshold
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._clock = clock
+        self._failures = 0
+        self._open_delay = retry_delay
+        self._open_until = None
+
+    def is_open(self):
+        return self.time_until_closed() > 0
+
+    def time_until_closed(self):
+        if self._open_until is None:
+            return 0
+        return max(0, self._open_until - self._clock())
+
+    def record_success(self):
+        self._failures = 0
+        self._open_delay = self._retry_delay
+        self._open_until = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures < self._failure_threshold:
+            return
+        self._open_until = self._clock() + self._open_delay
+        self._open_delay = min(self._open_delay * 2, self._max_retry_delay)
+
+
+class JournaledWork:
+    """
+    Base for work that is kept in a PendingJournal and done one entry at a
+    time by a background task. Subclasses keep track of entries in _track,
+    do the work in _work, and call _mark_done once they drop an entry. Their
+    len() should be the number of entries left.
+    """
+    # What entries are, for logging.
+    DESCRIPTION = "journaled operations"
+
+    def __init__(self, journal):
+        self._journal = journal
+        self._worker = None
+
+    async def start(self):
+        entries = await run_in_thread(self._journal.load)
+        await run_in_thread(lambda: self._journal.compact(entries))
+        for entry in entries:
+            self._track(entry)
+        if entries:
+            logger.info(f"Loaded {len(entries)} {self.DESCRIPTION}")
+        self._worker = asyncio.ensure_future(self._work())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    async def _add(self, op, args):
+        "Journals a new entry and tracks it. Raises OSError on failure."
+        entry = await run_in_thread(
+            lambda: self._journal.add(op, args, time.time()))
+        self._track(entry)
+
+    async def _mark_done(self, entry_id):
+        try:
+            if len(self) > 0:
+                await run_in_thread(lambda: self._journal.mark_done(entry_id))
+            else:
+                await run_in_thread(lambda: self._journal.compact([]))
+        except OSError as e:
+            # Worst case we do the work again after restart.
+            logger.warning((f"Failed to update journal of "
+                            f"{self.DESCRIPTION}: {short_exc(e)}"))
+
+    def _track(self, entry):
+        raise NotImplementedError
+
+    async def _work(self):
+        raise NotImplementedError
+
+
+class PendingOperation:
+    def __init__(self, entry):
+        self.id = entry["id"]
+        self.op = entry["op"]
+        self.args = entry["args"]
+        self.created = entry["created"]
+        self.attempts = 0
+        self.next_attempt = 0
+
+
+class PendingBookkeeping(JournaledWork):
+    """
+    Runs bookkeeping operations that use the database. Operations are first
+    attempted inline (unless the circuit breaker tells us the database is
+    down). Those that fail can be deferred, which puts them in the journal to
+    be retried by a background worker.
+
+    Deferred operations are identified by name and have to be registered with
+    add_handler before start() is called. Their arguments have to be JSON
+    serializable.
+    """
+    DESCRIPTION = "pending bookkeeping operations"
+
+    def __init__(self, journal, breaker, retry_delay, max_retry_delay,
+                 entry_lifetime, clock):
+        JournaledWork.__init__(self, journal)
+        self._breaker = breaker
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._entry_lifetime = entry_lifetime
+        self._clock = clock
+        self._handlers = {}
+        self._operations = {}
+        self._new_work = Event()
+
+    @classmethod
+    def build(cls, config):
+        journal = PendingJournal(os.path.join(config.vault_path,
+                                              ".pending_bookkeeping"))
+        breaker = CircuitBreaker(config.spool_failure_threshold,
+                                 config.spool_retry_delay,
+                                 config.spool_max_retry_delay,
+                                 loop_time)
+        return cls(journal, breaker,
+                   config.spool_retry_delay,
+                   config.spool_max_retry_delay,
+                   config.spool_entry_lifetime,
+                   loop_time)
+
+    def add_handler(self, op, handler):
+        self._handlers[op] = handler
+
+    async def attempt(self, coro_fn):
+        """
+        Runs a database operation right away. Raises DatabaseUnavailableError
+        without running it if the database is believed to be down. Other
+        errors don't say anything about the database, so they don't count as
+        failures.
+        """
+        if self._breaker.is_open():
+            raise DatabaseUnavailableError(
+                "Database is unavailable, not trying")
+        try:
+            result = await coro_fn()
+        except DatabaseUnavailableError:
+            self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
+        return result
+
+    async def defer(self, op, **args):
+        if op not in self._handlers:
+            raise ValueError(f"No handler for pending operation {op}")
+        try:
+            await self._add(op, args)
+        except OSError as e:
+            raise BookkeepingError(
+                f"Failed to write pending operation: {short_exc(e)}")
+
+    def __len__(self):
+        return len(self._operations)
+
+    def _track(self, entry):
+        if entry["op"] not in self._handlers:
+            logger.warning(f"Dropping pending operation with no handler: "
+                           f"{entry}")
+            return
+        self._operations[entry["id"]] = PendingOperation(entry)
+        metrics.pending_bookkeeping.set(len(self._operations))
+        self._new_work.set()
+
+    async def _finish(self, operation):
+        del self._operations[operation.id]
+        metrics.pending_bookkeeping.set(len(self._operations))
+        await self._mark_done(operation.id)
+
+    async def _work(self):
+        while True:
+            if not self._operations:
+                self._new_work.clear()
+                await self._new_work.wait()
+                continue
+
+            wait = self._breaker.time_until_closed()
+            operation = min(self._operations.values(),
+                            key=lambda o: o.next_attempt)
+            wait = max(wait, operation.next_attempt - self._clock())
+            if wait > 0:
+                self._new_work.clear()
+                try:
+                    await asyncio.wait_for(self._new_work.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(operation)
+
+    async def _run(self, operation):
+        # Creation time is stored in the journal, so it's wall clock time.
+        if time.time() - operation.created > self._entry_lifetime:
+            logger.warning((f"Giving up on pending {operation.op} "
+                            f"{operation.args} after {operation.attempts} "
+                            "attempts"))
+            await self._finish(operation)
+            return
+
+        handler = self._handlers[operation.op]
+        try:
+            await self.attempt(lambda: handler(**operation.args))
+        except DatabaseUnavailableError as e:
+            operation.attempts += 1
+            delay = min(self._retry_delay * 2 ** (operation.attempts - 1),
+                        self._max_retry_delay)
+            operation.next_attempt = self._clock() + delay
+            logger.debug((f"Pending {operation.op} {operation.args} failed, "
+                          f"retrying in {delay}s: {short_exc(e)}"))
+            return
+        except BookkeepingError as e:
+            # Retrying won't help if the database gave us an answer.
+            logger.warning((f"Giving up on pending {operation.op} "
+                            f"{operation.args}: {e}"))
+            await self._finish(operation)
+            return
+
+        logger.info(f"Finished pending {operation.op} {operation.args}")
+        await self._finish(operation)
@@ -0,0 +1,69 @@
+"""
+Recompressing replays that were saved at a lowered compression level while
+we were busy. Replays to recompress are kept in a journal in the vault, so
+they're not forgotten on restart, and are recompressed one by one once no
+replays were saved for a while.
+"""
+import asyncio
+import os
+from asyncio.locks import Event
+from collections import deque
+
+from replayserver.bookkeeping.pending import PendingJournal, JournaledWork
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger, short_exc
+
+
+class IdleRecompressor(JournaledWork):
+    DESCRIPTION = "replays to recompress"
+
+    def __init__(self, journal, saver, idle_time):
+        JournaledWork.__init__(self, journal)
+        self._saver = saver
+        self._idle_time = idle_time
+        self._entries = deque()
+        self._new_work = Event()
+
+    @classmethod
+    def build(cls, saver, config):
+        journal = PendingJournal(os.path.join(config.vault_path,
+                                              ".pending_recompression"))
+        return cls(journal, saver, config.recompress_idle_time)
+
+    async def replay_saved(self, game_id, level):
+        if level >= self._saver.target_compression_level:
+            return
+        try:
+            await self._add("recompress", {"game_id": game_id})
+        except OSError as e:
+            logger.warning((f"Failed to schedule recompression of replay "
+                            f"{game_id}: {short_exc(e)}"))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _track(self, entry):
+        self._entries.append(entry)
+        self._new_work.set()
+
+    async def _work(self):
+        while True:
+            if not self._entries:
+                self._new_work.clear()
+                await self._new_work.wait()
+                continue
+
+            idle = self._saver.compression_idle_time()
+            if idle < self._idle_time:
+                await asyncio.sleep(self._idle_time - idle)
+                continue
+
+            entry = self._entries.popleft()
+            game_id = entry["args"]["game_id"]
+            try:
+                await self._saver.recompress_replay(game_id)
+                logger.debug(f"Recompressed replay {game_id}")
+            except BookkeepingError as e:
+                logger.warning(
+                    f"Failed to recompress replay {game_id}: {e}")
+            await self._mark_done(entry["id"])
@@ -0,0 +1,217 @@
+"""
+Keeping replays in an S3-compatible object store instead of the local vault.
+Needs boto3, which is an optional dependency. Credentials are taken from the
+environment, as usual for boto3.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from replayserver import metrics
+from replayserver.bookkeeping.storage import ReplayFilePaths, run_in_thread
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger, short_exc
+
+
+def is_not_found(e):
+    code = getattr(e, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+class Retrying:
+    """
+    Runs blocking object store requests, retrying failed ones with
+    exponential backoff. Raises BookkeepingError once out of retries.
+    """
+
+    def __init__(self, max_retries, retry_delay, sleep=time.sleep):
+        if max_retries < 0:
+            raise ValueError("Expected a nonnegative number of retries")
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._sleep = sleep
+
+    def __call__(self, operation, fn):
+        for attempt in range(self._max_retries + 1):
+            try:
+                with metrics.object_store_latency(operation):
+                    return fn()
+            except Exception as e:
+                if is_not_found(e):
+                    raise
+                if attempt == self._max_retries:
+                    raise BookkeepingError(
+                        f"Object store {operation} failed: {short_exc(e)}")
+                metrics.object_store_retries.labels(
+                    operation=operation).inc()
+                delay = self._retry_delay * 2 ** attempt
+                logger.debug((f"Object store {operation} failed, retrying "
+                              f"in {delay}s: {short_exc(e)}"))
+                self._sleep(delay)
+
+
+class MultipartUploadWriter:
+    """
+    Binary file-like object that uploads what's written to it as an object.
+    Data is uploaded in parts as it comes, in an executor that bounds upload
+    concurrency. Objects smaller than a single part are uploaded in one
+    request. Blocking.
+    """
+    # Parts waiting for upload, per writer. Limits memory use if uploading
+    # is slower than compression.
+    MAX_PENDING_PARTS = 2
+
+    def __init__(self, client, bucket, key, part_size, executor, retrying):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size
+        self._executor = executor
+        self._retrying = retrying
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+        return len(data)
+
+    def close(self):
+        if self._upload_id is None:
+            self._retrying("put", lambda: self._client.put_object(
+                Bucket=self._bucket, Key=self._key,
+                Body=bytes(self._buffer)))
+            return
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+        parts = [{"PartNumber": i + 1, "ETag": p.result()}
+                 for i, p in enumerate(self._parts)]
+        self._retrying("complete", lambda: self._client.
+                       complete_multipart_upload(
+                           Bucket=self._bucket, Key=self._key,
+                           UploadId=self._upload_id,
+                           MultipartUpload={"Parts": parts}))
+
+    def abort(self):
+        if self._upload_id is None:
+            return
+        for p in self._parts:
+            p.cancel()
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+        except Exception as e:
+            # Bucket lifecycle rules should clean it up eventually.
+            logger.warning(
+                f"Failed to abort upload of {self._key}: {short_exc(e)}")
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self._retrying(
+                "create", lambda: self._client.create_multipart_upload(
+                    Bucket=self._bucket, Key=self._key))
+            self._upload_id = response["UploadId"]
+        pending = [p for p in self._parts if not p.done()]
+        if len(pending) >= self.MAX_PENDING_PARTS:
+            # Compressor doesn't count this in, see ReplayCompressor.
+            with metrics.object_store_latency("backpressure"):
+                pending[0].result()
+        number = len(self._parts) + 1
+        self._parts.append(self._executor.submit(
+            self._retrying, "part", lambda: self._client.upload_part(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+                PartNumber=number, Body=data)["ETag"]))
+
+
+class S3ReplayStore:
+    """
+    Keeps replays as objects in a bucket, keyed by the same layout as in the
+    local vault. See LocalReplayStore for the interface.
+    """
+
+    def __init__(self, client, bucket, keys, part_size, executor, retrying):
+        self._client = client
+        self._bucket = bucket
+        self._keys = keys
+        self._part_size = part_size
+        self._executor = executor
+        self._retrying = retrying
+
+    @classmethod
+    def build(cls, config):
+        client = boto3.client("s3",
+                              endpoint_url=config.s3_endpoint_url or None,
+                              region_name=config.s3_region or None)
+        executor = ThreadPoolExecutor(config.s3_upload_concurrency)
+        retrying = Retrying(config.s3_max_retries, config.s3_retry_delay)
+        return cls(client, config.s3_bucket,
+                   ReplayFilePaths.build(config.s3_prefix),
+                   config.s3_part_size, executor, retrying)
+
+    def location(self, game_id):
+        return f"s3://{self._bucket}/{self._key(game_id)}"
+
+    async def write_new(self, game_id, write):
+        key = self._key(game_id)
+
+        def do_write():
+            if self._exists(key):
+                raise BookkeepingError(f"Replay {key} already exists")
+            return self._upload(key, write)
+
+        return await run_in_thread(do_write)
+
+    async def rewrite(self, game_id, rewrite):
+        key = self._key(game_id)
+
+        def do_rewrite():
+            try:
+                response = self._retrying(
+                    "get", lambda: self._client.get_object(
+                        Bucket=self._bucket, Key=key))
+            except Exception as e:
+                if is_not_found(e):
+                    raise BookkeepingError(f"Replay {key} does not exist")
+                raise
+            src = response["Body"]
+            try:
+                return self._upload(key, lambda dst: rewrite(src, dst))
+            finally:
+                src.close()
+
+        return await run_in_thread(do_rewrite)
+
+    def _key(self, game_id):
+        return self._keys.replay_file(game_id)
+
+    def _exists(self, key):
+        try:
+            self._retrying("head", lambda: self._client.head_object(
+                Bucket=self._bucket, Key=key))
+            return True
+        except Exception as e:
+            if is_not_found(e):
+                return False
+            raise
+
+    def _upload(self, key, write):
+        writer = MultipartUploadWriter(self._client, self._bucket, key,
+                                       self._part_size, self._executor,
+                                       self._retrying)
+        try:
+            result = write(writer)
+            if result is not None:
+                writer.close()
+            else:
+                writer.abort()
+            return result
+        except BaseException:
+            writer.abort()
+            raise
@@ -0,0 +1,295 @@
+"""
+Handing finished replays over to a separate bookkeeping worker process, so
+that saving replays doesn't compete with live games for the server's event
+loop. The server drops each replay into a spool directory; the worker, ran
+with ``faf_replay_bookkeeper``, saves spooled replays like the server would
+and removes them once done. Several workers can share a spool on the same
+host, each claims a replay before saving it.
+"""
+import asyncio
+import json
+import os
+
+from replayserver import metrics
+from replayserver.bookkeeping.bookkeeper import Bookkeeper
+from replayserver.bookkeeping.storage import run_in_thread, remove_quietly
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger, short_exc
+from replayserver.streams.base import OutsideSourceReplayStream
+from replayserver.struct.header import ReplayHeader
+
+
+def encode_replay_header(game_id, header):
+    """
+    Returns the start of a spool file for a replay with given header (or
+    None), up to the replay data.
+    """
+    info = {
+        "game_id": game_id,
+        "header": None if header is None else header.struct,
+        "header_size": 0 if header is None else len(header.data),
+    }
+    header_data = b"" if header is None else header.data
+    return json.dumps(info).encode() + b"\n" + header_data
+
+
+class ReplaySpool:
+    """
+    Directory of replays waiting to be saved, one file per replay. A file
+    holds a line of JSON with the game id and parsed header, followed by
+    header and replay data. Files are written under a temporary name and
+    renamed once synced to disk, so the worker never sees partial replays.
+
+    A worker claims a replay by renaming it to a name with its pid, so that
+    other workers leave it alone.
+    """
+    SUFFIX = ".replay"
+    TMP_SUFFIX = ".replay.tmp"
+    CLAIMED_SUFFIX = ".claimed"
+
+    def __init__(self, path):
+        self._path = path
+
+    @classmethod
+    def build(cls, config):
+        return cls(config.worker_spool_path)
+
+    async def put(self, game_id, stream):
+        header = encode_replay_header(game_id, stream.header)
+        data = stream.data.bytes()
+        await run_in_thread(lambda: self._write(game_id, header, data))
+
+    async def ready(self):
+        "Returns ids of spooled replays, in order."
+        return await run_in_thread(self._ready)
+
+    async def claim(self, game_id):
+        """
+        Claims a spooled replay for this process. Returns False if another
+        worker claimed it first. Claimed replays are no longer ready.
+        """
+        def claim():
+            try:
+                os.rename(self.replay_file(game_id),
+                          self.claimed_file(game_id))
+                return True
+            except FileNotFoundError:
+                return False
+        return await run_in_thread(claim)
+
+    def release_stale_claims(self):
+        "Gives back replays claimed by processes that are gone. Blocking."
+        for name in os.listdir(self._path):
+            if not name.endswith(self.CLAIMED_SUFFIX):
+                continue
+            try:
+                game_id, pid = map(int, name.split(".")[:2])
+            except ValueError:
+                continue
+            if _process_exists(pid):
+                continue
+            logger.info(f"Releasing replay {game_id} claimed by "
+                        f"process {pid}")
+            try:
+                os.replace(os.path.join(self._path, name),
+                           self.replay_file(game_id))
+            except FileNotFoundError:
+                pass
+
+    async def load(self, game_id, claimed=False):
+        "Returns the spooled replay as a finished replay stream."
+        path = self._file(game_id, claimed)
+        info, data = await run_in_thread(lambda: self._read(path))
+        stream = OutsideSourceReplayStream()
+        header_size = info["header_size"]
+        if info["header"] is not None:
+            stream.set_header(ReplayHeader(data[:header_size],
+                                           info["header"]))
+        stream.feed_data(data[header_size:])
+        stream.finish()
+        return stream
+
+    async def remove(self, game_id, claimed=False):
+        path = self._file(game_id, claimed)
+        await run_in_thread(lambda: os.unlink(path))
+
+    async def set_aside(self, game_id, claimed=False):
+        "Renames a replay so that it's not picked up again."
+        path = self._file(game_id, claimed)
+        broken = f"{self.replay_file(game_id)}.broken"
+        await run_in_thread(lambda: os.replace(path, broken))
+
+    def remove_temporary(self):
+        "Removes replays left half-written by a crash. Blocking."
+        for name in os.listdir(self._path):
+            if name.endswith(self.TMP_SUFFIX):
+                remove_quietly(os.path.join(self._path, name))
+
+    def replay_file(self, game_id):
+        return os.path.join(self._path, f"{game_id}{self.SUFFIX}")
+
+    def claimed_file(self, game_id):
+        "Path of a replay claimed by this process."
+        return os.path.join(
+            self._path, f"{game_id}.{os.getpid()}{self.CLAIMED_SUFFIX}")
+
+    def _file(self, game_id, claimed):
+        if claimed:
+            return self.claimed_file(game_id)
+        return self.replay_file(game_id)
+
+    def _write(self, game_id, header, data):
+        rfile = self.replay_file(game_id)
+        tmp_file = os.path.join(self._path, f"{game_id}{self.TMP_SUFFIX}")
+        try:
+            with metrics.filesystem_latency("spool"):
+                with open(tmp_file, "wb") as f:
+                    f.write(header)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, rfile)
+        except BaseException:
+            remove_quietly(tmp_file)
+            raise
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            info = json.loads(f.readline())
+            return info, f.read()
+
+    def _ready(self):
+        ids = []
+        for name in os.listdir(self._path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                ids.append(int(name[:-len(self.SUFFIX)]))
+            except ValueError:
+                continue
+        return sorted(ids)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SpoolingBookkeeper:
+    """
+    Used by the server in place of the Bookkeeper when replays are saved by
+    a worker process.
+    """
+
+    def __init__(self, spool):
+        self._spool = spool
+
+    @classmethod
+    def build(cls, config):
+        return cls(ReplaySpool.build(config))
+
+    async def start(self):
+        await run_in_thread(self._spool.remove_temporary)
+
+    async def stop(self):
+        pass
+
+    async def save_replay(self, game_id, stream):
+        "Returns whether the replay was spooled."
+        try:
+            await self._spool.put(game_id, stream)
+            logger.debug(f"Spooled replay {game_id}")
+            return True
+        except OSError as e:
+            logger.warning(
+                f"Failed to spool replay for game {game_id}: {short_exc(e)}")
+            return False
+
+
+class BookkeepingWorker:
+    """
+    Saves replays from the spool with a Bookkeeper. Polls the spool for new
+    replays and saves up to a given number of them at once. Replays are
+    claimed before saving, so several workers can share a spool.
+    """
+
+    def __init__(self, spool, bookkeeper, poll_interval, concurrency):
+        self._spool = spool
+        self._bookkeeper = bookkeeper
+        self._poll_interval = poll_interval
+        self._slots = asyncio.Semaphore(concurrency)
+        self._saving = {}
+        self._runner = None
+
+    @classmethod
+    def build(cls, database, config):
+        return cls(ReplaySpool.build(config),
+                   Bookkeeper.build(database, config),
+                   config.worker_poll_interval, config.worker_concurrency)
+
+    async def start(self):
+        try:
+            await run_in_thread(self._spool.release_stale_claims)
+        except OSError as e:
+            logger.warning(
+                f"Failed to release stale spool claims: {short_exc(e)}")
+        await self._bookkeeper.start()
+        self._runner = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        # Let replays we started saving finish.
+        if self._saving:
+            await asyncio.wait(list(self._saving.values()))
+        await self._bookkeeper.stop()
+
+    async def _run(self):
+        while True:
+            try:
+                ready = await self._spool.ready()
+            except OSError as e:
+                logger.warning(f"Failed to list spool: {short_exc(e)}")
+                ready = []
+            metrics.spooled_replays.set(len(ready))
+            for game_id in ready:
+                if game_id in self._saving:
+                    continue
+                await self._slots.acquire()
+                self._saving[game_id] = asyncio.ensure_future(
+                    self._save(game_id))
+            await asyncio.sleep(self._poll_interval)
+
+    async def _save(self, game_id):
+        try:
+            if not await self._spool.claim(game_id):
+                return
+            try:
+                stream = await self._spool.load(game_id, claimed=True)
+            except (ValueError, KeyError) as e:
+                logger.warning((f"Setting aside broken spooled replay "
+                                f"{game_id}: {short_exc(e)}"))
+                await self._spool.set_aside(game_id, claimed=True)
+                return
+            try:
+                await self._bookkeeper.save_replay(game_id, stream)
+            except BookkeepingError as e:
+                logger.warning(
+                    f"Failed to save spooled replay {game_id}: {e}")
+            await self._spool.remove(game_id, claimed=True)
+        except OSError as e:
+            logger.warning(
+                f"Failed to process spooled replay {game_id}: {short_exc(e)}")
+        finally:
+            del self._saving[game_id]
+            self._slots.release()
@@ -1,29 +1,174 @@
 import os
 import json
+import base64
+import hashlib
+import zlib
 import zstandard as zstd
 import asyncio
+import tempfile
 import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from replayserver.errors import BookkeepingError
-from replayserver.logging import short_exc
+from replayserver import metrics
+from replayserver.bookkeeping.index import index_entry, update_index
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
+from replayserver.logging import logger, short_exc
+
+
+def run_in_thread(fn):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, fn)
+
+
+def loop_time():
+    return asyncio.get_event_loop().time()
+
+
+def remove_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def create_temp_file(rfile):
+    """
+    Creates an empty, uniquely named temporary file next to rfile, so that it
+    can be renamed into place, and returns its path.
+    """
+    rdir, name = os.path.split(rfile)
+    fd, tmp_file = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp",
+                                    dir=rdir)
+    os.close(fd)
+    return tmp_file
+
+
+def move_file(tmp_file, rfile, replace):
+    if replace:
+        os.replace(tmp_file, rfile)
+        return
+    # Unlike rename, link doesn't overwrite existing files.
+    try:
+        os.link(tmp_file, rfile)
+    except FileExistsError:
+        raise BookkeepingError(f"Replay file {rfile} already exists")
+    os.unlink(tmp_file)
+
+
+def commit_file(tmp_file, rfile, replace=False):
+    "Blocking, unbatched version of ReplayCommitter.commit."
+    try:
+        sync_file(tmp_file)
+        move_file(tmp_file, rfile, replace)
+    except (OSError, BookkeepingError):
+        remove_quietly(tmp_file)
+        raise
+    sync_file(os.path.dirname(rfile))
+
+
+class DirectoryCache:
+    """
+    Bounded LRU set of directories we know exist, so we don't have to stat
+    the whole vault path for each replay. Accessed from executor threads.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._dirs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, path):
+        with self._lock:
+            if path not in self._dirs:
+                return False
+            self._dirs.move_to_end(path)
+            return True
+
+    def add(self, path):
+        with self._lock:
+            self._dirs[path] = None
+            self._dirs.move_to_end(path)
+            if len(self._dirs) > self._size:
+                self._dirs.popitem(last=False)
+
+    def discard(self, path):
+        with self._lock:
+            self._dirs.pop(path, None)
 
 
 class ReplayFilePaths:
-    def __init__(self, replay_store_path):
+    # Each directory holds up to 100 replays.
+    DIRECTORY_CACHE_SIZE = 4096
+
+    def __init__(self, replay_store_path, directory_cache):
         self._replay_base_path = replay_store_path
+        self._directory_cache = directory_cache
 
     @classmethod
     def build(cls, config_replay_store_path):
-        return cls(config_replay_store_path)
+        return cls(config_replay_store_path,
+                   DirectoryCache(cls.DIRECTORY_CACHE_SIZE))
 
-    def get(self, game_id):
-        rpath = self._replay_path(game_id)
-        os.makedirs(rpath, exist_ok=True)
-        rfile = os.path.join(rpath, f"{str(game_id)}.fafreplay")
-        if os.path.exists(rfile):
-            raise BookkeepingError(f"Replay file {rfile} already exists")
-        open(rfile, 'a').close()    # Touch file
-        return rfile
+    async def get(self, game_id):
+        """
+        Creates an empty temporary file to write the game's replay to and
+        returns its path, along with the path the replay should be moved to
+        once it's written. Temporary file is in the same directory as the
+        replay, so it can be renamed into place. Raises BookkeepingError if
+        the replay already exists.
+
+        Filesystem access is done in a thread, as it can block for a while
+        on network filesystems.
+        """
+        return await run_in_thread(lambda: self._get(game_id))
+
+    def _get(self, game_id):
+        rfile = self.replay_file(game_id)
+        rdir = os.path.dirname(rfile)
+        if rdir not in self._directory_cache:
+            self._make_dirs(rdir)
+        try:
+            tmp_file = self._create_temp(rfile)
+        except FileNotFoundError:
+            # Someone removed the directory from under us.
+            self._directory_cache.discard(rdir)
+            self._make_dirs(rdir)
+            tmp_file = self._create_temp(rfile)
+        return tmp_file, rfile
+
+    def _make_dirs(self, rdir):
+        with metrics.filesystem_latency("makedirs"):
+            os.makedirs(rdir, exist_ok=True)
+        self._directory_cache.add(rdir)
+
+    def _create_temp(self, rfile):
+        with metrics.filesystem_latency("create"):
+            if os.path.exists(rfile):
+                raise BookkeepingError(f"Replay file {rfile} already exists")
+            return create_temp_file(rfile)
+
+    def replay_file(self, game_id):
+        "Path of a replay file. Doesn't create anything."
+        return os.path.join(self._replay_path(game_id),
+                            f"{str(game_id)}.fafreplay")
+
+    def all_replay_files(self):
+        "Yields paths of all replays in the vault. Blocking."
+        for root, dirs, files in os.walk(self._replay_base_path):
+            dirs.sort()
+            for f in sorted(files):
+                if f.endswith(".fafreplay"):
+                    yield os.path.join(root, f)
 
     def _replay_path(self, game_id):
         # Legacy folder structure:
@@ -37,32 +182,539 @@ class ReplayFilePaths:
         return os.path.join(self._replay_base_path, id_path)
 
 
-class ReplaySaver:
-    def __init__(self, paths, database):
+REPLAY_COMPRESSION_KEYS = ['compression', 'compression_dictionary',
+                           'compression_level']
+
+
+def load_dictionary(path):
+    with open(path, "rb") as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+
+def decompress_replay(info, data, dictionaries={}):
+    """
+    Decompresses replay data according to replay info. Handles both zstd
+    compressed replays and legacy base64 and zlib ones. Replays compressed
+    with a dictionary need it to be present in dictionaries, keyed by
+    dictionary ID.
+    """
+    if info.get('compression') == 'zstd':
+        dict_id = info.get('compression_dictionary')
+        if dict_id is None:
+            decompressor = zstd.ZstdDecompressor()
+        else:
+            try:
+                dict_data = dictionaries[dict_id]
+            except KeyError:
+                raise BookkeepingError(f"Missing dictionary {dict_id}")
+            decompressor = zstd.ZstdDecompressor(dict_data=dict_data)
+        return decompressor.decompress(data)
+    else:
+        # Legacy format, qCompress output in base64. First 4 bytes of
+        # qCompress output are uncompressed data size.
+        return zlib.decompress(base64.decodebytes(data)[4:])
+
+
+def read_replay_file(path):
+    "Returns info and still compressed data of a replay file. Blocking."
+    with open(path, "rb") as f:
+        info, data = f.read().split(b"\n", 1)
+    return json.loads(info), data
+
+
+def write_replay_file(path, info, data):
+    """
+    Writes replay info and compressed data to a file. Returns file size and
+    its sha256 checksum. Blocking.
+    """
+    with open(path, "wb") as f:
+        f = HashingWriter(f)
+        write_replay_info(f, info)
+        f.write(data)
+    return f.size, f.checksum()
+
+
+def write_replay_info(f, info):
+    f.write(json.dumps(info).encode('UTF-8'))
+    f.write(b"\n")
+
+
+def read_replay(path, dictionaries={}):
+    """
+    Reads a saved replay file, returns its info and uncompressed replay data.
+    Blocking.
+    """
+    info, data = read_replay_file(path)
+    return info, decompress_replay(info, data, dictionaries)
+
+
+class CompressionLevelPolicy:
+    """
+    Picks zstd compression level for each replay. We pick the highest level
+    (up to max_level) at which we estimate we can compress all replays waiting
+    to be saved within max_backlog seconds, based on recently measured
+    throughput of each level. That way we save with high compression when
+    idle, but don't fall behind when many games end at once.
+    """
+    # Rough throughput in bytes per second on replay data, refined as we go.
+    INITIAL_THROUGHPUT = {
+        level: mib * 2 ** 20 for level, mib in enumerate(
+            [400, 300, 250, 200, 120, 100, 80, 70, 60, 45, 35, 30, 15,
+             12, 10, 6, 5, 4, 3, 2.5, 2, 1.5], 1)
+    }
+    THROUGHPUT_DECAY = 0.2
+
+    def __init__(self, min_level, max_level, max_backlog, clock):
+        if min_level > max_level:
+            raise ValueError("Minimum compression level is higher than "
+                             "maximum")
+        self.min_level = min_level
+        self.max_level = max_level
+        self._max_backlog = max_backlog
+        self._clock = clock
+        self._throughput = dict(self.INITIAL_THROUGHPUT)
+        self._backlog = 0
+        self._idle_since = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fixed(cls, level):
+        return cls(level, level, 1, lambda: 0)
+
+    def queue(self, size):
+        "Marks size bytes as waiting to be compressed."
+        with self._lock:
+            self._backlog += size
+
+    def unqueue(self, size):
+        with self._lock:
+            self._backlog -= size
+            if self._backlog == 0:
+                self._idle_since = self._clock()
+
+    def idle_time(self):
+        "How long there was nothing to compress for."
+        with self._lock:
+            if self._backlog > 0:
+                return 0
+            return self._clock() - self._idle_since
+
+    def choose(self):
+        with self._lock:
+            for level in range(self.max_level, self.min_level - 1, -1):
+                if self._backlog <= (self._throughput.get(level, 1) *
+                                     self._max_backlog):
+                    return level
+            return self.min_level
+
+    def record(self, level, size, elapsed):
+        "Records that compressing size bytes at level took elapsed seconds."
+        if elapsed <= 0:
+            return
+        with self._lock:
+            old = self._throughput.get(level, size / elapsed)
+            self._throughput[level] = (
+                old * (1 - self.THROUGHPUT_DECAY) +
+                size / elapsed * self.THROUGHPUT_DECAY)
+
+
+class HashingWriter:
+    "Wraps a binary file, keeping track of size and sha256 of written data."
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def checksum(self):
+        return self._hash.hexdigest()
+
+
+class TimedWriter:
+    """
+    Wraps a binary file, keeping track of time spent writing to it, so that
+    we can tell compression time apart from output time.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.elapsed = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        try:
+            return self._f.write(data)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+class ReplayCompressor:
+    """
+    Thread-safe zstd compression of replay data, optionally using a trained
+    dictionary. Compressed data should be saved along with metadata() in
+    replay info, so we know how to decompress it.
+    """
+    # Compressed output is written out in pieces no larger than this.
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, levels, dictionary=None):
+        self.levels = levels
+        self._dictionary = dictionary
+        # zstandard is explicitly NOT thread-safe, so we keep a pool of
+        # compressors for each level and hand them out to one thread at a
+        # time.
+        self._compressors = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, config):
+        if config.compression_dictionary is None:
+            dictionary = None
+        else:
+            dictionary = load_dictionary(config.compression_dictionary)
+        levels = CompressionLevelPolicy(
+            min(config.compression_min_level, config.compression_level),
+            config.compression_level,
+            config.compression_max_backlog,
+            loop_time)
+        return cls(levels, dictionary)
+
+    @contextmanager
+    def queued(self, size):
+        "Marks data of given size as waiting for compression while active."
+        self.levels.queue(size)
+        try:
+            yield
+        finally:
+            self.levels.unqueue(size)
+
+    def choose_level(self):
+        return self.levels.choose()
+
+    def compress(self, data, level=None):
+        """
+        Returns compressed data and metadata. Picks compression level
+        according to our policy if not given.
+        """
+        if level is None:
+            level = self.choose_level()
+        with self._compressor(level) as compressor:
+            start = time.perf_counter()
+            result = compressor.compress(data)
+            elapsed = time.perf_counter() - start
+        self._record(level, len(data), elapsed)
+        return result, self.metadata(level)
+
+    def compress_to(self, f, data, level):
+        """
+        Compresses data into a binary file-like object, writing output as it
+        is produced.
+        """
+        # We measure how fast we compress, not how fast we can write.
+        f = TimedWriter(f)
+        with self._compressor(level) as compressor:
+            start = time.perf_counter()
+            with compressor.stream_writer(f, size=len(data),
+                                          closefd=False) as writer:
+                view = memoryview(data)
+                for i in range(0, len(view), self.CHUNK_SIZE):
+                    writer.write(view[i:i + self.CHUNK_SIZE])
+            elapsed = time.perf_counter() - start - f.elapsed
+        self._record(level, len(data), elapsed)
+
+    def decompress(self, info, data):
+        dictionaries = {}
+        if self._dictionary is not None:
+            dictionaries[self._dictionary.dict_id()] = self._dictionary
+        return decompress_replay(info, data, dictionaries)
+
+    def metadata(self, level):
+        result = {'compression': 'zstd', 'compression_level': level}
+        if self._dictionary is not None:
+            result['compression_dictionary'] = self._dictionary.dict_id()
+        return result
+
+    @contextmanager
+    def _compressor(self, level):
+        with self._lock:
+            pool = self._compressors.setdefault(level, [])
+            compressor = pool.pop() if pool else None
+        if compressor is None:
+            # TODO - consider multi-threaded compression if we end up
+            # needing more performance.
+            compressor = zstd.ZstdCompressor(level=level,
+                                             dict_data=self._dictionary,
+                                             write_checksum=True)
+        try:
+            yield compressor
+        finally:
+            with self._lock:
+                self._compressors[level].append(compressor)
+
+    def _record(self, level, size, elapsed):
+        self.levels.record(level, size, elapsed)
+        metrics.compression_level.observe(level)
+
+
+class ReplayCommitter:
+    """
+    Durably moves written replay files into place. A file is fsync'd, then
+    renamed to its final path, then the directory is fsync'd, so that after a
+    crash we either have the whole replay or no replay at all.
+
+    Commits are done in batches in a thread. Files committed while a batch is
+    being synced, or within batch_delay after a batch starts collecting, are
+    synced together, so a burst of finished games costs one round trip to the
+    executor and one directory fsync per directory instead of one each.
+    """
+
+    def __init__(self, batch_delay):
+        self._batch_delay = batch_delay
+        self._batch = []
+        self._flushing = None
+
+    @classmethod
+    def build(cls, config):
+        return cls(config.fsync_batch_delay)
+
+    async def commit(self, tmp_file, rfile, replace=False):
+        """
+        Moves tmp_file to rfile once it's on disk. If replace is False and
+        rfile exists, raises BookkeepingError and removes tmp_file.
+        """
+        done = asyncio.get_event_loop().create_future()
+        self._batch.append((tmp_file, rfile, replace, done))
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush())
+        await done
+
+    async def _flush(self):
+        try:
+            while self._batch:
+                if self._batch_delay > 0:
+                    await asyncio.sleep(self._batch_delay)
+                batch, self._batch = self._batch, []
+                try:
+                    results = await run_in_thread(
+                        lambda: self._sync_batch(batch))
+                except Exception as e:
+                    results = [e] * len(batch)
+                for (*_, done), result in zip(batch, results):
+                    if done.done():
+                        continue
+                    if result is None:
+                        done.set_result(None)
+                    else:
+                        done.set_exception(result)
+        finally:
+            self._flushing = None
+
+    def _sync_batch(self, batch):
+        metrics.fsync_batch_size.observe(len(batch))
+        results = []
+        dirs = set()
+        with metrics.filesystem_latency("sync"):
+            for tmp_file, rfile, replace, _ in batch:
+                try:
+                    sync_file(tmp_file)
+                    move_file(tmp_file, rfile, replace)
+                    dirs.add(os.path.dirname(rfile))
+                    results.append(None)
+                except (OSError, BookkeepingError) as e:
+                    remove_quietly(tmp_file)
+                    results.append(e)
+            for d in dirs:
+                # Replays are in place either way, so don't fail them.
+                try:
+                    sync_file(d)
+                except OSError as e:
+                    logger.warning(
+                        f"Failed to sync directory {d}: {short_exc(e)}")
+        return results
+
+
+class LocalReplayStore:
+    """
+    Keeps replays as files in the vault, in the legacy directory layout.
+
+    Replay stores take blocking functions that write replays to binary
+    file-like objects and run them in a thread. A store either saves the
+    whole replay or nothing at all.
+    """
+
+    def __init__(self, paths, committer):
         self._paths = paths
+        self._committer = committer
+
+    @classmethod
+    def build(cls, config):
+        return cls(ReplayFilePaths.build(config.vault_path),
+                   ReplayCommitter.build(config))
+
+    def location(self, game_id):
+        return self._paths.replay_file(game_id)
+
+    async def write_new(self, game_id, write):
+        """
+        Saves a new replay written by write(f), returning what it returns.
+        Raises BookkeepingError if the replay already exists.
+        """
+        tmp_file, rfile = await self._paths.get(game_id)
+        result = await run_in_thread(lambda: self._write(tmp_file, write))
+        await self._committer.commit(tmp_file, rfile)
+        return result
+
+    async def rewrite(self, game_id, rewrite):
+        """
+        Replaces a saved replay with one written by rewrite(src, dst), which
+        reads the old replay from src. If rewrite returns None, the replay
+        is left as it was.
+        """
+        rfile = self._paths.replay_file(game_id)
+
+        def do_rewrite():
+            # Saving or rewriting the same replay at once mustn't clobber
+            # our file.
+            tmp_file = create_temp_file(rfile)
+            with open(rfile, "rb") as src:
+                result = self._write(tmp_file, lambda dst: rewrite(src, dst))
+            if result is None:
+                remove_quietly(tmp_file)
+            return tmp_file, result
+
+        tmp_file, result = await run_in_thread(do_rewrite)
+        if result is None:
+            return None
+        await self._committer.commit(tmp_file, rfile, replace=True)
+        return result
+
+    def _write(self, tmp_file, write):
+        try:
+            with metrics.filesystem_latency("write"):
+                with open(tmp_file, "wb") as f:
+                    return write(f)
+        except BaseException:
+            remove_quietly(tmp_file)
+            raise
+
+
+class ReplaySaver:
+    def __init__(self, store, compressor, database, pending=None,
+                 index=None):
+        self._store = store
+        self._compressor = compressor
         self._database = database
-        # TODO - consider multi-threaded compression if we end up needing more
-        # performance.
-        self._compressor = zstd.ZstdCompressor(level=19,
-                                               write_checksum=True)
-        self._compressor_lock = threading.Lock()
+        self._pending = pending
+        self._index = index
+        # Updating info and recompressing both replace the whole file.
+        self._rewrite_lock = asyncio.Lock()
 
     @classmethod
-    def build(cls, database, config):
-        paths = ReplayFilePaths.build(config.vault_path)
-        return cls(paths, database)
+    def build(cls, database, store, config, pending=None, index=None):
+        compressor = ReplayCompressor.build(config)
+        return cls(store, compressor, database, pending, index)
 
     async def save_replay(self, game_id, stream):
+        """
+        Saves the replay and returns its index entry (see index_entry), with
+        ticks unknown. Doesn't add it to the index.
+        """
         if stream.header is None:
             raise BookkeepingError("Saved replay has no header")
-        info = await self._get_replay_info(game_id, stream.header.struct)
-        rfile = self._paths.get(game_id)
+        data = stream.header.data + stream.data.bytes()
+        location = self._store.location(game_id)
+        with self._compressor.queued(len(data)):
+            info, info_complete = await self._get_replay_info_or_placeholder(
+                game_id, stream.header.struct)
+            try:
+                entry = await self._store.write_new(
+                    game_id,
+                    lambda f: self._write_replay(f, location, info, data))
+            except IOError as e:
+                raise BookkeepingError(
+                    f"Failed to write replay: {short_exc(e)}")
+        if not info_complete:
+            try:
+                await self._pending.defer("replay_info", game_id=game_id)
+            except BookkeepingError as e:
+                # The replay is saved, it just lacks info.
+                logger.warning(
+                    f"Failed to defer info update for game {game_id}: {e}")
+        return entry
+
+    @property
+    def target_compression_level(self):
+        return self._compressor.levels.max_level
+
+    def compression_idle_time(self):
+        return self._compressor.levels.idle_time()
+
+    async def update_replay_info(self, game_id):
+        """
+        Fetches replay info again and replaces it in an already saved replay.
+        Used for replays saved while the database was unavailable.
+        """
+        info = await self._get_replay_info(game_id, None)
+        location = self._store.location(game_id)
+        async with self._rewrite_lock:
+            try:
+                entry = await self._store.rewrite(
+                    game_id,
+                    lambda src, dst: self._replace_replay_info(
+                        src, dst, location, info))
+            except IOError as e:
+                raise BookkeepingError(
+                    f"Failed to update replay info: {short_exc(e)}")
+            await self._update_index(entry)
+
+    async def recompress_replay(self, game_id):
+        """
+        Compresses an already saved replay again at target compression level,
+        if it was saved at a lower one.
+        """
+        location = self._store.location(game_id)
+        async with self._rewrite_lock:
+            try:
+                entry = await self._store.rewrite(
+                    game_id,
+                    lambda src, dst: self._recompress_replay(src, dst,
+                                                             location))
+            except (IOError, ValueError, zstd.ZstdError) as e:
+                raise BookkeepingError(
+                    f"Failed to recompress replay: {short_exc(e)}")
+            if entry is not None:
+                await self._update_index(entry)
+
+    async def _update_index(self, entry):
+        # Replays saved before the index existed are left for the backfill.
+        if self._index is not None:
+            await update_index(self._index, entry, replace=False)
+
+    async def _get_replay_info_or_placeholder(self, game_id, header):
+        if self._pending is None:
+            return await self._get_replay_info(game_id, header), True
         try:
-            with open(rfile, "wb") as f:
-                await self._write_replay_in_thread(
-                    f, info, stream.header.data + stream.data.bytes())
-        except IOError as e:
-            raise BookkeepingError(f"Failed to write replay: {short_exc(e)}")
+            info = await self._pending.attempt(
+                lambda: self._get_replay_info(game_id, header))
+            return info, True
+        except DatabaseUnavailableError as e:
+            logger.warning((f"Failed to get info for game {game_id}, "
+                            f"saving without it for now: {e}"))
+            return self._placeholder_replay_info(game_id), False
+
+    def _placeholder_replay_info(self, game_id):
+        return {
+            'uid': game_id,
+            'complete': True,
+            'state': 'PLAYING',
+            'version': 2,
+            'compression': 'zstd',
+        }
 
     async def _get_replay_info(self, game_id, header):
         result = {}
@@ -90,19 +742,43 @@ class ReplaySaver:
         # Replay format uses strings for teams for some reason
         return {str(t) if t is not None else "null": p for t, p in d.items()}
 
-    async def _write_replay_in_thread(self, rfile, info, data):
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None, lambda: self._write_replay(rfile, info, data))
-
-    def _write_replay(self, rfile, info, data):
+    def _write_replay(self, f, location, info, data, level=None):
+        if level is None:
+            level = self._compressor.choose_level()
+        info = dict(info)
+        info.update(self._compressor.metadata(level))
+        f = HashingWriter(f)
         try:
-            rfile.write(json.dumps(info).encode('UTF-8'))
-            rfile.write(b"\n")
-            # zstandard is explicitly NOT thread-safe
-            with self._compressor_lock:
-                data = self._compressor.compress(data)
-            rfile.write(data)
+            write_replay_info(f, info)
         # json should always produce ascii, but just in case...
         except UnicodeEncodeError:
             raise BookkeepingError("Unicode encoding error")
+        self._compressor.compress_to(f, data, level)
+        return index_entry(location, info, f.size, f.checksum(), len(data))
+
+    def _recompress_replay(self, src, dst, location):
+        info, data = src.read().split(b"\n", 1)
+        info = json.loads(info)
+        level = self.target_compression_level
+        # Replays saved before we recorded the level used the maximum one.
+        if info.get('compression_level', level) >= level:
+            return None
+        data = self._compressor.decompress(info, data)
+        for key in REPLAY_COMPRESSION_KEYS:
+            info.pop(key, None)
+        return self._write_replay(dst, location, info, data, level)
+
+    def _replace_replay_info(self, src, dst, location, info):
+        old_info, data = src.read().split(b"\n", 1)
+        old_info = json.loads(old_info)
+        # Keep describing how the data was compressed, compression
+        # settings might have changed since.
+        info = dict(info)
+        for key in REPLAY_COMPRESSION_KEYS:
+            info.pop(key, None)
+            if key in old_info:
+                info[key] = old_info[key]
+        dst = HashingWriter(dst)
+        write_replay_info(dst, info)
+        dst.write(data)
+        return index_entry(location, info, dst.size, dst.checksum())
@@ -42,6 +42,9 @@ class ServesConnections:
         await self._after_connections_end()
         self._ended.set()
 
+    def ended(self):
+        return self._ended.is_set()
+
     async def wait_for_ended(self):
         await self._ended.wait()
 
@@ -5,10 +5,12 @@ with less boilerplate, provides some common parsers with extra checks.
 
 import os
 from everett.component import RequiredConfigMixin, ConfigOptions
+from everett.manager import parse_bool
 
 
-__all__ = ["positive_int", "positive_float",
-           "nonnegative_float", "is_dir", "Config"]
+__all__ = ["positive_int", "nonnegative_int", "positive_float",
+           "nonnegative_float", "boolean", "is_dir", "optional_file",
+           "Config"]
 
 
 def positive_int(v):
@@ -18,6 +20,13 @@ def positive_int(v):
     return i
 
 
+def nonnegative_int(v):
+    i = int(v)
+    if i < 0:
+        raise ValueError("Expected a nonnegative value")
+    return i
+
+
 def positive_float(v):
     i = float(v)
     if i <= 0:
@@ -32,12 +41,24 @@ def nonnegative_float(v):
     return i
 
 
+def boolean(v):
+    return parse_bool(v)
+
+
 def is_dir(d):
     if not os.path.isdir(d):
         raise ValueError(f"Directory {d} does not exist")
     return d
 
 
+def optional_file(f):
+    if not f:
+        return None
+    if not os.path.isfile(f):
+        raise ValueError(f"File {f} does not exist")
+    return f
+
+
 class _ConfigMeta(type):
     def __init__(cls, name, bases, attrs, *args, **kwargs):
         super().__init__(name, bases, attrs, *args, **kwargs)
@@ -46,3 +46,20 @@ class BookkeepingError(Exception):
     replay.
     """
     pass
+
+
+class DatabaseUnavailableError(BookkeepingError):
+    """
+    Used when we couldn't run a database query at all, as opposed to the
+    query giving us an answer we can't use. Only these are worth retrying
+    later.
+    """
+    pass
+
+
+class WorkerExitedError(Exception):
+    """
+    Used when a worker of a Supervisor died, so that the whole server exits
+    and can be restarted.
+    """
+    pass
@@ -6,12 +6,19 @@ the environment, constructs and runs the server. ::
 import asyncio
 import signal
 import os
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from everett.manager import ConfigManager, ConfigOSEnv
 from everett.ext.yamlfile import ConfigYamlEnv
 from everett import ConfigurationError
 
 from replayserver import Server, MainConfig
 from replayserver.logging import logger
+from replayserver.server.sharding import Supervisor
 
 
 __all__ = ["main"]
@@ -39,6 +46,24 @@ def setup_signal_handler(server, loop):
 
     for sig in [signal.SIGINT, signal.SIGTERM]:
         loop.add_signal_handler(sig, shutdown_gracefully)
+    loop.add_signal_handler(signal.SIGUSR1, server.log_memory_usage)
+
+
+def setup_event_loop_policy(use_uvloop):
+    if not use_uvloop:
+        return
+    if uvloop is None:
+        logger.warning("uvloop is not installed, using default event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop")
+
+
+def build_worker(config, dep_connection_producer):
+    "Builds the server of a worker process or thread of a supervisor."
+    return Server.build(config=config,
+                        dep_connection_producer=dep_connection_producer,
+                        serve_metrics=False)
 
 
 def main():
@@ -51,7 +76,13 @@ def main():
 
     try:
         logger.setLevel(config.log_level)
-        server = Server.build(config=config)
+        # Before making any loops, workers' loops included.
+        setup_event_loop_policy(config.uvloop)
+        if config.server.workers > 0:
+            server = Supervisor.build(config=config)
+            server.spawn_workers(build_worker, config)
+        else:
+            server = Server.build(config=config)
         loop = asyncio.get_event_loop()
         setup_signal_handler(server, loop)
         loop.run_until_complete(server.run())
@@ -1,21 +1,27 @@
 """
 Wrappers for prometheus metrics and their helper functions, for more idiomatic
-usage.
+usage. Gauges say how to combine values of worker processes, for when we run
+with a supervisor (see server.sharding).
 """
 
-from prometheus_client import Gauge, Counter
+from prometheus_client import Gauge, Counter, Histogram
 from contextlib import contextmanager
 
 
 active_conns = Gauge(
     "replayserver_active_connections_count",
     "Count of currently active connections.",
-    ["category"])
+    ["category"], multiprocess_mode="livesum")
 served_conns = Counter(
     "replayserver_served_connections_total",
     "How many connections we served to completion.",
     ["result"])
 successful_conns = served_conns.labels(result="Success")
+parked_conns = active_conns.labels(category="parked")
+parked_connection_bytes = Gauge(
+    "replayserver_parked_connection_memory_bytes",
+    "Estimated bytes held per connection parked until it sends data.",
+    multiprocess_mode="max")
 
 
 def failed_conns(exception):
@@ -24,13 +30,55 @@ def failed_conns(exception):
 
 running_replays = Gauge(
     "replayserver_running_replays_count",
-    "Count of currently running replays.")
+    "Count of currently running replays.",
+    multiprocess_mode="livesum")
 finished_replays = Counter(
     "replayserver_finished_replays_total",
     "Number of replays ran to completion.")
 saved_replays = Counter(
     "replayserver_saved_replay_files_total",
     "Total replays successfully saved to disk.")
+filesystem_latency_seconds = Histogram(
+    "replayserver_filesystem_operation_seconds",
+    "Time spent on filesystem operations when saving replays.",
+    ["operation"])
+fsync_batch_size = Histogram(
+    "replayserver_fsync_batch_size",
+    "Number of replay files synced to disk together.",
+    buckets=[1, 2, 5, 10, 20, 50, 100, 200, 500])
+compression_level = Histogram(
+    "replayserver_compression_level",
+    "Zstd compression level replays were compressed with.",
+    buckets=list(range(1, 23)))
+object_store_latency_seconds = Histogram(
+    "replayserver_object_store_operation_seconds",
+    "Time spent on object store requests when saving replays.",
+    ["operation"])
+object_store_retries = Counter(
+    "replayserver_object_store_retries_total",
+    "Object store requests retried after failing.",
+    ["operation"])
+spooled_replays = Gauge(
+    "replayserver_spooled_replays_count",
+    "Count of replays waiting in the spool for the bookkeeping worker.",
+    multiprocess_mode="livesum")
+pending_bookkeeping = Gauge(
+    "replayserver_pending_bookkeeping_operations_count",
+    "Count of database operations waiting to be retried.",
+    multiprocess_mode="livesum")
+stream_memory_bytes = Gauge(
+    "replayserver_stream_memory_bytes",
+    "Bytes of replay data held in memory by streams of running replays.",
+    ["kind"], multiprocess_mode="livesum")
+stream_peak_memory_bytes = Histogram(
+    "replayserver_stream_peak_memory_bytes",
+    "Most bytes of replay data a stream held in memory at once.",
+    ["kind"],
+    buckets=[2 ** i for i in range(16, 30)])
+comparison_cutoff_bytes = Histogram(
+    "replayserver_stream_comparison_cutoff_bytes",
+    "Stream comparison cutoffs applied to games by adaptive cutoff.",
+    buckets=[2 ** i for i in range(10, 26)])
 
 
 @contextmanager
@@ -42,7 +90,21 @@ def track(metric):
         metric.dec()
 
 
+def filesystem_latency(operation):
+    return filesystem_latency_seconds.labels(operation=operation).time()
+
+
+def object_store_latency(operation):
+    return object_store_latency_seconds.labels(operation=operation).time()
+
+
+def stream_peak_memory(kind):
+    return stream_peak_memory_bytes.labels(kind=kind)
+
+
 class ConnectionGauge:
+    __slots__ = ("_active",)
+
     def __init__(self):
         self._active = None
 
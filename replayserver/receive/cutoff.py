@@ -0,0 +1,29 @@
+from replayserver import metrics
+
+
+class AdaptiveCutoff:
+    """
+    Picks a stream comparison cutoff for a game between min_cutoff and
+    max_cutoff. The fuller the memory budget, the smaller the cutoff. Games
+    with more than two writers (a typical quorum) get proportionally smaller
+    cutoffs, since each writer buffers data up to the cutoff.
+    """
+    TYPICAL_WRITERS = 2
+
+    def __init__(self, budget, min_cutoff, max_cutoff):
+        self._budget = budget
+        self._min_cutoff = min(min_cutoff, max_cutoff)
+        self._max_cutoff = max_cutoff
+
+    @classmethod
+    def build(cls, budget, config):
+        return cls(budget, config.min_stream_comparison_cutoff,
+                   config.stream_comparison_cutoff)
+
+    def for_writers(self, writers):
+        scale = 1 - self._budget.pressure()
+        scale *= self.TYPICAL_WRITERS / max(writers, self.TYPICAL_WRITERS)
+        cutoff = self._min_cutoff + int(
+            (self._max_cutoff - self._min_cutoff) * scale)
+        metrics.comparison_cutoff_bytes.observe(cutoff)
+        return cutoff
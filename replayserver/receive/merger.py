@@ -1,11 +1,14 @@
 import asyncio
+import weakref
 
 from replayserver.struct.header import ReplayHeader
 from replayserver.errors import MalformedDataError
 from replayserver.common import ServesConnections
-from replayserver.streams import OutsideSourceReplayStream, DelayedReplayStream
+from replayserver.streams import OutsideSourceReplayStream, \
+    DelayedReplayStream, SpillableReplayStream
 from replayserver.receive.mergestrategy import QuorumMergeStrategy
-from replayserver import config
+from replayserver.receive.cutoff import AdaptiveCutoff
+from replayserver import config, metrics
 
 
 class ReplayStreamReader:
@@ -18,9 +21,12 @@ class ReplayStreamReader:
         self.stream = stream
 
     @classmethod
-    def build(cls, connection):
+    def build(cls, connection, budget=None):
         header_reader = ReplayHeader.from_connection
-        stream = OutsideSourceReplayStream()
+        if budget is not None:
+            stream = SpillableReplayStream(budget)
+        else:
+            stream = OutsideSourceReplayStream()
         return cls(header_reader, stream, connection)
 
     async def _read_header(self):
@@ -86,6 +92,15 @@ class MergerConfig(config.Config):
                     ""
                     "The above doesn't happen in practice - a diverged replay "
                     "stays diverged (and ends soon after).")
+        },
+        "min_stream_comparison_cutoff": {
+            "parser": lambda x: None if x == "" else config.positive_int(x),
+            "default": "",
+            "doc": ("If set together with stream_comparison_cutoff and "
+                    "replay.writer_memory_budget, the cutoff of each game "
+                    "adapts between this value and stream_comparison_cutoff. "
+                    "It shrinks as writer buffers fill the memory budget, "
+                    "and for games with many writers.")
         }
     }
 
@@ -114,40 +129,74 @@ class DelayConfig(config.Config):
 
 
 class Merger(ServesConnections):
+    # How often we adapt comparison cutoff.
+    CUTOFF_INTERVAL = 10
+
     def __init__(self, reader_builder, delayed_stream_builder,
-                 merge_strategy, canonical_stream):
+                 merge_strategy, canonical_stream, cutoff=None):
         ServesConnections.__init__(self)
         self._reader_builder = reader_builder
         self._delayed_stream_builder = delayed_stream_builder
         self._merge_strategy = merge_strategy
         self.canonical_stream = canonical_stream
+        # Writer streams live as long as the merge strategy needs them.
+        self._writer_streams = weakref.WeakSet()
+        if cutoff is not None:
+            self._adapting_cutoff = asyncio.ensure_future(
+                self._adapt_cutoff(cutoff))
+        else:
+            self._adapting_cutoff = None
 
     @classmethod
-    def build(cls, merge_config, delay_config):
-        canonical_replay = OutsideSourceReplayStream()
+    def build(cls, merge_config, delay_config, canonical_replay=None,
+              budget=None):
+        if canonical_replay is None:
+            canonical_replay = OutsideSourceReplayStream()
         merge_strategy = QuorumMergeStrategy.build(canonical_replay,
                                                    merge_config)
-        return cls(ReplayStreamReader.build,
+        if (budget is not None
+                and merge_config.min_stream_comparison_cutoff is not None
+                and merge_config.stream_comparison_cutoff is not None):
+            cutoff = AdaptiveCutoff.build(budget, merge_config)
+        else:
+            cutoff = None
+        return cls(lambda c: ReplayStreamReader.build(c, budget),
                    lambda s: DelayedReplayStream.build(s, delay_config),
-                   merge_strategy, canonical_replay)
+                   merge_strategy, canonical_replay, cutoff)
 
     async def _handle_connection(self, connection):
         reader = self._reader_builder(connection)
+        self._writer_streams.add(reader.stream)
         delayed_stream = self._delayed_stream_builder(reader.stream)
-        strategy_callbacks = asyncio.ensure_future(
-            self._merge_strategy.track_stream(delayed_stream))
+        self._merge_strategy.track_stream(delayed_stream)
         try:
             await reader.read()
         finally:
-            await strategy_callbacks
+            await delayed_stream.wait_for_ended()
+            metrics.stream_peak_memory("writer").observe(
+                reader.stream.memory().peak)
         return reader.stream
 
+    def writer_memory(self):
+        "Memory usage of writer streams, as a list of StreamMemory."
+        return [s.memory() for s in self._writer_streams]
+
+    async def _adapt_cutoff(self, cutoff):
+        while True:
+            await asyncio.sleep(self.CUTOFF_INTERVAL)
+            writers = len(self._writer_streams)
+            self._merge_strategy.set_cmp_cutoff(cutoff.for_writers(writers))
+
     async def no_connections_for(self, grace_period):
         await self._connection_count.wait_until_empty_for(grace_period)
 
     async def _after_connections_end(self):
+        if self._adapting_cutoff is not None:
+            self._adapting_cutoff.cancel()
         self._merge_strategy.finalize()
         self.canonical_stream.finish()
+        metrics.stream_peak_memory("canonical").observe(
+            self.canonical_stream.memory().peak)
 
     def __str__(self):
         return "Merger"
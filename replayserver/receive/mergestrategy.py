@@ -22,20 +22,19 @@ class MergeStrategy:
     def stream_removed(self, stream):
         raise NotImplementedError
 
-    # Convenience stuff.
-    async def track_stream(self, stream):
+    # Convenience stuff. Observes the stream and reports what happens to it.
+    def track_stream(self, stream):
         self.stream_added(stream)
-        header = await stream.wait_for_header()
-        if header is not None:
+        stream.add_observer(self)
+
+    def on_header(self, stream):
+        if stream.header is not None:
             self.new_header(stream)
-        position = 0
-        while True:
-            dlen = await stream.wait_for_data(position)
-            position += dlen
-            if dlen != 0:
-                self.new_data(stream)
-            else:
-                break
+
+    def on_data(self, stream):
+        self.new_data(stream)
+
+    def on_end(self, stream):
         self.stream_removed(stream)
 
 
@@ -66,6 +65,11 @@ class QuorumSets:
         self._s2q[stream] = qs
         self.candidates.add(qs)
 
+    def set_cmp_cutoff(self, cmp_cutoff):
+        self._cmp_cutoff = cmp_cutoff
+        for qs in self._s2q.values():
+            qs.set_cmp_cutoff(cmp_cutoff)
+
     def get_qs(self, stream):
         return self._s2q[stream]
 
@@ -107,6 +111,8 @@ class QuorumSets:
 
 
 class QuorumStream:
+    __slots__ = ("stream", "_div", "role", "stalemate_byte", "ended")
+
     def __init__(self, stream, sink, cmp_cutoff):
         self.stream = stream
         self._div = DivergenceTracking(stream, sink, cmp_cutoff)
@@ -125,19 +131,24 @@ class QuorumStream:
     def set_as_matching(self, c):
         self._div.set_as_matching(c)
 
+    def set_cmp_cutoff(self, cmp_cutoff):
+        self._div.cmp_cutoff = cmp_cutoff
+
 
 class DivergenceTracking:
     """
     Allows us to compare stream with sink for divergence. Ensures that we never
     compare the same data twice.
     """
+    __slots__ = ("_stream", "_sink", "diverges", "_compared_num",
+                 "cmp_cutoff")
 
     def __init__(self, stream, sink, cmp_cutoff):
         self._stream = stream
         self._sink = sink
         self.diverges = False
         self._compared_num = 0
-        self._cmp_cutoff = cmp_cutoff
+        self.cmp_cutoff = cmp_cutoff
 
     def check_divergence(self, ended):
         if self.diverges:
@@ -151,8 +162,8 @@ class DivergenceTracking:
             return
 
         start = self._compared_num
-        if self._cmp_cutoff is not None:
-            max_cmp = stream_len - self._cmp_cutoff
+        if self.cmp_cutoff is not None:
+            max_cmp = stream_len - self.cmp_cutoff
             start = max(start, max_cmp)
         end = min(stream_len, sink_len)
         if start >= end:
@@ -245,6 +256,14 @@ class QuorumMergeStrategy(MergeStrategy):
         return cls(sink, config.desired_quorum,
                    config.stream_comparison_cutoff)
 
+    def set_cmp_cutoff(self, cmp_cutoff):
+        """
+        Changes comparison cutoff. Data discarded with a smaller cutoff stays
+        discarded, and it is not compared when the cutoff grows again.
+        """
+        self._cmp_cutoff = cmp_cutoff
+        self.sets.set_cmp_cutoff(cmp_cutoff)
+
     def _quorum_point_reached(self):
         return (self._state == QuorumState.QUORUM and
                 len(self.sink_stream.data) >= self._quorum_point)
@@ -402,6 +421,8 @@ class QuorumMergeStrategy(MergeStrategy):
         discard_size = self._quorum_point - self._cmp_cutoff
         for qs in self.sets.candidates:
             qs.stream.discard(discard_size)
+            # Cutoff can grow later, make sure we don't compare this data.
+            qs.set_as_matching(discard_size)
 
     def _mark_quorum_as_matching(self):
         for qs in self.sets.quorum:
@@ -440,7 +461,7 @@ class QuorumMergeStrategy(MergeStrategy):
         send_from = len(self.sink_stream.data)
         send_to = min(len(qs.stream.data), self._quorum_point)
         if send_from < send_to:
-            self.sink_stream.feed_data(qs.stream.data[send_from:send_to])
+            self.sink_stream.feed_from(qs.stream, send_from, send_to)
         qs.stream.discard(len(self.sink_stream.data))
 
     def finalize(self):
@@ -5,6 +5,8 @@ from replayserver.logging import logger
 class ReplayStreamWriter:
     def __init__(self, stream):
         self._stream = stream
+        # Connection -> position of data we sent it up to
+        self._positions = {}
 
     @classmethod
     def build(cls, stream):
@@ -21,17 +23,25 @@ class ReplayStreamWriter:
         if header is not None:
             await connection.write(header.data)
 
+    def lowest_position(self):
+        "Lowest position connections were sent data up to, or None."
+        return min(self._positions.values(), default=None)
+
     async def _write_replay(self, connection):
         position = 0
-        while True:
-            dlen = await self._stream.wait_for_data(position)
-            if dlen == 0:
-                break
-            data = self._stream.data[position:position+dlen]
-            position += dlen
-            conn_open = await connection.write(data)
-            if not conn_open:
-                break
+        try:
+            while True:
+                self._positions[connection] = position
+                dlen = await self._stream.wait_for_data(position)
+                if dlen == 0:
+                    break
+                data = await self._stream.read(position, dlen)
+                position += len(data)
+                conn_open = await connection.write(data)
+                if not conn_open:
+                    break
+        finally:
+            del self._positions[connection]
 
         logger.info((f"Finished writing to {connection}, "
                      f"sent {position} data bytes total"))
@@ -48,6 +58,9 @@ class Sender(ServesConnections):
         writer = ReplayStreamWriter.build(stream)
         return cls(stream, writer)
 
+    def lowest_position(self):
+        return self._writer.lowest_position()
+
     async def _handle_connection(self, connection):
         await self._writer.send_to(connection)
 
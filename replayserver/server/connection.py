@@ -1,18 +1,24 @@
 from enum import Enum
 import asyncio
+import os
 from asyncio.streams import IncompleteReadError, LimitOverrunError
 from replayserver.errors import MalformedDataError, EmptyConnectionError
 from replayserver.logging import short_exc
+from replayserver.timers import timer_wheel
 
 
 class Connection:
+    # We hold lots of idle connections, keep them small.
+    __slots__ = ("reader", "writer", "_closed", "_header", "_closed_by_us",
+                 "_closing_timer", "_linger_time")
+
     def __init__(self, reader, writer, linger_time):
         self.reader = reader
         self.writer = writer
         self._closed = False
         self._header = None
         self._closed_by_us = False
-        self._closing_coro = None
+        self._closing_timer = None
         self._linger_time = linger_time
 
     async def read(self, size):
@@ -54,15 +60,12 @@ class Connection:
     def close(self, immediate=False):
         if immediate:
             self._do_close()
-        elif self._closing_coro is None:
-            self._closing_coro = asyncio.ensure_future(self._delayed_close())
-
-    async def _delayed_close(self):
-        # HACK - I suspect FA has a bug where it fails to process all the data
-        # before the connection to the server ends. I don't know how since it's
-        # TCP, but let's try and verify this.
-        await asyncio.sleep(self._linger_time)
-        self._do_close()
+        elif self._closing_timer is None:
+            # HACK - I suspect FA has a bug where it fails to process all the
+            # data before the connection to the server ends. I don't know how
+            # since it's TCP, but let's try and verify this.
+            self._closing_timer = timer_wheel().call_later(
+                self._linger_time, self._do_close)
 
     def _do_close(self):
         if self._closed:
@@ -73,6 +76,23 @@ class Connection:
         # Reader and writer share a transport, so no need to close reader.
 
 
+    def set_socket_options(self, options):
+        options.apply(self.writer.get_extra_info("socket"))
+
+    def detach(self):
+        """
+        Takes the socket away from us, for passing it to another process.
+        Returns a duplicate of its file descriptor and data we received, but
+        nobody read yet. Closes the connection on our side.
+        """
+        sock = self.writer.get_extra_info("socket")
+        fd = os.dup(sock.fileno())
+        # StreamReader has no public way to take buffered data without
+        # waiting.
+        data = bytes(self.reader._buffer)
+        self._do_close()
+        return fd, data
+
     async def wait_closed(self):
         try:
             await self.writer.wait_closed()
@@ -97,6 +117,8 @@ class ConnectionHeader:
         READER = "reader"
         WRITER = "writer"
 
+    __slots__ = ("type", "game_id", "game_name")
+
     def __init__(self, type_, game_id, game_name):
         self.type = type_
         self.game_id = game_id
@@ -105,12 +127,25 @@ class ConnectionHeader:
     def __str__(self):
         return f"{self.type.value} for {self.game_id} ({self.game_name})"
 
+    def to_bytes(self):
+        "Header as it's sent by the client."
+        prefix = b"P/" if self.type == self.Type.WRITER else b"G/"
+        return prefix + f"{self.game_id}/{self.game_name}\0".encode()
+
     @classmethod
     async def read(cls, connection, timeout):
+        # Same as wait_for, but without an extra task for each of the many
+        # connections waiting for their header.
+        timer = timer_wheel().call_later(timeout,
+                                         asyncio.current_task().cancel)
         try:
-            return await asyncio.wait_for(cls._do_read(connection), timeout)
-        except asyncio.TimeoutError:
+            return await cls._do_read(connection)
+        except asyncio.CancelledError:
+            if not timer.fired:
+                raise
             raise MalformedDataError("Timed out while reading header")
+        finally:
+            timer.cancel()
 
     @classmethod
     async def _do_read(cls, connection):
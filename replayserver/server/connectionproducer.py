@@ -1,7 +1,76 @@
 import asyncio
+import sys
 
+from replayserver import metrics
 from replayserver.server.connection import Connection
 from replayserver.logging import logger
+from replayserver.timers import timer_wheel
+
+
+class ParkedConnection:
+    """
+    Protocol for a connection that didn't send us anything yet, like FA
+    lobbies. Holds just the transport and a deadline. Once data arrives, we
+    swap in a stream protocol and hand a full connection to the producer.
+
+    Not derived from asyncio.Protocol, as that would give us a __dict__.
+    """
+    __slots__ = ("_producer", "_transport", "_timer")
+
+    def __init__(self, producer):
+        self._producer = producer
+        self._transport = None
+        self._timer = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._producer._accepted(transport)
+        self._timer = timer_wheel().call_later(self._producer._park_timeout,
+                                               transport.close)
+        self._producer._park(self)
+
+    def data_received(self, data):
+        transport = self._unpark()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport.set_protocol(protocol)
+        protocol.connection_made(transport)
+        protocol.data_received(data)
+        writer = asyncio.StreamWriter(transport, protocol, reader,
+                                      asyncio.get_event_loop())
+        asyncio.ensure_future(self._producer._serve(reader, writer))
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def eof_received(self):
+        # Lobby ended without a game, nothing to serve. Let transport close.
+        return False
+
+    def connection_lost(self, exc):
+        if self._transport is not None:
+            self._unpark()
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def _unpark(self):
+        transport = self._transport
+        self._transport = None
+        self._timer.cancel()
+        self._producer._unpark(self)
+        return transport
+
+    def footprint(self):
+        "Rough estimate of bytes held for this connection."
+        objects = [self, self._timer, self._transport,
+                   getattr(self._transport, "__dict__", None),
+                   self._transport.get_extra_info("socket")]
+        return sum(sys.getsizeof(o) for o in objects if o is not None)
 
 
 class ConnectionProducer:
@@ -11,22 +80,53 @@ class ConnectionProducer:
     Hence, no DI.
     """
 
-    def __init__(self, callback, server_port, connection_linger_time):
+    def __init__(self, callback, server_port, connection_linger_time,
+                 park_timeout=None, accept_options=None):
         self._server = None
         self._server_port = server_port
         self._callback = callback
         self._conn_linger_time = connection_linger_time
+        self._park_timeout = park_timeout
+        self._parked = set()
+        self._accept_options = accept_options
 
     @classmethod
-    def build(cls, callback, server_port, connection_linger_time):
-        return cls(callback, server_port, connection_linger_time)
+    def build(cls, callback, server_port, connection_linger_time,
+              park_timeout=None, accept_options=None):
+        return cls(callback, server_port, connection_linger_time,
+                   park_timeout, accept_options)
 
     async def start(self):
-        self._server = await asyncio.streams.start_server(
-            self._make_connection, port=self._server_port)
+        if self._park_timeout is None:
+            self._server = await asyncio.streams.start_server(
+                self._make_connection, port=self._server_port)
+        else:
+            loop = asyncio.get_event_loop()
+            self._server = await loop.create_server(
+                lambda: ParkedConnection(self), port=self._server_port)
         logger.info(f"Started listening on {self._server_port}")
 
+    def parked_count(self):
+        return len(self._parked)
+
+    def _park(self, parked):
+        self._parked.add(parked)
+        metrics.parked_conns.inc()
+        metrics.parked_connection_bytes.set(parked.footprint())
+
+    def _unpark(self, parked):
+        self._parked.discard(parked)
+        metrics.parked_conns.dec()
+
+    def _accepted(self, transport):
+        if self._accept_options:
+            self._accept_options.apply(transport.get_extra_info("socket"))
+
     async def _make_connection(self, reader, writer):
+        self._accepted(writer.transport)
+        await self._serve(reader, writer)
+
+    async def _serve(self, reader, writer):
         # By default asyncio streams keep around a fairly large write buffer -
         # something around 64kb. We already perform our own buffering and flow
         # control (via 5 minute replay delay and sending data after regular
@@ -41,5 +141,7 @@ class ConnectionProducer:
 
     async def stop(self):
         self._server.close()
+        for parked in list(self._parked):
+            parked.close()
         await self._server.wait_closed()
         logger.info(f"Stopped listening on {self._server_port}")
@@ -8,15 +8,17 @@ from replayserver.logging import logger, short_exc
 
 
 class Connections:
-    def __init__(self, header_read, replays):
+    def __init__(self, header_read, replays, socket_options=None):
         self._replays = replays
         self._header_read = header_read
         self._connections = AsyncSet()
+        # Socket options for each connection type
+        self._socket_options = socket_options or {}
 
     @classmethod
-    def build(cls, replays, header_read_timeout):
+    def build(cls, replays, header_read_timeout, socket_options=None):
         return cls(lambda c: ConnectionHeader.read(c, header_read_timeout),
-                   replays)
+                   replays, socket_options)
 
     async def handle_connection(self, connection):
         conn_gauge = metrics.ConnectionGauge()
@@ -45,6 +47,9 @@ class Connections:
     async def _handle_initial_data(self, connection):
         header = await self._header_read(connection)
         connection.add_header(header)
+        options = self._socket_options.get(header.type)
+        if options:
+            connection.set_socket_options(options)
         logger.debug(f"Accepted new connection: {connection}")
         return header
 
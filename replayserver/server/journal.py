@@ -0,0 +1,186 @@
+"""
+Journaling canonical streams of live replays to disk, so that replays can be
+saved even if the server crashes before they end. Journals are written in
+spool format (see bookkeeping.spool) and, on startup, journals left over by a
+crash are saved as partial replays.
+"""
+import asyncio
+import os
+
+from replayserver import metrics
+from replayserver.bookkeeping.spool import ReplaySpool, encode_replay_header
+from replayserver.bookkeeping.storage import run_in_thread, remove_quietly, \
+    sync_file
+from replayserver.errors import BookkeepingError
+from replayserver.logging import logger, short_exc
+
+
+class ReplayJournal:
+    "Journal of a single replay's canonical stream."
+
+    def __init__(self, journals, game_id, stream, path):
+        self._journals = journals
+        self._game_id = game_id
+        self._stream = stream
+        self.path = path
+        self._header_written = False
+        self._written = 0
+        # Bytes in the journal file we know were written whole.
+        self.size = 0
+        self._taken = 0
+
+    def take_new_data(self):
+        """
+        Returns data added to the stream since the last successful write, or
+        None if there's nothing to write. Call written() once it's written.
+        """
+        if self._stream.header is None:
+            return None
+        chunks = []
+        if not self._header_written:
+            chunks.append(encode_replay_header(self._game_id,
+                                               self._stream.header))
+        self._taken = len(self._stream.data)
+        if self._taken > self._written:
+            chunks.append(self._stream.data[self._written:self._taken])
+        return b"".join(chunks) if chunks else None
+
+    def written(self, size):
+        "Marks data we last took, of given size, as written."
+        self._header_written = True
+        self._written = self._taken
+        self.size += size
+
+    async def close(self):
+        "Stops journaling the replay and removes its journal."
+        await self._journals.forget(self._game_id)
+
+
+class ReplayJournals:
+    """
+    Journals all live replays. New data is gathered from all streams and
+    written at once every flush interval, so that we go to a thread once per
+    interval, not once per replay.
+    """
+
+    def __init__(self, spool, flush_interval):
+        self._spool = spool
+        self._flush_interval = flush_interval
+        self._journals = {}
+        # Keeps us from removing a journal while it's being written to.
+        self._lock = asyncio.Lock()
+        self._flusher = None
+
+    @classmethod
+    def build(cls, config):
+        return cls(ReplaySpool(config.journal_path),
+                   config.journal_flush_interval)
+
+    def track(self, game_id, stream):
+        journal = ReplayJournal(self, game_id, stream,
+                                self._spool.replay_file(game_id))
+        self._journals[game_id] = journal
+        return journal
+
+    async def forget(self, game_id):
+        async with self._lock:
+            journal = self._journals.pop(game_id, None)
+            if journal is not None:
+                await run_in_thread(lambda: remove_quietly(journal.path))
+
+    async def start(self):
+        self._flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def stop(self):
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        await self.flush()
+
+    async def recover(self, bookkeeper):
+        """
+        Saves replays from journals left over by a previous run. Should be
+        called before we track any replays.
+        """
+        try:
+            game_ids = await self._spool.ready()
+        except OSError as e:
+            logger.warning(f"Failed to list replay journals: {short_exc(e)}")
+            return
+        for game_id in game_ids:
+            logger.info(f"Recovering replay {game_id} from journal")
+            try:
+                stream = await self._spool.load(game_id)
+            except (ValueError, KeyError, OSError) as e:
+                logger.warning((f"Failed to recover replay {game_id}: "
+                                f"{short_exc(e)}"))
+                stream = None
+            if stream is not None:
+                saved = False
+                try:
+                    saved = await bookkeeper.save_replay(game_id, stream)
+                except BookkeepingError as e:
+                    logger.warning(f"Failed to save replay {game_id}: {e}")
+                if not saved:
+                    logger.info(f"Keeping journal of replay {game_id}")
+                    continue
+            await run_in_thread(
+                lambda: remove_quietly(self._spool.replay_file(game_id)))
+
+    async def flush(self):
+        async with self._lock:
+            writes = []
+            for journal in self._journals.values():
+                data = journal.take_new_data()
+                if data is not None:
+                    writes.append((journal, journal.path, journal.size,
+                                   data))
+            if not writes:
+                return
+            written = await run_in_thread(lambda: self._write(writes))
+            for journal, data in written:
+                journal.written(len(data))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            # Stopping mustn't leave a write running in a thread behind our
+            # back, the final flush would race with it.
+            await asyncio.shield(self.flush())
+
+    def _write(self, writes):
+        """
+        Appends data to journals and syncs them to disk, returns journals and
+        data that were written. Those that failed are written again on next
+        flush.
+        """
+        written = []
+        created = False
+        with metrics.filesystem_latency("journal"):
+            for journal, path, size, data in writes:
+                try:
+                    with open(path, "ab") as f:
+                        # Drop whatever a failed write left behind.
+                        f.truncate(size)
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    written.append((journal, data))
+                    created = created or size == 0
+                except OSError as e:
+                    logger.warning(
+                        f"Failed to write journal {path}: {short_exc(e)}")
+            if created:
+                # So that new journals survive power loss, too.
+                directory = os.path.dirname(written[0][0].path)
+                try:
+                    sync_file(directory)
+                except OSError as e:
+                    logger.warning((f"Failed to sync journal directory "
+                                    f"{directory}: {short_exc(e)}"))
+        return written
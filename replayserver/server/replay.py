@@ -1,5 +1,6 @@
 import asyncio
 from asyncio.locks import Event
+from collections import namedtuple
 from contextlib import contextmanager
 
 from replayserver import config
@@ -7,7 +8,10 @@ from replayserver.errors import MalformedDataError
 from replayserver.logging import logger
 from replayserver.receive.merger import DelayConfig, Merger, MergerConfig
 from replayserver.send.sender import Sender
+from replayserver.streams import TieredReplayStream
+from replayserver.streams.spill import SpillFile
 from replayserver.server.connection import ConnectionHeader
+from replayserver.timers import timer_wheel
 
 
 class ReplayConfig(config.Config):
@@ -21,6 +25,50 @@ class ReplayConfig(config.Config):
             "doc": ("Time in seconds after which a replay with no writers "
                     "will consider itself over.")
         },
+        "journal_path": {
+            "parser": str,
+            "default": "",
+            "doc": ("Directory to journal merged data of live replays in. "
+                    "If the server crashes, replays in the journal are "
+                    "saved as they were when it's started again. Empty to "
+                    "not journal replays.")
+        },
+        "journal_flush_interval": {
+            "parser": config.positive_float,
+            "default": "1",
+            "doc": ("Time in seconds between writes of new replay data to "
+                    "the journal. Data of all replays is written at once.")
+        },
+        "compress_cold_data": {
+            "parser": config.boolean,
+            "default": "false",
+            "doc": ("Whether to compress merged data of live replays in "
+                    "memory once it's older than cold_data_window and all "
+                    "readers received it. Saves a lot of memory for long "
+                    "games, for a bit of CPU time.")
+        },
+        "cold_data_window": {
+            "parser": config.positive_int,
+            "default": "4194304",
+            "doc": ("Number of most recent bytes of replay data that are "
+                    "never compressed.")
+        },
+        "spill_path": {
+            "parser": str,
+            "default": "",
+            "doc": ("Directory to move data of saved replays to while we "
+                    "still send them to readers, so that we don't keep "
+                    "them in memory. Empty to keep them in memory.")
+        },
+        "writer_memory_budget": {
+            "parser": lambda x: None if x == "" else config.positive_int(x),
+            "default": "",
+            "doc": ("Total number of bytes that buffers of replay writers can "
+                    "use in memory, across all replays. Over budget, buffers "
+                    "that were least recently compared are moved to "
+                    "spill_path (or the system's temporary directory if "
+                    "unset). Empty for no limit.")
+        },
     }
 
     def __init__(self, config):
@@ -29,25 +77,57 @@ class ReplayConfig(config.Config):
         self.delay = DelayConfig(config.with_namespace("delay"))
 
 
+class ReplayMemory(namedtuple("ReplayMemory", ["canonical", "writers"])):
+    "StreamMemory of the canonical stream and a list of it for writers."
+
+    def held(self):
+        return self.canonical.held + sum(w.held for w in self.writers)
+
+
 class Replay:
-    def __init__(self, merger, sender, bookkeeper, config, game_id):
+    # How often we look for replay data to compress.
+    COLD_DATA_INTERVAL = 30
+
+    def __init__(self, merger, sender, bookkeeper, config, game_id,
+                 journal=None, spill_path=None, cold_data_window=None):
         self.merger = merger
         self.sender = sender
         self.bookkeeper = bookkeeper
+        self._journal = journal
+        self._spill_path = spill_path
+        self._spill = None
         self._game_id = game_id
         self._connections = set()
         self._ended = Event()
+        self._force_closing = timer_wheel().call_later(
+            config.forced_end_time, self._force_close)
         self._lifetime_coroutines = [
-            asyncio.ensure_future(self._force_closing(config.forced_end_time)),
             asyncio.ensure_future(self._write_phase(config.grace_period))
         ]
+        if cold_data_window is not None:
+            self._compressing_cold_data = asyncio.ensure_future(
+                self._compress_cold_data(cold_data_window))
+        else:
+            self._compressing_cold_data = None
         asyncio.ensure_future(self._lifetime())
 
     @classmethod
-    def build(cls, game_id, bookkeeper, config):
-        merger = Merger.build(config.merge, config.delay)
+    def build(cls, game_id, bookkeeper, config, journals=None, budget=None):
+        if config.compress_cold_data:
+            canonical_stream = TieredReplayStream()
+            cold_data_window = config.cold_data_window
+        else:
+            canonical_stream = None
+            cold_data_window = None
+        merger = Merger.build(config.merge, config.delay, canonical_stream,
+                              budget)
         sender = Sender.build(merger.canonical_stream)
-        return cls(merger, sender, bookkeeper, config, game_id)
+        if journals is not None:
+            journal = journals.track(game_id, merger.canonical_stream)
+        else:
+            journal = None
+        return cls(merger, sender, bookkeeper, config, game_id, journal,
+                   config.spill_path or None, cold_data_window)
 
     @contextmanager
     def _track_connection(self, connection):
@@ -74,8 +154,7 @@ class Replay:
         for connection in self._connections:
             connection.close()
 
-    async def _force_closing(self, timeout):
-        await asyncio.sleep(timeout)
+    def _force_close(self):
         logger.info(f"Timeout - force-ending {self}")
         self.close()
 
@@ -84,8 +163,21 @@ class Replay:
         self.merger.stop_accepting_connections()
         self.sender.stop_accepting_connections()
 
+    async def _compress_cold_data(self, window):
+        stream = self.merger.canonical_stream
+        while True:
+            await asyncio.sleep(self.COLD_DATA_INTERVAL)
+            until = len(stream.data) - window
+            reader_position = self.sender.lowest_position()
+            if reader_position is not None:
+                until = min(until, reader_position)
+            await stream.compress_cold(until)
+
     async def _lifetime(self):
         await self.merger.wait_for_ended()
+        # Saving needs all data anyway, and we might spill it.
+        if self._compressing_cold_data is not None:
+            self._compressing_cold_data.cancel()
 
         canon_stream = self.merger.canonical_stream
         logger.info((f"{self} write phase ended, "
@@ -93,13 +185,38 @@ class Replay:
 
         await self.bookkeeper.save_replay(self._game_id,
                                           self.merger.canonical_stream)
+        if self._journal is not None:
+            await self._journal.close()
+        if self._spill_path is not None:
+            await self._spill_canonical_stream()
         await self.sender.wait_for_ended()
         self.merger.canonical_stream.discard_all()
+        if self._spill is not None:
+            self._spill.close()
+        self._force_closing.cancel()
         for coro in self._lifetime_coroutines:
             coro.cancel()
         self._ended.set()
         logger.debug(f"Lifetime of {self} ended")
 
+    async def _spill_canonical_stream(self):
+        # Nobody left to send the replay to, no need to spill it.
+        if self.sender.ended():
+            return
+        stream = self.merger.canonical_stream
+        try:
+            self._spill = await SpillFile.create(self._spill_path,
+                                                 stream.data.bytes())
+        except OSError as e:
+            logger.warning(f"{self} - failed to spill replay: {e}")
+            return
+        stream.spill(self._spill)
+        logger.debug(f"{self} - spilled {len(self._spill)} bytes")
+
+    def memory(self):
+        return ReplayMemory(self.merger.canonical_stream.memory(),
+                            self.merger.writer_memory())
+
     async def wait_for_ended(self):
         await self._ended.wait()
 
@@ -15,8 +15,9 @@ class Replays:
         self._closing = False
 
     @classmethod
-    def build(cls, bookkeeper, config):
-        return cls(lambda game_id: Replay.build(game_id, bookkeeper, config))
+    def build(cls, bookkeeper, config, journals=None, budget=None):
+        return cls(lambda game_id: Replay.build(game_id, bookkeeper, config,
+                                                journals, budget))
 
     async def handle_connection(self, header, connection):
         replay = self._get_matching_replay(header)
@@ -62,6 +63,22 @@ class Replays:
             replay.close()
         await self._replays.wait_until_empty()
 
+    def memory_usage(self):
+        "Bytes held in memory by all canonical and writer streams."
+        usage = {"canonical": 0, "writers": 0}
+        for replay in self._replays.values():
+            memory = replay.memory()
+            usage["canonical"] += memory.canonical.held
+            usage["writers"] += sum(w.held for w in memory.writers)
+        return usage
+
+    def top_memory_usage(self, n):
+        "Returns n (game id, ReplayMemory) pairs using the most memory."
+        usage = [(game_id, replay.memory())
+                 for game_id, replay in self._replays.items()]
+        usage.sort(key=lambda u: u[1].held(), reverse=True)
+        return usage[:n]
+
     # Tiny bit of introspection for easier testing
     def __contains__(self, game_id):
         return game_id in self._replays
@@ -1,3 +1,4 @@
+import asyncio
 from asyncio.locks import Event
 import prometheus_client
 import logging
@@ -6,10 +7,16 @@ from enum import Enum
 from replayserver.server.connectionproducer import ConnectionProducer
 from replayserver.bookkeeping.database import Database, DatabaseConfig
 from replayserver.server.connections import Connections
+from replayserver.server.sockopts import SocketConfig, \
+    accept_socket_options, role_socket_options
 from replayserver.server.replays import Replays
 from replayserver.server.replay import ReplayConfig
+from replayserver.server.journal import ReplayJournals
+from replayserver.streams import MemoryBudget
 from replayserver.bookkeeping.bookkeeper import Bookkeeper, BookkeeperConfig
-from replayserver import config
+from replayserver.bookkeeping.spool import SpoolingBookkeeper
+from replayserver import config, metrics
+from replayserver.logging import logger
 
 
 class ServerConfig(config.Config):
@@ -42,9 +49,51 @@ class ServerConfig(config.Config):
             "parser": config.positive_int,
             "doc": ("Time in seconds to keep connection open after sending all "
                     "the data. Needed for FA to properly receive all data.")
+        },
+        "workers": {
+            "parser": config.nonnegative_int,
+            "default": "0",
+            "doc": ("Number of worker processes to spread games across. With "
+                    "0, everything runs in a single process. Otherwise the "
+                    "main process only accepts connections and passes them "
+                    "to workers by game id. To aggregate metrics of workers, "
+                    "set the PROMETHEUS_MULTIPROC_DIR environment variable "
+                    "to an empty directory.")
+        },
+        "connection_keepalive_time": {
+            "parser": lambda x: None if x == "" else config.positive_int(x),
+            "default": "",
+            "doc": ("Idle time in seconds after which we start sending TCP "
+                    "keepalive probes, so that we notice lobby connections "
+                    "that silently went away. Empty to disable keepalive.")
+        },
+        "worker_threads": {
+            "parser": config.boolean,
+            "default": "false",
+            "doc": ("Run workers as threads, each with its own event loop, "
+                    "instead of processes. Experimental, meant for "
+                    "free-threaded Python builds: workers share one address "
+                    "space and metrics registry, but each still has its own "
+                    "database pool and bookkeeper. With the GIL, they scale "
+                    "worse than processes.")
+        },
+        "park_idle_connections": {
+            "parser": config.boolean,
+            "default": "false",
+            "doc": ("Keep connections that didn't send anything yet (like FA "
+                    "lobbies) in a minimal parked state, and set up full "
+                    "connection machinery only once data arrives. Parked "
+                    "connections are dropped after the header read timeout.")
         }
     }
 
+    def __init__(self, config):
+        super().__init__(config)
+        self.reader_socket = SocketConfig(
+            config.with_namespace("reader_socket"))
+        self.writer_socket = SocketConfig(
+            config.with_namespace("writer_socket"))
+
 
 class LogLevel(Enum):
     CRITICAL = logging.CRITICAL
@@ -71,6 +120,13 @@ class MainConfig(config.Config):
             "parser": LogLevel.from_config,
             "doc": ("Server log level. Either name or numeric value "
                     "corresponding to Python's logging module value.")
+        },
+        "uvloop": {
+            "parser": config.boolean,
+            "default": "false",
+            "doc": ("Run on uvloop instead of the default asyncio event loop. "
+                    "Needs uvloop installed; if it isn't, we log a warning "
+                    "and use the default loop.")
         }
     }
 
@@ -83,15 +139,23 @@ class MainConfig(config.Config):
 
 
 class Server:
+    # How often we update stream memory gauges.
+    MEMORY_METRICS_INTERVAL = 15
+    # How many replays log_memory_usage lists.
+    MEMORY_REPORT_SIZE = 10
+
     def __init__(self, connection_producer, database,
                  connections, replays, bookkeeper,
-                 prometheus_port):
+                 prometheus_port, journals=None, serve_metrics=True):
         self._connection_producer = connection_producer
         self._database = database
         self._connections = connections
         self._replays = replays
         self._bookkeper = bookkeeper
         self._prometheus_port = prometheus_port
+        self._serve_metrics = serve_metrics
+        self._journals = journals
+        self._memory_metrics = None
         self._stopped = Event()
         self._stopped.set()
 
@@ -99,22 +163,48 @@ class Server:
     def build(cls, *,
               dep_connection_producer=ConnectionProducer.build,
               dep_database=Database.build,
-              config):
+              config, serve_metrics=True):
         database = dep_database(config.db)
-        bookkeeper = Bookkeeper.build(database, config.storage)
-        replays = Replays.build(bookkeeper, config.replay)
+        if config.storage.worker_spool_path:
+            bookkeeper = SpoolingBookkeeper.build(config.storage)
+        else:
+            bookkeeper = Bookkeeper.build(database, config.storage)
+        if config.replay.journal_path:
+            journals = ReplayJournals.build(config.replay)
+        else:
+            journals = None
+        if config.replay.writer_memory_budget is not None:
+            budget = MemoryBudget.build(config.replay)
+        else:
+            budget = None
+        replays = Replays.build(bookkeeper, config.replay, journals, budget)
         conns = Connections.build(replays,
-                                  config.server.connection_header_read_timeout)
-        producer = dep_connection_producer(conns.handle_connection,
-                                           config.server.port,
-                                           config.server.connection_linger_time)
+                                  config.server.connection_header_read_timeout,
+                                  role_socket_options(config.server))
+        if config.server.park_idle_connections:
+            park_timeout = config.server.connection_header_read_timeout
+        else:
+            park_timeout = None
+        accept_options = accept_socket_options(config.server)
+        producer = dep_connection_producer(
+            conns.handle_connection, config.server.port,
+            config.server.connection_linger_time, park_timeout,
+            accept_options)
         return cls(producer, database, conns, replays, bookkeeper,
-                   config.server.prometheus_port)
+                   config.server.prometheus_port, journals, serve_metrics)
 
     async def start(self):
         if self._prometheus_port is not None:
-            prometheus_client.start_http_server(self._prometheus_port)
+            # Workers of a supervisor leave serving metrics to it.
+            if self._serve_metrics:
+                prometheus_client.start_http_server(self._prometheus_port)
+            self._memory_metrics = asyncio.ensure_future(
+                self._update_memory_metrics())
         await self._database.start()
+        await self._bookkeper.start()
+        if self._journals is not None:
+            await self._journals.recover(self._bookkeper)
+            await self._journals.start()
         await self._connection_producer.start()
         self._stopped.clear()
 
@@ -123,9 +213,43 @@ class Server:
         await self._connections.close_all()
         await self._replays.stop_all()
         await self._connections.wait_until_empty()
+        if self._journals is not None:
+            await self._journals.stop()
+        await self._bookkeper.stop()
         await self._database.stop()
+        if self._memory_metrics is not None:
+            self._memory_metrics.cancel()
+            self._memory_metrics = None
         self._stopped.set()
 
+    async def _update_memory_metrics(self):
+        # Several servers can run in one process (see server.sharding), so
+        # adjust gauges by what we reported before instead of setting them.
+        reported = {}
+        try:
+            while True:
+                for kind, held in self._replays.memory_usage().items():
+                    metrics.stream_memory_bytes.labels(kind=kind).inc(
+                        held - reported.get(kind, 0))
+                    reported[kind] = held
+                await asyncio.sleep(self.MEMORY_METRICS_INTERVAL)
+        finally:
+            for kind, held in reported.items():
+                metrics.stream_memory_bytes.labels(kind=kind).dec(held)
+
+    def log_memory_usage(self):
+        "Logs replays that hold the most stream data in memory."
+        top = self._replays.top_memory_usage(self.MEMORY_REPORT_SIZE)
+        lines = [f"Top {len(top)} replays by memory usage:"]
+        for game_id, memory in top:
+            writers = ", ".join(str(w.held) for w in memory.writers)
+            lines.append(
+                f"Game {game_id}: {memory.held()} bytes held, canonical "
+                f"{memory.canonical.held} (peak {memory.canonical.peak}, "
+                f"discarded {memory.canonical.discarded}), "
+                f"writers [{writers}]")
+        logger.info("\n".join(lines))
+
     async def run(self):
         await self.start()
         await self._stopped.wait()
@@ -0,0 +1,555 @@
+"""
+Running the server as a supervisor and several worker processes. The
+supervisor accepts connections and reads their headers, then passes each
+socket (via SCM_RIGHTS) to the worker chosen by game id. This way all
+connections of a game end up in the same worker's Replays, and each worker is
+a regular Server that gets connections from its supervisor instead of a
+listening socket.
+
+Workers can also be threads, each running its own event loop. This is an
+experiment for free-threaded Python builds: each thread still builds its own
+database pool and bookkeeper, since those are tied to their event loop, so
+the only thing threads share is the address space. Threads only talk to each
+other through call_soon_threadsafe, and don't rely on the GIL otherwise, so
+they can run in parallel on such builds. With the GIL, they scale worse than
+processes.
+"""
+
+import array
+import asyncio
+import copy
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+from replayserver import metrics
+from replayserver.collections import AsyncSet
+from replayserver.bookkeeping.spool import ReplaySpool
+from replayserver.errors import BadConnectionError, EmptyConnectionError, \
+    CannotAcceptConnectionError, WorkerExitedError
+from replayserver.logging import logger, short_exc
+from replayserver.server.connection import ConnectionHeader
+from replayserver.server.connectionproducer import ConnectionProducer
+from replayserver.server.sockopts import accept_socket_options
+
+
+# Header plus whatever a StreamReader could have buffered past it.
+MAX_HANDOFF_SIZE = 256 * 1024
+_FD_SIZE = array.array("i").itemsize
+
+
+def _multiprocess_metrics_dir():
+    return (os.environ.get("PROMETHEUS_MULTIPROC_DIR") or
+            os.environ.get("prometheus_multiproc_dir"))
+
+
+def _gil_enabled():
+    check = getattr(sys, "_is_gil_enabled", None)
+    return check is None or check()
+
+
+class HandoffConnectionProducer(ConnectionProducer):
+    """
+    Produces connections from sockets handed to us by the supervisor, instead
+    of accepting them from a listening socket.
+    """
+
+    def __init__(self, callback, connection_linger_time):
+        ConnectionProducer.__init__(self, callback, None,
+                                    connection_linger_time)
+
+    @classmethod
+    def build(cls, callback, server_port, connection_linger_time,
+              park_timeout=None, accept_options=None):
+        return cls(callback, connection_linger_time)
+
+    async def start(self):
+        logger.info("Started receiving connections from supervisor")
+
+    def adopt(self, fd, data):
+        """
+        Makes a connection out of a socket's file descriptor and data read
+        from it before the handoff.
+        """
+        asyncio.ensure_future(self._adopt(fd, data))
+
+    async def _adopt(self, fd, data):
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(fileno=fd)
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        transport, protocol = await loop.connect_accepted_socket(
+            lambda: asyncio.StreamReaderProtocol(reader), sock)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        await self._serve(reader, writer)
+
+    async def stop(self):
+        logger.info("Stopped receiving connections from supervisor")
+
+
+class ShardConnectionProducer(HandoffConnectionProducer):
+    "Receives sockets from the supervisor process over a channel."
+
+    def __init__(self, callback, channel, connection_linger_time):
+        HandoffConnectionProducer.__init__(self, callback,
+                                           connection_linger_time)
+        self._channel = channel
+
+    @classmethod
+    def builder(cls, channel):
+        "Builder with the same signature as ConnectionProducer.build."
+        def build(callback, server_port, connection_linger_time,
+                  park_timeout=None, accept_options=None):
+            return cls(callback, channel, connection_linger_time)
+        return build
+
+    async def start(self):
+        self._channel.setblocking(False)
+        asyncio.get_event_loop().add_reader(self._channel.fileno(),
+                                            self._receive)
+        await HandoffConnectionProducer.start(self)
+
+    def _receive(self):
+        while True:
+            try:
+                data, ancdata, _, _ = self._channel.recvmsg(
+                    MAX_HANDOFF_SIZE, socket.CMSG_SPACE(_FD_SIZE))
+            except BlockingIOError:
+                return
+            if not data and not ancdata:
+                logger.warning("Supervisor closed its channel")
+                self._stop_receiving()
+                return
+            for level, type_, fds in ancdata:
+                if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                    for fd in array.array("i", fds):
+                        self.adopt(fd, data)
+
+    def _stop_receiving(self):
+        if self._channel.fileno() != -1:
+            asyncio.get_event_loop().remove_reader(self._channel.fileno())
+
+    async def stop(self):
+        self._stop_receiving()
+        await HandoffConnectionProducer.stop(self)
+
+
+class Shard:
+    "Worker process, together with the channel we pass its sockets through."
+    SEPARATE_PROCESS = True
+
+    def __init__(self, index, channel, worker_channel):
+        self.index = index
+        self._channel = channel
+        self._worker_channel = worker_channel
+        self._process = None
+
+    @classmethod
+    def build(cls, index):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        return cls(index, channel, worker_channel)
+
+    def spawn(self, build_worker, config, shards):
+        context = multiprocessing.get_context("fork")
+        self._process = context.Process(
+            target=self._run, args=(build_worker, config, shards),
+            name=f"replayserver-shard-{self.index}")
+        self._process.start()
+        self._worker_channel.close()
+
+    def _run(self, build_worker, config, shards):
+        # Only keep our end of our own channel.
+        for shard in shards:
+            shard._channel.close()
+            if shard is not self:
+                shard._worker_channel.close()
+        # Supervisor tells us when to stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            server = build_worker(
+                config, ShardConnectionProducer.builder(self._worker_channel))
+
+            def stop():
+                loop.remove_signal_handler(signal.SIGTERM)
+                asyncio.ensure_future(server.stop())
+
+            loop.add_signal_handler(signal.SIGTERM, stop)
+            loop.add_signal_handler(signal.SIGUSR1, server.log_memory_usage)
+            loop.run_until_complete(server.run())
+        except Exception:
+            logger.exception("Critical worker error!")
+            raise
+        finally:
+            loop.close()
+
+    async def hand_off(self, fd, data):
+        message = [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                            array.array("i", [fd]))]
+        while True:
+            try:
+                self._channel.sendmsg(*message)
+                return
+            except BlockingIOError:
+                await self._wait_writable()
+            except ConnectionError:
+                raise CannotAcceptConnectionError(
+                    f"Worker {self.index} is not running")
+
+    async def _wait_writable(self):
+        loop = asyncio.get_event_loop()
+        writable = loop.create_future()
+        loop.add_writer(self._channel.fileno(), writable.set_result, None)
+        try:
+            await writable
+        finally:
+            loop.remove_writer(self._channel.fileno())
+
+    def watch(self, on_exit):
+        "Calls on_exit(shard) when the worker process exits."
+        self._channel.setblocking(False)
+        loop = asyncio.get_event_loop()
+        loop.add_reader(self._process.sentinel, on_exit, self)
+
+    def unwatch(self):
+        asyncio.get_event_loop().remove_reader(self._process.sentinel)
+
+    def stop(self):
+        self._signal(signal.SIGTERM)
+
+    def log_memory_usage(self):
+        self._signal(signal.SIGUSR1)
+
+    def _signal(self, sig):
+        if self._process.is_alive():
+            os.kill(self._process.pid, sig)
+
+    async def wait_exited(self):
+        await asyncio.get_event_loop().run_in_executor(None,
+                                                       self._process.join)
+        if _multiprocess_metrics_dir():
+            multiprocess.mark_process_dead(self._process.pid)
+
+    def exitcode(self):
+        return self._process.exitcode
+
+    def close(self):
+        self._channel.close()
+
+
+class ThreadShard:
+    """
+    Worker thread with its own event loop. Has the same interface as Shard;
+    sockets are passed to it by file descriptor. Only useful on free-threaded
+    Python builds, see module docstring.
+    """
+    SEPARATE_PROCESS = False
+
+    def __init__(self, index):
+        self.index = index
+        self._thread = None
+        self._loop = None
+        self._server = None
+        self._producer = None
+        self._failed = False
+        self._watcher = None
+
+    @classmethod
+    def build(cls, index):
+        return cls(index)
+
+    def spawn(self, build_worker, config, shards):
+        # Workers adjust their config, so give each one a copy.
+        config = copy.copy(config)
+        config.replay = copy.copy(config.replay)
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(build_worker, config, started),
+            name=f"replayserver-shard-{self.index}")
+        self._thread.start()
+        started.wait()
+
+    def _make_producer(self, *args):
+        self._producer = HandoffConnectionProducer.build(*args)
+        return self._producer
+
+    def _run(self, build_worker, config, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            try:
+                self._server = build_worker(config, self._make_producer)
+            finally:
+                started.set()
+            self._loop.run_until_complete(self._server.run())
+        except Exception:
+            logger.exception("Critical worker error!")
+            self._failed = True
+        finally:
+            self._loop.close()
+            watcher = self._watcher
+            if watcher is not None:
+                watcher[0].call_soon_threadsafe(watcher[1], self)
+
+    def _call(self, fn, *args):
+        try:
+            self._loop.call_soon_threadsafe(fn, *args)
+            return True
+        except (RuntimeError, AttributeError):
+            # Loop is closed, or it never existed.
+            return False
+
+    async def hand_off(self, fd, data):
+        fd = os.dup(fd)
+        if not self._call(self._producer.adopt, fd, data):
+            os.close(fd)
+            raise CannotAcceptConnectionError(
+                f"Worker {self.index} is not running")
+
+    def watch(self, on_exit):
+        "Calls on_exit(shard) when the worker thread exits."
+        self._watcher = asyncio.get_event_loop(), on_exit
+        if not self._thread.is_alive():
+            on_exit(self)
+
+    def unwatch(self):
+        self._watcher = None
+
+    def stop(self):
+        if self._server is not None:
+            self._call(self._stop_server)
+
+    def _stop_server(self):
+        asyncio.ensure_future(self._server.stop())
+
+    def log_memory_usage(self):
+        if self._server is not None:
+            self._call(self._server.log_memory_usage)
+
+    async def wait_exited(self):
+        await asyncio.get_event_loop().run_in_executor(None,
+                                                       self._thread.join)
+
+    def exitcode(self):
+        return 1 if self._failed else 0
+
+    def close(self):
+        pass
+
+
+def shard_config(config, index, shards):
+    """
+    Adjusts worker config so that workers don't step on each other's toes:
+    each one gets its own journal directory and share of the memory budget.
+    """
+    if config.replay.journal_path:
+        path = os.path.join(config.replay.journal_path, f"shard{index}")
+        os.makedirs(path, exist_ok=True)
+        config.replay.journal_path = path
+    if config.replay.writer_memory_budget is not None:
+        config.replay.writer_memory_budget = max(
+            1, config.replay.writer_memory_budget // shards)
+
+
+def redistribute_journals(journal_path, shards):
+    """
+    Moves replay journals left by a previous run into the directory of the
+    shard that now owns their game, so that they're recovered even if the
+    number of workers changed. Blocking.
+    """
+    names = [name for name in os.listdir(journal_path)
+             if name.startswith("shard") and
+             os.path.isdir(os.path.join(journal_path, name))]
+    for name in names:
+        directory = os.path.join(journal_path, name)
+        for replay in os.listdir(directory):
+            if not replay.endswith(ReplaySpool.SUFFIX):
+                continue
+            try:
+                game_id = int(replay[:-len(ReplaySpool.SUFFIX)])
+            except ValueError:
+                continue
+            target = os.path.join(journal_path, f"shard{game_id % shards}")
+            if target == directory:
+                continue
+            os.makedirs(target, exist_ok=True)
+            os.replace(os.path.join(directory, replay),
+                       os.path.join(target, replay))
+            logger.info(f"Moved journal of replay {game_id} to {target}")
+
+
+class ShardAcceptor:
+    """
+    Reads headers of incoming connections and hands them off to shards. Only
+    the header is read here; the worker reads it again, together with all
+    data after it.
+    """
+
+    def __init__(self, header_read, shards):
+        self._header_read = header_read
+        self._shards = shards
+        self._connections = AsyncSet()
+
+    @classmethod
+    def build(cls, shards, header_read_timeout):
+        return cls(lambda c: ConnectionHeader.read(c, header_read_timeout),
+                   shards)
+
+    def shard_for(self, game_id):
+        return self._shards[game_id % len(self._shards)]
+
+    async def handle_connection(self, connection):
+        self._connections.add(connection)
+        try:
+            header = await self._header_read(connection)
+            fd, data = connection.detach()
+            try:
+                await self.shard_for(header.game_id).hand_off(
+                    fd, header.to_bytes() + data)
+            finally:
+                os.close(fd)
+        except EmptyConnectionError:
+            pass
+        except BadConnectionError as e:
+            if not connection.closed_by_us():
+                logger.info((f"Connection was dropped: {connection}\n"
+                             f"Reason: {short_exc(e)}"))
+                metrics.failed_conns(e).inc()
+        finally:
+            connection.close(immediate=True)
+            await connection.wait_closed()
+            self._connections.remove(connection)
+
+    async def close_all(self):
+        for c in self._connections:
+            c.close(immediate=True)
+        await self._connections.wait_until_empty()
+
+
+class Supervisor:
+    """
+    Accepts connections and spreads them across workers by game id. Has the
+    same run / stop interface as Server. If a worker dies, the supervisor
+    stops the others and run raises, so that the server can be restarted and
+    recover journaled replays.
+    """
+
+    def __init__(self, connection_producer, acceptor, shards,
+                 prometheus_port):
+        self._connection_producer = connection_producer
+        self._acceptor = acceptor
+        self._shards = shards
+        self._prometheus_port = prometheus_port
+        self._stopping = False
+        self._dead_shard = None
+        self._stopped = asyncio.locks.Event()
+        self._stopped.set()
+
+    @classmethod
+    def build(cls, *,
+              dep_connection_producer=ConnectionProducer.build,
+              config):
+        if config.server.worker_threads:
+            shard_cls = ThreadShard
+            if _gil_enabled():
+                logger.warning(("Worker threads share the GIL on this Python "
+                                "build, so they won't run in parallel"))
+        else:
+            shard_cls = Shard
+        shards = [shard_cls.build(i) for i in range(config.server.workers)]
+        acceptor = ShardAcceptor.build(
+            shards, config.server.connection_header_read_timeout)
+        if config.server.park_idle_connections:
+            park_timeout = config.server.connection_header_read_timeout
+        else:
+            park_timeout = None
+        producer = dep_connection_producer(
+            acceptor.handle_connection, config.server.port,
+            config.server.connection_linger_time, park_timeout,
+            accept_socket_options(config.server))
+        return cls(producer, acceptor, shards, config.server.prometheus_port)
+
+    def spawn_workers(self, build_worker, config):
+        """
+        Starts workers, each running a server built with
+        build_worker(config, dep_connection_producer), with config adjusted
+        by shard_config. Call this before starting the event loop.
+        """
+        if config.replay.journal_path:
+            redistribute_journals(config.replay.journal_path,
+                                  len(self._shards))
+        for shard in self._shards:
+            shard.spawn(self._shard_builder(build_worker, shard.index),
+                        config, self._shards)
+
+    def _shard_builder(self, build_worker, index):
+        shards = len(self._shards)
+
+        def build(config, dep_connection_producer):
+            shard_config(config, index, shards)
+            return build_worker(config, dep_connection_producer)
+        return build
+
+    async def start(self):
+        self._stopped.clear()
+        if self._prometheus_port is not None:
+            self._start_metrics_server()
+        for shard in self._shards:
+            shard.watch(self._shard_exited)
+        await self._connection_producer.start()
+
+    def _start_metrics_server(self):
+        # Worker threads share our registry, processes need help.
+        registry = prometheus_client.REGISTRY
+        if any(shard.SEPARATE_PROCESS for shard in self._shards):
+            if _multiprocess_metrics_dir():
+                registry = prometheus_client.CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry)
+            else:
+                logger.warning(("PROMETHEUS_MULTIPROC_DIR is not set, "
+                                "metrics of workers won't be collected"))
+        prometheus_client.start_http_server(self._prometheus_port,
+                                            registry=registry)
+
+    def _shard_exited(self, shard):
+        shard.unwatch()
+        if self._stopping:
+            return
+        logger.error((f"Worker {shard.index} exited unexpectedly with code "
+                      f"{shard.exitcode()}, stopping the server"))
+        self._dead_shard = shard
+        asyncio.ensure_future(self.stop())
+
+    async def stop(self):
+        if self._stopping:
+            await self._stopped.wait()
+            return
+        self._stopping = True
+        await self._connection_producer.stop()
+        await self._acceptor.close_all()
+        for shard in self._shards:
+            shard.stop()
+        for shard in self._shards:
+            await shard.wait_exited()
+            shard.close()
+        self._stopped.set()
+
+    def log_memory_usage(self):
+        "Asks workers to log replays that hold the most memory."
+        for shard in self._shards:
+            shard.log_memory_usage()
+
+    async def run(self):
+        await self.start()
+        await self._stopped.wait()
+        if self._dead_shard is not None:
+            raise WorkerExitedError(
+                f"Worker {self._dead_shard.index} exited unexpectedly")
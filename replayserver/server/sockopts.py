@@ -0,0 +1,124 @@
+"""
+Socket-level tuning of connections. Lobby sockets get keepalive as soon as we
+accept them, since they can sit idle for hours; other options depend on
+whether a connection turns out to be a reader or a writer, so we set them once
+we read its header.
+"""
+
+import socket
+
+from replayserver import config
+from replayserver.logging import logger, short_exc
+from replayserver.server.connection import ConnectionHeader
+
+
+def _optional(parser):
+    def parse(v):
+        if v in ["", "None"]:
+            return None
+        return parser(v)
+    return parse
+
+
+class SocketConfig(config.Config):
+    _options = {
+        "tcp_nodelay": {
+            "parser": _optional(config.boolean),
+            "default": "",
+            "doc": ("Whether to disable Nagle's algorithm. Empty to keep the "
+                    "system default.")
+        },
+        "send_buffer": {
+            "parser": _optional(config.positive_int),
+            "default": "",
+            "doc": ("Kernel send buffer size (SO_SNDBUF) in bytes. Empty to "
+                    "keep the system default.")
+        },
+        "receive_buffer": {
+            "parser": _optional(config.positive_int),
+            "default": "",
+            "doc": ("Kernel receive buffer size (SO_RCVBUF) in bytes. Empty "
+                    "to keep the system default.")
+        },
+        "notsent_lowat": {
+            "parser": _optional(config.positive_int),
+            "default": "",
+            "doc": ("Most bytes of unsent data the kernel accepts from us "
+                    "(TCP_NOTSENT_LOWAT). Keeps replay data from piling up "
+                    "in the kernel when the client can't keep up, like we do "
+                    "with our own write buffers. Empty to keep the system "
+                    "default.")
+        },
+    }
+
+
+class SocketOptions:
+    """
+    A set of socket options to apply to connections. Options unsupported by
+    the platform are skipped.
+    """
+    # Probes for keepalive, once the connection was idle for keepalive time.
+    KEEPALIVE_INTERVAL = 60
+    KEEPALIVE_PROBES = 5
+
+    __slots__ = ("_options",)
+
+    def __init__(self, *, tcp_nodelay=None, send_buffer=None,
+                 receive_buffer=None, notsent_lowat=None,
+                 keepalive_time=None):
+        options = []
+
+        def add(level, name, value):
+            if value is not None and hasattr(socket, name):
+                options.append((name, level, getattr(socket, name),
+                                int(value)))
+
+        tcp = socket.IPPROTO_TCP
+        add(tcp, "TCP_NODELAY", tcp_nodelay)
+        add(socket.SOL_SOCKET, "SO_SNDBUF", send_buffer)
+        add(socket.SOL_SOCKET, "SO_RCVBUF", receive_buffer)
+        add(tcp, "TCP_NOTSENT_LOWAT", notsent_lowat)
+        if keepalive_time is not None:
+            add(socket.SOL_SOCKET, "SO_KEEPALIVE", 1)
+            add(tcp, "TCP_KEEPIDLE", keepalive_time)
+            add(tcp, "TCP_KEEPINTVL", self.KEEPALIVE_INTERVAL)
+            add(tcp, "TCP_KEEPCNT", self.KEEPALIVE_PROBES)
+        self._options = tuple(options)
+
+    @classmethod
+    def build(cls, config):
+        return cls(tcp_nodelay=config.tcp_nodelay,
+                   send_buffer=config.send_buffer,
+                   receive_buffer=config.receive_buffer,
+                   notsent_lowat=config.notsent_lowat)
+
+    def __bool__(self):
+        return bool(self._options)
+
+    def apply(self, sock):
+        if sock is None:
+            return
+        for name, level, option, value in self._options:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                # Most likely the connection is already gone, but keep going
+                # in case only this option is refused.
+                logger.debug(f"Failed to set socket option {name}: "
+                             f"{short_exc(e)}")
+
+
+def accept_socket_options(server_config):
+    "Options for sockets we just accepted."
+    return SocketOptions(
+        keepalive_time=server_config.connection_keepalive_time)
+
+
+def role_socket_options(server_config):
+    "Options for each connection type, applied once we read the header."
+    return {
+        ConnectionHeader.Type.READER: SocketOptions.build(
+            server_config.reader_socket),
+        ConnectionHeader.Type.WRITER: SocketOptions.build(
+            server_config.writer_socket),
+    }
@@ -1,6 +1,9 @@
 from replayserver.streams.base import ReplayStream, ConcreteDataMixin, \
-    OutsideSourceReplayStream
+    OutsideSourceReplayStream, StreamMemory
 from replayserver.streams.delayed import DelayedReplayStream
+from replayserver.streams.tiered import TieredReplayStream
+from replayserver.streams.budget import MemoryBudget, SpillableReplayStream
 
 __all__ = ["ReplayStream", "ConcreteDataMixin", "OutsideSourceReplayStream",
-           "DelayedReplayStream"]
+           "DelayedReplayStream", "TieredReplayStream", "MemoryBudget",
+           "SpillableReplayStream", "StreamMemory"]
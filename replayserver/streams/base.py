@@ -2,31 +2,56 @@
 Abstract classes for manipulating data streams as replays.
 """
 
+import asyncio
+import heapq
+import itertools
 from asyncio.locks import Event
+from collections import namedtuple
+
+
+# Bytes of stream data held in memory, discarded so far, and the most ever
+# held at once.
+StreamMemory = namedtuple("StreamMemory", ["held", "discarded", "peak"])
 
 
 class ReplayStreamData:
     """
-    Data buffer wrapper that allows to avoid unnecessary copies.
+    Data buffer wrapper that allows to avoid unnecessary copies. Calls stream
+    methods directly instead of holding bound methods, so it's small.
     """
+    __slots__ = ("_stream",)
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __len__(self):
+        return self._stream._data_length()
+
+    def __getitem__(self, val):
+        return self._stream._data_slice(val)
+
+    def bytes(self):
+        return self._stream._data_bytes()
+
+    def view(self, start=None, end=None):
+        return self._stream._data_view(start, end)
 
-    def __init__(self, length, slice_, bytes_, view):
-        self._length = length
-        self._slice = slice_
-        self._bytes = bytes_
-        self._view = view
+
+class FutureReplayStreamData(ReplayStreamData):
+    "Same as above, for future data."
+    __slots__ = ()
 
     def __len__(self):
-        return self._length()
+        return self._stream._future_data_length()
 
     def __getitem__(self, val):
-        return self._slice(val)
+        return self._stream._future_data_slice(val)
 
     def bytes(self):
-        return self._bytes()
+        return self._stream._future_data_bytes()
 
     def view(self, start=None, end=None):
-        return self._view(start, end)
+        return self._stream._future_data_view(start, end)
 
 
 class ReplayStream:
@@ -53,6 +78,10 @@ class ReplayStream:
     merge strategies), a future_data member is a available that supports the
     same methods as data and should give access to all received data.
 
+    Data can also be read with an async read(start, length) method, which
+    may return less data than asked for. Unlike the methods above, it keeps
+    working for data that was spilled to disk, which is what senders use.
+
     A replay stream can optionally implement a discard() method for dropping
     replay data until some position. This can result in major memory savings,
     but accessing deleted ranges is a programmer error. In particular:
@@ -63,18 +92,21 @@ class ReplayStream:
     * len() is not affected by discarding bytes.
     * You can discard data of any length. If you discard more data than you
       have, extra data won't be added until you reach that length.
+
+    Instead of awaiting, users can add an observer with add_observer(). It
+    gets synchronous on_header(stream), on_data(stream) and on_end(stream)
+    calls as things happen, after they're added.
     """
 
     def __init__(self):
-        self.data = ReplayStreamData(self._data_length, self._data_slice,
-                                     self._data_bytes, self._data_view)
-        self.future_data = ReplayStreamData(self._future_data_length,
-                                            self._future_data_slice,
-                                            self._future_data_bytes,
-                                            self._future_data_view)
+        self.data = ReplayStreamData(self)
+        self.future_data = FutureReplayStreamData(self)
         self._ended = Event()
         self._header_read_or_ended = Event()
-        self._new_data_or_ended = Event()
+        # Heap of (position, tie breaker, future) of wait_for_data callers.
+        self._data_waiters = []
+        self._waiter_number = itertools.count()
+        self._observers = []
 
     @property
     def header(self):
@@ -119,6 +151,10 @@ class ReplayStream:
     def _future_data_view(self, start, end):
         return self._data_view(start, end)
 
+    async def read(self, start, length):
+        "Returns up to length bytes of data from start."
+        return self.data[start:start + length]
+
     def discard(self, until):
         """
         Discards stream data until position.
@@ -131,31 +167,54 @@ class ReplayStream:
     def _header_available(self):
         "Called by implementation once header is available."
         self._header_read_or_ended.set()
+        for observer in self._observers:
+            observer.on_header(self)
 
     def _data_available(self):
         "Called by implementation when more data is available."
-        self._new_data_or_ended.set()
-        self._new_data_or_ended.clear()
+        length = len(self.data)
+        waiters = self._data_waiters
+        while waiters and waiters[0][0] <= length:
+            _, _, future = heapq.heappop(waiters)
+            if not future.done():
+                future.set_result(None)
+        for observer in self._observers:
+            observer.on_data(self)
 
     def _end(self):
         "Called by implementation when the replay is over."
+        if self._ended.is_set():
+            return
         self._ended.set()
         self._header_read_or_ended.set()
-        self._new_data_or_ended.set()
+        for _, _, future in self._data_waiters:
+            if not future.done():
+                future.set_result(None)
+        self._data_waiters.clear()
+        for observer in self._observers:
+            observer.on_end(self)
 
     # Public-facing part of interface starts here.
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
     async def wait_for_header(self):
         await self._header_read_or_ended.wait()
         return self.header
 
-    async def wait_for_data(self, position):
+    async def wait_for_data(self, position, min_bytes=1):
         """
-        Wait until there is data after specified position. Return the number of
-        bytes available, or 0 if the stream ended and there is no data past
-        position.
+        Wait until there are at least min_bytes of data after specified
+        position, or the stream ended. Return the number of bytes available,
+        or 0 if the stream ended and there is no data past position. Only
+        waiters whose position was reached are woken up.
         """
-        while position >= len(self.data) and not self.ended():
-            await self._new_data_or_ended.wait()
+        until = position + min_bytes
+        if len(self.data) < until and not self.ended():
+            future = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._data_waiters,
+                           (until, next(self._waiter_number), future))
+            await future
         if position < len(self.data):
             return len(self.data) - position
         else:
@@ -178,6 +237,8 @@ class ConcreteDataMixin:
         self._data = bytearray()
         self._discarded_data = 0
         self._len = 0
+        self._spill = None
+        self._peak_held = 0
 
     def _add_data(self, data):
         if self._discarded_data <= self._len:
@@ -185,6 +246,15 @@ class ConcreteDataMixin:
         else:
             self._data += data[self._discarded_data - self._len:]
         self._len += len(data)
+        self._peak_held = max(self._peak_held, self._held())
+
+    def _held(self):
+        "Bytes of data held in memory."
+        return len(self._data)
+
+    def memory(self):
+        return StreamMemory(self._held(), self._discarded_data,
+                            self._peak_held)
 
     @property
     def header(self):
@@ -224,6 +294,23 @@ class ConcreteDataMixin:
         del self._data[:diff]
         self._discarded_data = until
 
+    def spill(self, spill_file):
+        """
+        Frees stream data, reading it from spill_file (see SpillFile) from
+        now on. Spilled data can only be accessed with read() - to other
+        methods it looks discarded. Stream has to have ended, and the caller
+        is responsible for closing the file.
+        """
+        assert self.ended() and len(spill_file) == self._len
+        self._spill = spill_file
+        self.discard(self._len)
+        self._data = bytearray()
+
+    async def read(self, start, length):
+        if self._spill is not None:
+            return await self._spill.read(start, length)
+        return self._data_slice(slice(start, start + length))
+
     def _data_view(self, start, end):
         if start is None:
             if self._discarded_data > 0:
@@ -253,5 +340,14 @@ class OutsideSourceReplayStream(ConcreteDataMixin, ReplayStream):
         self._add_data(data)
         self._data_available()
 
+    def feed_from(self, stream, start, end):
+        """
+        Appends data of another stream from start to end. Data goes straight
+        from the other stream's buffer to ours, without intermediate copies.
+        """
+        with stream.data.view(start, end) as view:
+            self._add_data(view)
+        self._data_available()
+
     def finish(self):
         self._end()
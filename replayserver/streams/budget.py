@@ -0,0 +1,255 @@
+import asyncio
+import weakref
+from collections import OrderedDict
+
+from replayserver.logging import logger
+from replayserver.streams.base import ConcreteDataMixin, \
+    OutsideSourceReplayStream
+from replayserver.streams.spill import MappedSpill
+
+
+class MemoryBudget:
+    """
+    Accounts for memory used by buffers of all writer streams in the process.
+    When they use more than the budget, buffers of streams whose data was
+    least recently accessed (i.e. compared by the merge strategy) are
+    spilled to disk until we're within budget again. Spilled streams move
+    back to memory once the budget is at most UNSPILL_PRESSURE full with them,
+    so that they don't go back and forth.
+    """
+    UNSPILL_PRESSURE = 0.5
+
+    def __init__(self, limit, spill_path):
+        self._limit = limit
+        self._spill_path = spill_path
+        self._total = 0
+        # Stream id -> (weakref to stream, its resident size), in order of
+        # last access.
+        self._streams = OrderedDict()
+        self._spilling = None
+
+    @classmethod
+    def build(cls, config):
+        return cls(config.writer_memory_budget, config.spill_path or None)
+
+    @property
+    def total(self):
+        return self._total
+
+    def pressure(self):
+        "How full the budget is, from 0 to 1."
+        return min(1, self._total / self._limit)
+
+    def has_room(self, size):
+        "Whether size more bytes can be taken back into memory."
+        return self._total + size <= self._limit * self.UNSPILL_PRESSURE
+
+    def register(self, stream):
+        key = id(stream)
+        self._streams[key] = (weakref.ref(stream), 0)
+        weakref.finalize(stream, self._forget, key)
+
+    def touched(self, stream):
+        self._streams.move_to_end(id(stream))
+
+    def resize(self, stream, size):
+        key = id(stream)
+        ref, old_size = self._streams[key]
+        self._streams[key] = (ref, size)
+        self._total += size - old_size
+        if self._total > self._limit and self._spilling is None:
+            self._spilling = asyncio.ensure_future(self._spill())
+
+    def _forget(self, key):
+        _, size = self._streams.pop(key)
+        self._total -= size
+
+    async def _spill(self):
+        try:
+            while self._total > self._limit:
+                stream = self._least_recently_used()
+                if stream is None:
+                    return
+                if not await stream.spill(self._spill_path):
+                    return
+        finally:
+            self._spilling = None
+
+    def _least_recently_used(self):
+        for ref, size in self._streams.values():
+            stream = ref()
+            if stream is not None and size > 0 and stream.can_spill():
+                return stream
+        return None
+
+
+class SpillableReplayStream(OutsideSourceReplayStream):
+    """
+    Outside source stream accounted for in a MemoryBudget, whose buffer can
+    be spilled to disk (see MappedSpill). Data that arrives while the spill
+    has no room stays in memory until it grows. Spilled data is freed as it's
+    discarded, and the stream moves back to memory once the budget has room
+    for it again.
+    """
+
+    def __init__(self, budget):
+        OutsideSourceReplayStream.__init__(self)
+        self._budget = budget
+        # When spilled, _data holds what comes after the spill's end.
+        self._mapped = None
+        self._close_mapped = None
+        self._spilling = False
+        self._growing = None
+        budget.register(self)
+
+    def can_spill(self):
+        return self._mapped is None and not self._spilling
+
+    async def spill(self, directory):
+        """
+        Moves buffered data to disk in directory. Returns False if that
+        failed.
+        """
+        if not self.can_spill():
+            return True
+        self._spilling = True
+        start = self._discarded_data
+        # Copy, since the buffer can't be resized while a thread reads it.
+        snapshot = bytes(self._data)
+        try:
+            mapped = await MappedSpill.create(directory, start, snapshot)
+        except OSError as e:
+            logger.warning(f"Failed to spill stream to disk: {e}")
+            return False
+        finally:
+            self._spilling = False
+        self._mapped = mapped
+        self._close_mapped = weakref.finalize(self, mapped.close)
+
+        # Account for what happened while spilling.
+        if self._discarded_data >= mapped.end:
+            self._unspill()
+            return True
+        mapped.discard(self._discarded_data)
+        del self._data[:mapped.end - self._discarded_data]
+        self._spill_tail()
+        return True
+
+    def _spill_tail(self):
+        "Moves data kept in memory to the spill, as much as it has room for."
+        mapped = self._mapped
+        if self._data:
+            del self._data[:mapped.write(self._data)]
+        if mapped.room() < mapped.SEGMENT_SIZE and self._growing is None:
+            self._growing = asyncio.ensure_future(self._grow())
+        self._budget.resize(self, len(self._data))
+
+    async def _grow(self):
+        mapped = self._mapped
+        try:
+            segment = await asyncio.get_event_loop().run_in_executor(
+                None, mapped.new_segment)
+        except OSError as e:
+            logger.warning(f"Failed to grow spilled stream: {e}")
+            segment = None
+        finally:
+            self._growing = None
+
+        if self._mapped is not mapped:
+            if segment is not None:
+                segment.close()
+        elif segment is None:
+            self._unspill()
+        else:
+            mapped.add_segment(segment)
+            self._spill_tail()
+
+    def _unspill(self):
+        "Moves spilled data back to memory."
+        mapped, self._mapped = self._mapped, None
+        if self._discarded_data < mapped.end:
+            data = mapped.read(self._discarded_data, mapped.end)
+            data += self._data
+            self._data = data
+        self._close_mapped.detach()
+        asyncio.get_event_loop().run_in_executor(None, mapped.close)
+        self._peak_held = max(self._peak_held, self._held())
+        self._budget.resize(self, len(self._data))
+
+    def _add_data(self, data):
+        if self._mapped is None:
+            ConcreteDataMixin._add_data(self, data)
+            self._budget.resize(self, len(self._data))
+            return
+        self._len += len(data)
+        if not self._data:
+            data = data[self._mapped.write(data):]
+        self._data += data
+        self._peak_held = max(self._peak_held, self._held())
+        self._spill_tail()
+
+    def discard(self, until):
+        if self._mapped is None:
+            ConcreteDataMixin.discard(self, until)
+            self._budget.resize(self, len(self._data))
+            return
+        if until <= self._discarded_data:
+            return
+        self._discarded_data = until
+        mapped = self._mapped
+        if until >= mapped.end:
+            del self._data[:until - mapped.end]
+            self._unspill()
+            return
+        mapped.discard(until)
+        if self._budget.has_room(mapped.end - until):
+            self._unspill()
+
+    def _read(self, start, end):
+        if start < self._discarded_data:
+            raise IndexError
+        mapped = self._mapped
+        split = min(max(start, mapped.end), end)
+        data = mapped.read(start, split)
+        data += self._data[split - mapped.end:max(split, end) - mapped.end]
+        return data
+
+    def _data_slice(self, s):
+        self._budget.touched(self)
+        if self._mapped is None:
+            return ConcreteDataMixin._data_slice(self, s)
+        if isinstance(s, slice):
+            return self._get_slice(s)
+        if s < 0:
+            s += self._len
+        if not 0 <= s < self._len:
+            raise IndexError
+        return self._read(s, s + 1)[0]
+
+    def _get_slice(self, s):
+        if self._mapped is None:
+            return ConcreteDataMixin._get_slice(self, s)
+        start, end, step = s.indices(self._len)
+        return self._read(start, max(start, end))[::step]
+
+    def _data_bytes(self):
+        self._budget.touched(self)
+        if self._mapped is None:
+            return ConcreteDataMixin._data_bytes(self)
+        return self._read(0, self._len)
+
+    def _data_view(self, start, end):
+        self._budget.touched(self)
+        if self._mapped is None:
+            return ConcreteDataMixin._data_view(self, start, end)
+        mapped = self._mapped
+        start = 0 if start is None else start
+        end = self._len if end is None else min(end, self._len)
+        if start < self._discarded_data:
+            raise IndexError
+        if start >= mapped.end:
+            return memoryview(self._data)[start - mapped.end:
+                                          max(start, end) - mapped.end]
+        if end <= mapped.end:
+            return mapped.view(start, max(start, end))
+        return memoryview(self._read(start, end))
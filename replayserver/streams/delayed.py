@@ -1,46 +1,49 @@
 import asyncio
-from asyncio.locks import Event
 import math
 from collections import deque
 from replayserver.streams.base import ReplayStream
 
 
 class Timestamp:
+    """
+    Stamps stream length every interval, using loop timers rather than a
+    task. On each stamp, tells the listener what the length was delay ago.
+    Once told that the stream ended, gives the listener its final length.
+    """
+    __slots__ = ("_stream", "_interval", "_delay", "_listener", "_handle",
+                 "_stamps")
+
     def __init__(self, stream, interval, delay):
         self._stream = stream
         self._interval = interval
         self._delay = delay
-        self._ended = False
+        self._listener = None
+        self._handle = None
 
         # Last item in deque size n+1 is from n intervals ago
         stamp_number = math.ceil(self._delay / self._interval) + 1
         self._stamps = deque([0], maxlen=stamp_number)
-        self._new_stamp = Event()
-        self._stamp_coro = asyncio.ensure_future(self._periodic_stamp())
-        asyncio.ensure_future(self._wait_for_stream_end())
+
+    def start(self, listener):
+        self._listener = listener
+        self._handle = asyncio.get_event_loop().call_soon(
+            self._periodic_stamp)
 
     def _stamp(self, pos):
         self._stamps.append(pos)
-        self._new_stamp.set()
-        self._new_stamp.clear()
+        self._listener(self._stamps[0])
 
-    async def _periodic_stamp(self):
-        while True:
-            self._stamp(len(self._stream.data))
-            await asyncio.sleep(self._interval)
+    def _periodic_stamp(self):
+        self._stamp(len(self._stream.data))
+        self._handle = asyncio.get_event_loop().call_later(
+            self._interval, self._periodic_stamp)
 
-    async def _wait_for_stream_end(self):
-        await self._stream.wait_for_ended()
-        self._stamp_coro.cancel()
+    def end(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
         self._stamps.clear()
         self._stamp(len(self._stream.data))
-        self._ended = True
-
-    async def timestamps(self):
-        while not self._ended:
-            await self._new_stamp.wait()
-            yield self._stamps[0]
-        yield self._stamps[0]
 
 
 class DelayedReplayStream(ReplayStream):
@@ -49,7 +52,8 @@ class DelayedReplayStream(ReplayStream):
         self._stream = stream
         self._timestamp = timestamp
         self._current_position = 0
-        asyncio.ensure_future(self._track_delayed_stream())
+        stream.add_observer(self)
+        timestamp.start(self._advance)
 
     @classmethod
     def build(cls, stream, config):
@@ -106,15 +110,18 @@ class DelayedReplayStream(ReplayStream):
     def discard(self, until):
         return self._stream.discard(until)
 
-    async def _track_delayed_stream(self):
-        await self._stream.wait_for_header()
+    def on_header(self, stream):
         self._header_available()
-        await self._track_data()
+
+    def on_data(self, stream):
+        pass
+
+    def on_end(self, stream):
+        self._timestamp.end()
         self._end()
 
-    async def _track_data(self):
-        async for position in self._timestamp.timestamps():
-            if position <= self._current_position:
-                continue
-            self._current_position = position
-            self._data_available()
+    def _advance(self, position):
+        if position <= self._current_position:
+            return
+        self._current_position = position
+        self._data_available()
@@ -0,0 +1,170 @@
+import asyncio
+import mmap
+import os
+import tempfile
+from collections import deque
+
+
+def write_unlinked_file(directory, prefix, data):
+    """
+    Creates a temporary file in directory, unlinks it and writes data to it.
+    Returns its descriptor. Blocking.
+    """
+    fd, path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        os.unlink(path)
+        with open(fd, "wb", closefd=False) as f:
+            f.write(data)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+class SpillFile:
+    """
+    Finished stream data kept in a file instead of memory. The file is
+    unlinked as soon as it's created, so it's cleaned up even if we crash.
+    Reads are done in a thread.
+    """
+    # Readers get data in chunks at most this large, so that we don't read a
+    # whole replay into memory for each of them.
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, fd, length):
+        self._fd = fd
+        self._length = length
+
+    @classmethod
+    async def create(cls, directory, data):
+        "Writes data to a new spill file in directory. data must not change."
+        fd = await asyncio.get_event_loop().run_in_executor(
+            None, write_unlinked_file, directory, ".spill-", data)
+        return cls(fd, len(data))
+
+    def __len__(self):
+        return self._length
+
+    async def read(self, start, length):
+        length = max(0, min(length, self.READ_SIZE, self._length - start))
+        return await asyncio.get_event_loop().run_in_executor(
+            None, os.pread, self._fd, length, start)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MappedSpill:
+    """
+    Stream data kept in unlinked temporary files mapped into memory, so that
+    it can be accessed synchronously without syscalls while the kernel is
+    free to write it out and drop it from memory. Data is split into
+    segments of SEGMENT_SIZE bytes, each in its own file, so that we can free
+    it from the front as it's discarded. Files get their space allocated when
+    created, so running out of disk can't make writing to them crash us.
+
+    Creating a segment is blocking, do it in a thread.
+    """
+    SEGMENT_SIZE = 1024 * 1024
+
+    def __init__(self, directory, start):
+        self._directory = directory
+        # Stream positions of the start of the first segment and of the end
+        # of data.
+        self.start = start
+        self.end = start
+        self._segments = deque()
+
+    @classmethod
+    async def create(cls, directory, start, data):
+        """
+        Spills data, which starts at stream position start and must not
+        change, with some room to spare.
+        """
+        def fill():
+            spill = cls(directory, start)
+            try:
+                for _ in range(len(data) // cls.SEGMENT_SIZE + 1):
+                    spill.add_segment(spill.new_segment())
+                spill.write(data)
+            except BaseException:
+                spill.close()
+                raise
+            return spill
+
+        return await asyncio.get_event_loop().run_in_executor(None, fill)
+
+    def new_segment(self):
+        fd, path = tempfile.mkstemp(dir=self._directory, prefix=".writer-")
+        try:
+            os.unlink(path)
+            os.posix_fallocate(fd, 0, self.SEGMENT_SIZE)
+            return mmap.mmap(fd, self.SEGMENT_SIZE)
+        finally:
+            # The mapping keeps its own descriptor.
+            os.close(fd)
+
+    def add_segment(self, segment):
+        self._segments.append(segment)
+
+    def room(self):
+        return len(self._segments) * self.SEGMENT_SIZE - (self.end -
+                                                          self.start)
+
+    def write(self, data):
+        "Appends as much of data as there's room for, returns how much."
+        written = 0
+        while written < len(data) and self.room() > 0:
+            segment, offset = self._locate(self.end)
+            size = min(len(data) - written, self.SEGMENT_SIZE - offset)
+            segment[offset:offset + size] = data[written:written + size]
+            written += size
+            self.end += size
+        return written
+
+    def read(self, start, end):
+        "Returns a copy of data from start to end."
+        data = bytearray()
+        while start < end:
+            segment, offset = self._locate(start)
+            size = min(end - start, self.SEGMENT_SIZE - offset)
+            data += memoryview(segment)[offset:offset + size]
+            start += size
+        return data
+
+    def view(self, start, end):
+        "Returns a view of data from start to end, copied if it has to be."
+        segment, offset = self._locate(start)
+        if offset + end - start <= self.SEGMENT_SIZE:
+            return memoryview(segment)[offset:offset + end - start]
+        return memoryview(self.read(start, end))
+
+    def discard(self, until):
+        "Closes segments (in a thread) that only hold data before until."
+        dropped = []
+        while (len(self._segments) > 1 and
+               self.start + self.SEGMENT_SIZE <= until):
+            dropped.append(self._segments.popleft())
+            self.start += self.SEGMENT_SIZE
+        if dropped:
+            asyncio.get_event_loop().run_in_executor(None, _close_all,
+                                                     dropped)
+
+    def close(self):
+        _close_all(self._segments)
+        self._segments.clear()
+
+    def _locate(self, position):
+        index, offset = divmod(position - self.start, self.SEGMENT_SIZE)
+        return self._segments[index], offset
+
+
+def _close_all(segments):
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            # Someone still holds a view, it's unmapped once they let go.
+            pass
@@ -0,0 +1,135 @@
+import asyncio
+import zstandard as zstd
+
+from replayserver.streams.base import ConcreteDataMixin, \
+    OutsideSourceReplayStream
+
+
+class TieredReplayStream(OutsideSourceReplayStream):
+    """
+    Outside source stream that can keep old data compressed in memory. Data
+    is compressed in fixed size segments, in a thread, when asked to with
+    compress_cold(). Accessing compressed data decompresses it, which happens
+    synchronously except for read().
+
+    For ConcreteDataMixin, compressed data looks discarded; we handle access
+    to it ourselves.
+    """
+    SEGMENT_SIZE = 1024 * 1024
+    COMPRESSION_LEVEL = 3
+
+    def __init__(self):
+        OutsideSourceReplayStream.__init__(self)
+        # Segment number -> compressed segment
+        self._cold = {}
+        self._cold_size = 0
+        self._cold_end = 0
+        self._compressing = False
+
+    def cold_size(self):
+        "Total size of compressed segments."
+        return self._cold_size
+
+    async def compress_cold(self, until):
+        "Compresses whole segments of data before position until."
+        segments = until // self.SEGMENT_SIZE
+        first = self._cold_end // self.SEGMENT_SIZE
+        if segments <= first or self._compressing or self._spill is not None:
+            return
+        start = self._cold_end
+        end = segments * self.SEGMENT_SIZE
+        hot = self._data_slice(slice(start, end))
+
+        def compress():
+            cctx = zstd.ZstdCompressor(level=self.COMPRESSION_LEVEL)
+            view = memoryview(hot)
+            return [cctx.compress(view[i:i + self.SEGMENT_SIZE])
+                    for i in range(0, len(hot), self.SEGMENT_SIZE)]
+
+        self._compressing = True
+        try:
+            compressed = await asyncio.get_event_loop().run_in_executor(
+                None, compress)
+        finally:
+            self._compressing = False
+        # Data might have been discarded in the meantime.
+        if self._discarded_data != start:
+            return
+        for i, c in enumerate(compressed):
+            self._cold[first + i] = c
+            self._cold_size += len(c)
+        self._cold_end = end
+        # Copy, so that the memory is actually freed.
+        self._data = self._data[end - start:]
+        self._discarded_data = end
+
+    def discard(self, until):
+        for i in list(self._cold):
+            if (i + 1) * self.SEGMENT_SIZE <= until:
+                self._cold_size -= len(self._cold.pop(i))
+        if until > self._discarded_data:
+            ConcreteDataMixin.discard(self, until)
+
+    def _held(self):
+        return len(self._data) + self._cold_size
+
+    def _segment(self, i):
+        try:
+            segment = self._cold[i]
+        except KeyError:
+            raise IndexError
+        return zstd.ZstdDecompressor().decompress(segment)
+
+    def _cold_range(self, start, end):
+        chunks = []
+        first = start // self.SEGMENT_SIZE
+        last = (end - 1) // self.SEGMENT_SIZE
+        for i in range(first, last + 1):
+            chunks.append(self._segment(i))
+        offset = first * self.SEGMENT_SIZE
+        return b"".join(chunks)[start - offset:end - offset]
+
+    def _data_slice(self, s):
+        if isinstance(s, slice):
+            return self._get_slice(s)
+        if s < 0:
+            s += self._len
+        if 0 <= s < self._cold_end:
+            return self._cold_range(s, s + 1)[0]
+        return ConcreteDataMixin._data_slice(self, s)
+
+    def _get_slice(self, s):
+        start, end, step = s.indices(self._len)
+        if start >= end:
+            return bytearray()
+        if start >= self._cold_end:
+            return ConcreteDataMixin._get_slice(self, s)
+        data = self._cold_range(start, min(end, self._cold_end))
+        if end > self._cold_end:
+            data += ConcreteDataMixin._get_slice(
+                self, slice(self._cold_end, end))
+        return data[::step]
+
+    def _data_bytes(self):
+        if self._cold_end == 0:
+            return ConcreteDataMixin._data_bytes(self)
+        return self._get_slice(slice(0, self._len))
+
+    def _data_view(self, start, end):
+        if self._cold_end == 0 or (start is not None
+                                   and start >= self._cold_end):
+            return ConcreteDataMixin._data_view(self, start, end)
+        return memoryview(self._get_slice(slice(start, end)))
+
+    async def read(self, start, length):
+        if self._spill is not None or start >= self._cold_end:
+            return await OutsideSourceReplayStream.read(self, start, length)
+        # Serve up to the end of the segment, decompressing off the loop.
+        i = start // self.SEGMENT_SIZE
+        segment = self._cold.get(i)
+        if segment is None:
+            raise IndexError
+        data = await asyncio.get_event_loop().run_in_executor(
+            None, zstd.ZstdDecompressor().decompress, segment)
+        offset = start - i * self.SEGMENT_SIZE
+        return data[offset:offset + length]
@@ -0,0 +1,126 @@
+"""
+Hashed timer wheel for connection-level deadlines. We keep tens of thousands
+of idle connections, each with an hours-long header timeout; a wheel makes
+adding and cancelling these O(1) and drives them all with a single periodic
+tick, instead of keeping them all in the event loop's timer heap.
+"""
+
+import asyncio
+import threading
+import weakref
+
+
+class Timer:
+    __slots__ = ("_wheel", "_callback", "_slot", "_rounds", "fired")
+
+    def __init__(self, wheel, callback, slot, rounds):
+        self._wheel = wheel
+        self._callback = callback
+        self._slot = slot
+        self._rounds = rounds
+        self.fired = False
+
+    def cancel(self):
+        if self._slot is not None:
+            self._wheel._remove(self)
+
+
+class TimerWheel:
+    """
+    Runs callbacks after a delay, with resolution-second precision. Timers
+    never fire early, and fire at most one tick late (unless the loop lags).
+    """
+    RESOLUTION = 0.1
+    SLOTS = 1024
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._slots = [set() for _ in range(self.SLOTS)]
+        self._count = 0
+        self._start = loop.time()
+        self._ticks = 0
+        self._tick_handle = None
+        self._in_tick = False
+
+    def __len__(self):
+        return self._count
+
+    def _current_tick(self):
+        return int((self._loop.time() - self._start) // self.RESOLUTION)
+
+    def call_later(self, delay, callback):
+        now = self._loop.time()
+        if self._count == 0 and not self._in_tick:
+            # Nothing to fire in between, restart the wheel from now.
+            self._start = now
+            self._ticks = 0
+        # Round up, so we never fire early.
+        elapsed = now - self._start
+        tick = max(self._ticks + 1,
+                   -int(-(elapsed + delay) // self.RESOLUTION))
+        rounds = (tick - self._ticks - 1) // self.SLOTS
+        timer = Timer(self, callback, tick % self.SLOTS, rounds)
+        self._slots[timer._slot].add(timer)
+        self._count += 1
+        # A running tick schedules the next one itself.
+        if self._tick_handle is None and not self._in_tick:
+            self._schedule_tick()
+        return timer
+
+    def _remove(self, timer):
+        self._slots[timer._slot].discard(timer)
+        timer._slot = None
+        self._count -= 1
+        if self._count == 0 and self._tick_handle is not None:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+
+    def _schedule_tick(self):
+        self._tick_handle = self._loop.call_at(
+            self._start + (self._ticks + 1) * self.RESOLUTION, self._tick)
+
+    def _tick(self):
+        self._tick_handle = None
+        # We were scheduled for the next tick, don't let float rounding
+        # tell us otherwise.
+        until = max(self._current_tick(), self._ticks + 1)
+        self._in_tick = True
+        try:
+            while self._ticks < until and self._count > 0:
+                self._ticks += 1
+                self._fire_slot(self._ticks % self.SLOTS)
+        finally:
+            self._in_tick = False
+        if self._count > 0:
+            self._schedule_tick()
+
+    def _fire_slot(self, slot):
+        due = []
+        for timer in self._slots[slot]:
+            if timer._rounds > 0:
+                timer._rounds -= 1
+            else:
+                due.append(timer)
+        for timer in due:
+            # An earlier callback might have cancelled it.
+            if timer._slot is None:
+                continue
+            self._remove(timer)
+            timer.fired = True
+            timer._callback()
+
+
+_wheels = weakref.WeakKeyDictionary()
+# Loops of worker threads look up their wheels concurrently.
+_wheels_lock = threading.Lock()
+
+
+def timer_wheel():
+    "Returns the timer wheel of the current event loop."
+    loop = asyncio.get_event_loop()
+    with _wheels_lock:
+        wheel = _wheels.get(loop)
+        if wheel is None:
+            wheel = TimerWheel(loop)
+            _wheels[loop] = wheel
+    return wheel
@@ -0,0 +1,59 @@
+"""
+Entry point to the bookkeeping worker, installed as a runnable script. Takes
+the same configuration as the server and saves replays the server hands over
+in storage.worker_spool_path.
+"""
+
+import asyncio
+import signal
+
+from everett import ConfigurationError
+
+from replayserver.bookkeeping.database import Database
+from replayserver.bookkeeping.spool import BookkeepingWorker
+from replayserver.logging import logger
+from replayserver.main import VERSION, get_program_config, \
+    setup_event_loop_policy
+
+
+__all__ = ["main"]
+
+
+def setup_signal_handler(stop, loop):
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, stop.set)
+
+
+async def run_worker(database, worker, stop):
+    await database.start()
+    await worker.start()
+    await stop.wait()
+    await worker.stop()
+    await database.stop()
+
+
+def main():
+    logger.info(f"FAF replay bookkeeping worker version {VERSION} starting")
+    try:
+        config = get_program_config()
+    except ConfigurationError:
+        logger.exception("Invalid configuration was provided!")
+        return 1
+    if not config.storage.worker_spool_path:
+        logger.error("storage.worker_spool_path is not set")
+        return 1
+
+    try:
+        logger.setLevel(config.log_level)
+        setup_event_loop_policy(config.uvloop)
+        database = Database.build(config.db)
+        worker = BookkeepingWorker.build(database, config.storage)
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+        setup_signal_handler(stop, loop)
+        loop.run_until_complete(run_worker(database, worker, stop))
+        loop.close()
+        return 0
+    except Exception:
+        logger.exception("Critical worker error!")
+        return 1
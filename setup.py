@@ -27,7 +27,15 @@ setup(
     entry_points={
         "console_scripts": [
             "faf_replay_server = replayserver.main:main",
+            ("faf_replay_train_dictionary = "
+             "replayserver.bookkeeping.dictionary:main"),
+            "faf_replay_migrate = replayserver.bookkeeping.migrate:main",
+            "faf_replay_bookkeeper = replayserver.worker:main",
         ],
     },
-    install_requires=install_reqs
+    install_requires=install_reqs,
+    extras_require={
+        "s3": ["boto3"],
+        "uvloop": ["uvloop"],
+    },
 )
@@ -9,7 +9,7 @@ from everett.manager import ConfigManager, ConfigDictEnv
 # FIXME - there's all kinds of utility stuff here, we should tidy it up
 
 __all__ = ["timeout", "fast_forward_time", "TimeSkipper",
-           "slow_test", "docker_faf_db_config"]
+           "slow_test", "benchmark", "docker_faf_db_config"]
 
 
 def timeout(time):
@@ -52,6 +52,12 @@ def slow_test(fn):
         "Test is slow")(fn)
 
 
+def benchmark(fn):
+    return unittest.skipUnless(
+        "RS_BENCHMARKS" in os.environ,
+        "Benchmark, set RS_BENCHMARKS to run")(fn)
+
+
 def config_from_dict(d):
     def flatten_dict(d, prefix=""):
         newd = {}
@@ -0,0 +1,59 @@
+"""
+Compares replay compression ratio and speed across levels, with and without a
+trained dictionary. Run with RS_BENCHMARKS=1 and pytest -s to see results.
+
+By default uses replays from test data. To benchmark on real replays, point
+RS_BENCHMARK_VAULT at a vault; half of the sampled replays are used for
+training, the other half for measurement.
+"""
+import os
+import random
+import time
+
+from tests import benchmark
+from tests.replays import example_replay, diverging_1
+from replayserver.bookkeeping.dictionary import sample_replays, \
+    train_dictionary
+from replayserver.bookkeeping.storage import ReplayFilePaths, \
+    ReplayCompressor, CompressionLevelPolicy
+
+
+LEVELS = [1, 3, 6, 9, 12, 15, 19]
+
+
+def benchmark_replays():
+    vault = os.environ.get("RS_BENCHMARK_VAULT")
+    if vault is None:
+        replays = [bytes(r.data) for r in diverging_1 + [example_replay]]
+        return replays, replays
+    paths = ReplayFilePaths.build(vault).all_replay_files()
+    count = int(os.environ.get("RS_BENCHMARK_SAMPLES", "400"))
+    replays = sample_replays(paths, count, 2 ** 30, rng=random.Random(0))
+    half = len(replays) // 2
+    return replays[:half], replays[half:]
+
+
+def measure(compressor, replays):
+    total_in = sum(len(r) for r in replays)
+    start = time.perf_counter()
+    total_out = sum(len(compressor.compress(r)[0]) for r in replays)
+    elapsed = time.perf_counter() - start
+    return total_in / total_out, elapsed / (total_in / 2 ** 20)
+
+
+@benchmark
+def test_compression_levels_and_dictionary():
+    training, measured = benchmark_replays()
+    samples = [r[:128 * 1024] for r in training]
+    print()
+    print(f"{len(measured)} replays, "
+          f"{sum(len(r) for r in measured) / 2 ** 20:.2f} MiB")
+    print("level  dict   ratio   s/MiB")
+    for level in LEVELS:
+        dictionary = train_dictionary(samples, 112640, level)
+        for d in [None, dictionary]:
+            compressor = ReplayCompressor(
+                CompressionLevelPolicy.fixed(level), d)
+            ratio, speed = measure(compressor, measured)
+            print(f"{level:5}  {'yes' if d else 'no':4} {ratio:7.2f} "
+                  f"{speed:7.3f}")
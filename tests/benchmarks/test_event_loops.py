@@ -0,0 +1,125 @@
+"""
+Compares the default asyncio event loop with uvloop (when installed) on the
+kind of load the server sees: short-lived connections, lots of small wakeups,
+and data sent through connections with no write buffer. Run with
+RS_BENCHMARKS=1 and pytest -s to see results.
+"""
+import asyncio
+import socket
+import time
+
+from tests import benchmark
+from replayserver.server.connection import Connection, ConnectionHeader
+from replayserver.server.connectionproducer import ConnectionProducer
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+CONNECTIONS = 2000
+WAKEUP_TASKS = 1000
+WAKEUP_TIME = 2
+SENDERS = 50
+SEND_CHUNK = 4096
+SEND_TOTAL = 4 * 1024 * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def connections_per_second():
+    port = free_port()
+
+    async def handle(conn):
+        await ConnectionHeader.read(conn, 10)
+        conn.close(immediate=True)
+
+    producer = ConnectionProducer(handle, port, 0)
+    await producer.start()
+    start = time.perf_counter()
+    for _ in range(CONNECTIONS):
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        w.write(b"G/1/Game\0")
+        await r.read()
+        w.close()
+    elapsed = time.perf_counter() - start
+    await producer.stop()
+    return CONNECTIONS / elapsed
+
+
+async def wakeups_per_second():
+    count = 0
+    end = asyncio.get_event_loop().time() + WAKEUP_TIME
+
+    async def wake():
+        nonlocal count
+        loop = asyncio.get_event_loop()
+        while loop.time() < end:
+            await asyncio.sleep(0.001)
+            count += 1
+
+    await asyncio.gather(*[wake() for _ in range(WAKEUP_TASKS)])
+    return count / WAKEUP_TIME
+
+
+async def cpu_per_megabyte():
+    port = free_port()
+    chunk = b"x" * SEND_CHUNK
+
+    async def handle(reader, writer):
+        writer.transport.set_write_buffer_limits(0)
+        conn = Connection(reader, writer, 0)
+        for _ in range(SEND_TOTAL // SEND_CHUNK):
+            await conn.write(chunk)
+        conn.close(immediate=True)
+
+    async def receive():
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        received = 0
+        while True:
+            data = await r.read(65536)
+            if not data:
+                break
+            received += len(data)
+        w.close()
+        return received
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    start_cpu = time.process_time()
+    received = await asyncio.gather(*[receive() for _ in range(SENDERS)])
+    cpu = time.process_time() - start_cpu
+    server.close()
+    await server.wait_closed()
+    return cpu * 1000 / (sum(received) / 2 ** 20)
+
+
+def run_load(new_loop):
+    loop = new_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return (loop.run_until_complete(connections_per_second()),
+                loop.run_until_complete(wakeups_per_second()),
+                loop.run_until_complete(cpu_per_megabyte()))
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+@benchmark
+def test_event_loops():
+    loops = [("asyncio", asyncio.new_event_loop)]
+    if uvloop is not None:
+        loops.append(("uvloop", uvloop.new_event_loop))
+    print()
+    if uvloop is None:
+        print("uvloop is not installed, measuring asyncio only")
+    for name, new_loop in loops:
+        conns, wakeups, cpu = run_load(new_loop)
+        print(f"{name:8}: {conns:.0f} connections/s, "
+              f"{wakeups:.0f} wakeups/s, "
+              f"{cpu:.1f} ms CPU per delivered MB")
@@ -0,0 +1,53 @@
+"""
+Measures the cost of journaling live replays, with 1000 games each getting
+a few hundred bytes per flush, as a running game does every second. Run with
+RS_BENCHMARKS=1 and pytest -s to see results.
+"""
+import os
+import time
+
+import pytest
+
+from tests import benchmark
+from tests.replays import example_replay
+from replayserver.bookkeeping.spool import ReplaySpool
+from replayserver.server.journal import ReplayJournals
+from replayserver.streams import OutsideSourceReplayStream
+from replayserver.struct.header import ReplayHeader
+
+
+GAMES = 1000
+TICKS = 60
+TICK_DATA = 300
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_journal_overhead(tmpdir):
+    journals = ReplayJournals(ReplaySpool(str(tmpdir)), 1)
+    header = ReplayHeader(example_replay.header_data, example_replay.header)
+    streams = []
+    for game_id in range(GAMES):
+        stream = OutsideSourceReplayStream()
+        stream.set_header(header)
+        journals.track(game_id, stream)
+        streams.append(stream)
+    chunk = os.urandom(TICK_DATA)
+
+    cpu_time = 0
+    total_time = 0
+    for _ in range(TICKS):
+        for stream in streams:
+            stream.feed_data(chunk)
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        await journals.flush()
+        total_time += time.perf_counter() - start
+        cpu_time += time.process_time() - start_cpu
+
+    written = sum(len(s.data) for s in streams) / 2 ** 20
+    print()
+    print(f"{GAMES} games, {TICKS} flushes, {written:.2f} MiB")
+    print(f"flush wall time: {total_time / TICKS * 1000:.2f} ms")
+    print(f"flush CPU time:  {cpu_time / TICKS * 1000:.2f} ms")
+    assert len(os.listdir(str(tmpdir))) == GAMES
@@ -0,0 +1,78 @@
+"""
+Measures how merging work scales with event loops running in threads, like
+workers of a supervisor with worker_threads set. Each loop merges the same
+number of games, so with perfect scaling wall time stays flat as loops are
+added. Without a free-threaded Python build, expect it to grow linearly. Run
+with RS_BENCHMARKS=1 and pytest -s to see results.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from tests import benchmark
+from replayserver.receive.mergestrategy import QuorumMergeStrategy
+from replayserver.streams import OutsideSourceReplayStream
+
+
+LOOPS = [1, 2, 4, 8, 16]
+GAMES_PER_LOOP = 200
+WRITERS_PER_GAME = 2
+TICKS = 50
+TICK_DATA = 300
+
+
+class Config:
+    desired_quorum = 2
+    stream_comparison_cutoff = None
+
+
+async def merge_games():
+    writers = []
+    for _ in range(GAMES_PER_LOOP):
+        strategy = QuorumMergeStrategy.build(OutsideSourceReplayStream(),
+                                             Config)
+        for _ in range(WRITERS_PER_GAME):
+            stream = OutsideSourceReplayStream()
+            strategy.track_stream(stream)
+            stream.set_header("header")
+            writers.append(stream)
+    chunk = os.urandom(TICK_DATA)
+    for _ in range(TICKS):
+        for stream in writers:
+            stream.feed_data(chunk)
+        await asyncio.sleep(0)
+    for stream in writers:
+        stream.finish()
+
+
+def run_loop():
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(merge_games())
+    loop.close()
+
+
+@benchmark
+def test_loop_scaling():
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    cores = os.cpu_count()
+    print()
+    print(f"{GAMES_PER_LOOP} games per loop, {TICKS} ticks, "
+          f"{cores} cores, GIL {'enabled' if gil else 'disabled'}")
+    base = None
+    for loops in LOOPS:
+        threads = [threading.Thread(target=run_loop) for _ in range(loops)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        game_ticks = loops * GAMES_PER_LOOP * TICKS / elapsed
+        if base is None:
+            base = game_ticks
+        used_cores = min(loops, cores)
+        print(f"{loops:2} loops: {elapsed:.2f} s, "
+              f"{game_ticks / used_cores:.0f} game ticks/s per core, "
+              f"speedup {game_ticks / base:.2f}")
@@ -0,0 +1,125 @@
+"""
+Measures memory held per idle connection (one that connected, but didn't send
+its header yet, like FA lobbies do) and per writer stream pipeline. Run with
+RS_BENCHMARKS=1 and pytest -s to see results.
+"""
+import asyncio
+import socket
+import tracemalloc
+
+import pytest
+
+from tests import benchmark
+from replayserver.receive.mergestrategy import QuorumMergeStrategy
+from replayserver.server.connection import Connection, ConnectionHeader
+from replayserver.server.connectionproducer import ConnectionProducer
+from replayserver.streams import OutsideSourceReplayStream, \
+    DelayedReplayStream
+
+
+CONNECTIONS = 2000
+WRITERS = 10000
+
+
+class Config:
+    desired_quorum = 2
+    stream_comparison_cutoff = None
+    update_interval = 1
+    replay_delay = 300
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_idle_connection_memory():
+    accepted = 0
+
+    async def handle(reader, writer):
+        nonlocal accepted
+        writer.transport.set_write_buffer_limits(0)
+        connection = Connection(reader, writer, 1)
+        accepted += 1
+        try:
+            await ConnectionHeader.read(connection, 3600)
+        except Exception:
+            pass
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0,
+                                        backlog=CONNECTIONS)
+    port = server.sockets[0].getsockname()[1]
+
+    tracemalloc.start()
+    clients = [socket.create_connection(("127.0.0.1", port))
+               for _ in range(CONNECTIONS)]
+    before = tracemalloc.get_traced_memory()[0]
+    while accepted < CONNECTIONS:
+        await asyncio.sleep(0.01)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for c in clients:
+        c.close()
+    server.close()
+    await server.wait_closed()
+    print()
+    print(f"{CONNECTIONS} idle connections")
+    print(f"bytes per connection: {(after - before) / CONNECTIONS:.0f}")
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_parked_connection_memory(unused_tcp_port):
+    async def handle(connection):
+        pass
+
+    producer = ConnectionProducer(handle, unused_tcp_port, 1,
+                                  park_timeout=3600)
+    await producer.start()
+
+    # Default listen backlog is small, so connect in batches and don't count
+    # memory of client sockets.
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients = []
+    client_memory = 0
+    while len(clients) < CONNECTIONS:
+        start = tracemalloc.get_traced_memory()[0]
+        clients.extend(
+            socket.create_connection(("127.0.0.1", unused_tcp_port))
+            for _ in range(50))
+        client_memory += tracemalloc.get_traced_memory()[0] - start
+        while producer.parked_count() < len(clients):
+            await asyncio.sleep(0.01)
+    after = tracemalloc.get_traced_memory()[0] - client_memory
+    tracemalloc.stop()
+
+    for c in clients:
+        c.close()
+    await producer.stop()
+    print()
+    print(f"{CONNECTIONS} parked connections")
+    print(f"bytes per connection: {(after - before) / CONNECTIONS:.0f}")
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_writer_memory():
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    writers = []
+    for _ in range(WRITERS // 2):
+        strategy = QuorumMergeStrategy.build(OutsideSourceReplayStream(),
+                                             Config)
+        for _ in range(2):
+            stream = OutsideSourceReplayStream()
+            strategy.track_stream(DelayedReplayStream.build(stream, Config))
+            stream.set_header("header")
+            writers.append(stream)
+    await asyncio.sleep(0)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for stream in writers:
+        stream.finish()
+    print()
+    print(f"{WRITERS} writers, with canonical streams of their games")
+    print(f"bytes per writer: {(after - before) / WRITERS:.0f}")
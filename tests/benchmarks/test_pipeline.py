@@ -0,0 +1,63 @@
+"""
+Measures tasks alive and scheduling overhead of the writer stream pipeline
+(stream, delay, merge strategy) with 10000 writers in 5000 games, each writer
+getting a chunk of data every update interval. Run with RS_BENCHMARKS=1 and
+pytest -s to see results.
+"""
+import asyncio
+import os
+import time
+
+import pytest
+
+from tests import benchmark
+from replayserver.receive.mergestrategy import QuorumMergeStrategy
+from replayserver.streams import OutsideSourceReplayStream, \
+    DelayedReplayStream
+
+
+WRITERS = 10000
+WRITERS_PER_GAME = 2
+TICKS = 20
+TICK_DATA = 300
+
+
+class Config:
+    desired_quorum = 2
+    stream_comparison_cutoff = None
+    update_interval = 0.05
+    replay_delay = 0.2
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_pipeline_overhead():
+    tasks_before = len(asyncio.all_tasks())
+    writers = []
+    for _ in range(WRITERS // WRITERS_PER_GAME):
+        strategy = QuorumMergeStrategy.build(OutsideSourceReplayStream(),
+                                             Config)
+        for _ in range(WRITERS_PER_GAME):
+            stream = OutsideSourceReplayStream()
+            strategy.track_stream(DelayedReplayStream.build(stream, Config))
+            stream.set_header("header")
+            writers.append(stream)
+    tasks = len(asyncio.all_tasks()) - tasks_before
+    chunk = os.urandom(TICK_DATA)
+
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    for _ in range(TICKS):
+        for stream in writers:
+            stream.feed_data(chunk)
+        await asyncio.sleep(Config.update_interval)
+    for stream in writers:
+        stream.finish()
+    total_time = time.perf_counter() - start - TICKS * Config.update_interval
+    cpu_time = time.process_time() - start_cpu
+
+    print()
+    print(f"{WRITERS} writers, {TICKS} ticks")
+    print(f"tasks per writer: {tasks / WRITERS:.2f}")
+    print(f"overhead per tick: {total_time / TICKS * 1000:.2f} ms wall, "
+          f"{cpu_time / TICKS * 1000:.2f} ms CPU")
@@ -0,0 +1,112 @@
+"""
+Measures send syscalls and delivery latency per reader under different socket
+option profiles. Each reader gets a burst of catch-up data, then a small chunk
+every tick, like a reader joining a running game. Run with RS_BENCHMARKS=1
+and pytest -s to see results.
+"""
+import asyncio
+import socket
+import statistics
+import struct
+import time
+
+from tests import benchmark
+from replayserver.server.connectionproducer import ConnectionProducer
+from replayserver.server.sockopts import SocketOptions
+
+
+READERS = 50
+TICKS = 50
+TICK = 0.02
+TICK_DATA = 1024
+BURST_DATA = 256 * 1024
+MESSAGE_HEADER = struct.Struct("!dI")
+
+PROFILES = [
+    ("default", SocketOptions()),
+    ("nodelay", SocketOptions(tcp_nodelay=True)),
+    ("sndbuf 16k", SocketOptions(send_buffer=16384)),
+    ("notsent_lowat 16k", SocketOptions(notsent_lowat=16384)),
+    ("nodelay, lowat 16k", SocketOptions(tcp_nodelay=True,
+                                         notsent_lowat=16384)),
+]
+
+
+class CountingSocket:
+    "Counts send calls of the wrapped socket."
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.sends = 0
+
+    def send(self, data):
+        self.sends += 1
+        return self._sock.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def message(size):
+    return MESSAGE_HEADER.pack(time.perf_counter(), size) + b"x" * size
+
+
+async def run_profile(options):
+    port = free_port()
+    sockets = []
+
+    async def serve(conn):
+        conn.set_socket_options(options)
+        counting = CountingSocket(conn.writer.transport._sock)
+        conn.writer.transport._sock = counting
+        sockets.append(counting)
+        await conn.write(message(BURST_DATA))
+        for _ in range(TICKS):
+            await asyncio.sleep(TICK)
+            await conn.write(message(TICK_DATA))
+        conn.close(immediate=True)
+
+    async def read():
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        latencies = []
+        while True:
+            try:
+                head = await r.readexactly(MESSAGE_HEADER.size)
+            except asyncio.IncompleteReadError:
+                break
+            sent, size = MESSAGE_HEADER.unpack(head)
+            await r.readexactly(size)
+            latencies.append(time.perf_counter() - sent)
+        w.close()
+        return latencies
+
+    producer = ConnectionProducer(serve, port, 0)
+    await producer.start()
+    results = await asyncio.gather(*[read() for _ in range(READERS)])
+    await producer.stop()
+    latencies = sorted(lat for result in results for lat in result)
+    sends = sum(s.sends for s in sockets) / READERS
+    return sends, latencies
+
+
+@benchmark
+def test_socket_option_profiles():
+    print()
+    print(f"{READERS} readers, {BURST_DATA // 1024}kB burst, then "
+          f"{TICK_DATA}B every {TICK * 1000:.0f}ms for {TICKS} ticks")
+    for name, options in PROFILES:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        sends, latencies = loop.run_until_complete(run_profile(options))
+        loop.close()
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(f"{name:20}: {sends:.0f} sends per reader, latency median "
+              f"{statistics.median(latencies) * 1000:.2f}ms, "
+              f"p99 {p99 * 1000:.2f}ms")
+    asyncio.set_event_loop(None)
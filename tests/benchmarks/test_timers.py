@@ -0,0 +1,88 @@
+"""
+Compares keeping header deadlines of 50000 idle lobby connections in the timer
+wheel against keeping them in the event loop's timer heap. Connections are
+backed by plain StreamReaders, so we don't run out of file descriptors. Run
+with RS_BENCHMARKS=1 and pytest -s to see results.
+"""
+import asyncio
+import time
+import tracemalloc
+
+import pytest
+
+from tests import benchmark
+from replayserver.errors import EmptyConnectionError
+from replayserver.server import connection as connection_module
+from replayserver.server.connection import Connection, ConnectionHeader
+
+
+CONNECTIONS = 50000
+HEADER_TIMEOUT = 6 * 60 * 60
+IDLE_TIME = 3
+
+
+class LoopTimer:
+    __slots__ = ("_handle", "_callback", "fired")
+
+    def __init__(self, delay, callback):
+        self._callback = callback
+        self.fired = False
+        self._handle = asyncio.get_event_loop().call_later(delay, self._fire)
+
+    def _fire(self):
+        self.fired = True
+        self._callback()
+
+    def cancel(self):
+        self._handle.cancel()
+
+
+class LoopTimers:
+    def call_later(self, delay, callback):
+        return LoopTimer(delay, callback)
+
+
+async def idle_connections():
+    async def lobby(conn):
+        try:
+            await ConnectionHeader.read(conn, HEADER_TIMEOUT)
+        except EmptyConnectionError:
+            pass
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    conns = [Connection(asyncio.StreamReader(), None, 1)
+             for _ in range(CONNECTIONS)]
+    tasks = [asyncio.ensure_future(lobby(c)) for c in conns]
+    await asyncio.sleep(0)
+    setup_time = time.perf_counter() - start
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_cpu = time.process_time()
+    await asyncio.sleep(IDLE_TIME)
+    idle_cpu = time.process_time() - start_cpu
+
+    # Lobbies end without a game, cancelling their deadlines.
+    start = time.perf_counter()
+    for c in conns:
+        c.reader.feed_eof()
+    await asyncio.gather(*tasks)
+    teardown_time = time.perf_counter() - start
+
+    print(f"  bytes per connection: {(after - before) / CONNECTIONS:.0f}")
+    print(f"  setup: {setup_time * 1000:.0f} ms, "
+          f"teardown: {teardown_time * 1000:.0f} ms, "
+          f"idle CPU: {idle_cpu / IDLE_TIME * 1000:.1f} ms/s")
+
+
+@benchmark
+@pytest.mark.asyncio
+async def test_idle_connection_deadlines(monkeypatch):
+    print()
+    print(f"{CONNECTIONS} idle connections, timer wheel")
+    await idle_connections()
+    monkeypatch.setattr(connection_module, "timer_wheel", LoopTimers)
+    print(f"{CONNECTIONS} idle connections, event loop timers")
+    await idle_connections()
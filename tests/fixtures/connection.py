@@ -63,6 +63,13 @@ class ControlledConnection:
         self._closed = True
         self._closed_by_us = True
 
+    def detach(self):
+        self.close()
+        return None, b""
+
+    def set_socket_options(self, options):
+        pass
+
     async def wait_closed(self):
         while not self._closed:
             await asyncio.sleep(1)
@@ -0,0 +1,96 @@
+import pytest
+import asynctest
+
+from replayserver.bookkeeping.bookkeeper import Bookkeeper
+from replayserver.bookkeeping.index import VaultIndex, index_entry
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
+
+
+@pytest.fixture
+def bookkeeper_deps():
+    class Q:
+        async def update_game_stats():
+            pass
+
+    class S:
+        async def save_replay():
+            pass
+
+    class A:
+        def get_replay_ticks():
+            pass
+
+    class R:
+        async def replay_saved():
+            pass
+
+    class P:
+        async def attempt():
+            pass
+
+        async def defer():
+            pass
+
+    async def attempt(fn):
+        return await fn()
+
+    analyzer = asynctest.Mock(spec=A)
+    analyzer.get_replay_ticks.return_value = 100
+    pending = asynctest.Mock(spec=P, attempt=asynctest.CoroutineMock(
+        side_effect=attempt))
+    return (asynctest.Mock(spec=Q), asynctest.Mock(spec=S), analyzer,
+            pending, asynctest.Mock(spec=R))
+
+
+@pytest.mark.asyncio
+async def test_bookkeeper_updates_stats(bookkeeper_deps,
+                                        outside_source_stream):
+    queries, saver, analyzer, pending, _ = bookkeeper_deps
+    bookkeeper = Bookkeeper(queries, saver, analyzer, pending)
+    await bookkeeper.save_replay(1, outside_source_stream)
+    queries.update_game_stats.assert_awaited_once_with(1, 100, True)
+    pending.defer.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_bookkeeper_defers_failed_stats_update(bookkeeper_deps,
+                                                     outside_source_stream):
+    queries, saver, analyzer, pending, _ = bookkeeper_deps
+    saver.save_replay.side_effect = BookkeepingError
+    queries.update_game_stats.side_effect = DatabaseUnavailableError
+    bookkeeper = Bookkeeper(queries, saver, analyzer, pending)
+    await bookkeeper.save_replay(1, outside_source_stream)
+    pending.defer.assert_awaited_once_with("game_stats", game_id=1,
+                                           replay_ticks=100,
+                                           replay_available=False)
+
+
+@pytest.mark.asyncio
+async def test_bookkeeper_schedules_recompression(bookkeeper_deps,
+                                                  outside_source_stream):
+    queries, saver, analyzer, pending, recompressor = bookkeeper_deps
+    saver.save_replay.return_value = {"game_id": 1, "compression_level": 3}
+    bookkeeper = Bookkeeper(queries, saver, analyzer, pending, recompressor)
+    await bookkeeper.save_replay(1, outside_source_stream)
+    recompressor.replay_saved.assert_awaited_once_with(1, 3)
+
+
+@pytest.mark.asyncio
+async def test_bookkeeper_indexes_replay(bookkeeper_deps,
+                                         outside_source_stream, tmpdir):
+    queries, saver, analyzer, pending, _ = bookkeeper_deps
+    saver.save_replay.return_value = index_entry(
+        "/foo/1.fafreplay", {"uid": 1, "mapname": "scmp_009"}, 100, "abc",
+        1000)
+    index = VaultIndex(str(tmpdir.join("index")))
+    bookkeeper = Bookkeeper(queries, saver, analyzer, pending, index=index)
+    await bookkeeper.save_replay(1, outside_source_stream)
+
+    entry = index.get(1)
+    assert entry["ticks"] == 100
+    assert entry["data_size"] == 1000
+    assert entry["mapname"] == "scmp_009"
+
+    saver.save_replay.side_effect = BookkeepingError
+    await bookkeeper.save_replay(2, outside_source_stream)
+    assert index.get(2) is None
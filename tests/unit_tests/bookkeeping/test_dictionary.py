@@ -0,0 +1,53 @@
+import json
+import random
+
+from tests.replays import example_replay, diverging_1
+from replayserver.bookkeeping.dictionary import sample_replays, main
+from replayserver.bookkeeping.storage import ReplayFilePaths, \
+    ReplayCompressor, CompressionLevelPolicy, load_dictionary, read_replay
+
+
+def write_vault(tmpdir, replays):
+    paths = ReplayFilePaths.build(str(tmpdir))
+    compressor = ReplayCompressor(CompressionLevelPolicy.fixed(3))
+    for i, replay in enumerate(replays):
+        rfile = paths.replay_file(i + 1)
+        tmpdir.join(rfile[len(str(tmpdir)):]).write(
+            b'{"compression": "zstd"}\n' + compressor.compress(replay.data)[0],
+            mode="wb", ensure=True)
+    return paths
+
+
+def test_sample_replays(tmpdir):
+    paths = write_vault(tmpdir, diverging_1)
+    tmpdir.join("broken.fafreplay").write(b"garbage")
+    files = list(paths.all_replay_files())
+
+    samples = sample_replays(files, 4, 1000, rng=random.Random(1))
+    assert len(samples) <= 4
+    assert all(len(s) == 1000 for s in samples)
+    samples = sample_replays(files, 100, 10 ** 6)
+    assert sorted(samples) == sorted(bytes(r.data) for r in diverging_1)
+
+
+def test_train_dictionary_main(tmpdir):
+    vault = tmpdir.mkdir("vault")
+    write_vault(vault, diverging_1 * 4 + [example_replay] * 4)
+    out = str(tmpdir.join("dict"))
+
+    assert main(["--vault", str(vault), "--out", out,
+                 "--dict-size", "8192", "--level", "3"]) == 0
+    dictionary = load_dictionary(out)
+
+    rfile = tmpdir.join("replay")
+    compressor = ReplayCompressor(CompressionLevelPolicy.fixed(3),
+                                  dictionary)
+    data, info = compressor.compress(example_replay.data)
+    rfile.write(json.dumps(info).encode() + b"\n" + data, mode="wb")
+    _, data = read_replay(str(rfile), {dictionary.dict_id(): dictionary})
+    assert data == example_replay.data
+
+
+def test_train_dictionary_empty_vault(tmpdir):
+    assert main(["--vault", str(tmpdir),
+                 "--out", str(tmpdir.join("dict"))]) == 1
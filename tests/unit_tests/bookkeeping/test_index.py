@@ -0,0 +1,94 @@
+import pytest
+import sqlite3
+
+from replayserver.bookkeeping.index import VaultIndex, index_entry, \
+    update_index
+
+
+def entry(game_id, **kwargs):
+    info = {"uid": game_id, "compression": "zstd", "compression_level": 19,
+            "mapname": "scmp_009", "featured_mod": "faf"}
+    result = index_entry(f"/vault/{game_id}.fafreplay", info, 100, "abc",
+                         1000, 50)
+    result.update(kwargs)
+    return result
+
+
+def test_index_entry_from_file_name():
+    e = index_entry("/vault/1/2/123.fafreplay", {}, 100, "abc")
+    assert e["game_id"] == 123
+    assert e["ticks"] is None
+
+
+def test_index_put_and_get(tmpdir):
+    index = VaultIndex(str(tmpdir.join("index")))
+    assert index.get(1) is None
+    index.put(entry(1))
+    assert index.get(1) == entry(1)
+    index.put(entry(1, ticks=None))
+    assert index.get(1)["ticks"] is None
+    assert len(index) == 1
+    index.remove(1)
+    assert len(index) == 0
+
+
+def test_index_update_and_merge(tmpdir):
+    index = VaultIndex(str(tmpdir.join("index")))
+    index.update(1, ticks=10)
+    assert index.get(1) is None
+
+    index.put(entry(1))
+    index.update(1, ticks=None, file_size=200)
+    assert index.get(1)["ticks"] == 50
+    assert index.get(1)["file_size"] == 200
+
+    index.merge(entry(1, ticks=None, data_size=None, file_size=300))
+    assert index.get(1) == entry(1, file_size=300)
+    index.merge(entry(2, ticks=None))
+    assert index.get(2)["ticks"] is None
+
+    with pytest.raises(ValueError):
+        index.update(1, foo=1)
+
+
+def test_index_find(tmpdir):
+    index = VaultIndex(str(tmpdir.join("index")))
+    index.put(entry(3, mapname="scmp_001"))
+    index.put(entry(2, ticks=None))
+    index.put(entry(1, compression_level=3))
+
+    assert [e["game_id"] for e in index.find()] == [1, 2, 3]
+    assert [e["game_id"] for e in index.find(mapname="scmp_009")] == [1, 2]
+    assert [e["game_id"] for e in index.find(missing=["ticks"])] == [2]
+    assert [e["game_id"] for e in index.find(compression="zstd",
+                                             compression_level=19)] == [2, 3]
+    assert [e["game_id"] for e in index.find(limit=1)] == [1]
+    with pytest.raises(ValueError):
+        index.find(foo=1)
+
+
+def test_index_persists(tmpdir):
+    path = str(tmpdir.join("index"))
+    index = VaultIndex(path)
+    index.put(entry(1))
+    index.close()
+    assert VaultIndex(path).get(1) == entry(1)
+
+
+@pytest.mark.asyncio
+async def test_update_index(tmpdir):
+    index = VaultIndex(str(tmpdir.join("index")))
+    await update_index(index, entry(1))
+    assert index.get(1) == entry(1)
+    await update_index(index, entry(1, ticks=None, file_size=5),
+                       replace=False)
+    assert index.get(1) == entry(1, file_size=5)
+
+
+@pytest.mark.asyncio
+async def test_update_index_ignores_errors(tmpdir):
+    index = VaultIndex(str(tmpdir.join("index")))
+    index.close()
+    await update_index(index, entry(1))
+    with pytest.raises(sqlite3.Error):
+        index.get(1)
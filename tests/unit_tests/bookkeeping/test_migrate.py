@@ -0,0 +1,170 @@
+import base64
+import json
+import os
+import struct
+import zlib
+
+from tests.replays import example_replay, diverging_1
+from replayserver.bookkeeping.migrate import Checkpoint, Throttle, walk_key, \
+    main
+from replayserver.bookkeeping.index import VaultIndex
+from replayserver.bookkeeping.storage import ReplayFilePaths, \
+    ReplayCompressor, CompressionLevelPolicy, read_replay, write_replay_file
+
+
+GAME_IDS = [1, 99, 100, 12345, 1000000, 1234567]
+
+
+def write_vault(vault):
+    paths = ReplayFilePaths.build(str(vault))
+    compressor = ReplayCompressor(CompressionLevelPolicy.fixed(1))
+    for game_id, replay in zip(GAME_IDS, diverging_1):
+        rfile = paths.replay_file(game_id)
+        os.makedirs(os.path.dirname(rfile), exist_ok=True)
+        data, info = compressor.compress(bytes(replay.data))
+        info.update({"uid": game_id, "version": 2})
+        write_replay_file(rfile, info, data)
+
+    # One legacy replay
+    rfile = paths.replay_file(7)
+    data = bytes(example_replay.data)
+    qcompressed = struct.pack(">i", len(data)) + zlib.compress(data)
+    write_replay_file(rfile, {"uid": 7}, base64.encodebytes(qcompressed))
+    return paths
+
+
+def test_walk_key_matches_replay_order(tmpdir):
+    paths = write_vault(tmpdir)
+    files = list(paths.all_replay_files())
+    assert sorted(files, key=lambda p: walk_key(str(tmpdir), p)) == files
+
+
+def test_throttle():
+    now = 0
+    slept = []
+
+    def sleep(t):
+        nonlocal now
+        slept.append(t)
+        now += t
+
+    throttle = Throttle(100, lambda: now, sleep)
+    throttle.wait(200)
+    assert slept == []
+    throttle.wait(100)
+    assert slept == [2]
+    now += 10
+    throttle.wait(100)
+    assert slept == [2]
+
+
+def test_migrate_recompress_in_place(tmpdir):
+    paths = write_vault(tmpdir)
+    assert main(["--vault", str(tmpdir), "--workers", "2",
+                 "recompress", "--level", "9"]) == 0
+
+    for game_id, replay in zip(GAME_IDS, diverging_1):
+        info, data = read_replay(paths.replay_file(game_id))
+        assert info["uid"] == game_id
+        assert info["compression_level"] == 9
+        assert data == replay.data
+    info, data = read_replay(paths.replay_file(7))
+    assert info == {"uid": 7, "version": 2, "compression": "zstd",
+                    "compression_level": 9}
+    assert data == example_replay.data
+
+    checkpoint = Checkpoint(
+        str(tmpdir.join(".migration_checkpoint_recompress")))
+    state = checkpoint.load()
+    assert state["counts"] == {"done": 7}
+
+    # Second run resumes after the last replay, so there's nothing to do
+    assert main(["--vault", str(tmpdir), "--workers", "2",
+                 "recompress", "--level", "9"]) == 0
+    state = checkpoint.load()
+    assert state["counts"] == {"done": 7}
+
+
+def test_migrate_resumes_from_checkpoint(tmpdir):
+    paths = write_vault(tmpdir)
+    files = list(paths.all_replay_files())
+    checkpoint = str(tmpdir.join("checkpoint"))
+    description = {"action": "recompress", "level": 9, "dest": None,
+                   "dictionary": None, "ticks": False}
+    Checkpoint(checkpoint).save({"description": description,
+                                 "last": files[2], "counts": {"done": 3},
+                                 "bytes_in": 0, "bytes_out": 0})
+
+    assert main(["--vault", str(tmpdir), "--workers", "1",
+                 "--checkpoint", checkpoint,
+                 "recompress", "--level", "9"]) == 0
+    for f in files[:3]:
+        assert read_replay(f)[0].get("compression_level") != 9
+    for f in files[3:]:
+        assert read_replay(f)[0]["compression_level"] == 9
+    assert Checkpoint(checkpoint).load()["counts"] == {"done": 7}
+
+
+def test_migrate_refuses_other_checkpoint(tmpdir):
+    write_vault(tmpdir)
+    checkpoint = str(tmpdir.join("checkpoint"))
+    Checkpoint(checkpoint).save({"description": {"action": "migrate"},
+                                 "last": None})
+    assert main(["--vault", str(tmpdir), "--checkpoint", checkpoint,
+                 "recompress"]) == 1
+
+
+def test_migrate_to_other_vault(tmpdir):
+    vault = tmpdir.mkdir("vault")
+    dest = tmpdir.mkdir("dest")
+    paths = write_vault(vault)
+    dest_paths = ReplayFilePaths.build(str(dest))
+    broken = dest_paths.replay_file(99)
+    os.makedirs(os.path.dirname(broken))
+    open(broken, "w").close()
+
+    assert main(["--vault", str(vault), "--workers", "2",
+                 "migrate", "--dest", str(dest)]) == 0
+
+    # Existing replays in destination are left alone
+    assert os.stat(broken).st_size == 0
+    for game_id in GAME_IDS + [7]:
+        if game_id == 99:
+            continue
+        with open(dest_paths.replay_file(game_id), "rb") as f:
+            with open(paths.replay_file(game_id), "rb") as g:
+                assert f.read() == g.read()
+    state = json.loads(vault.join(".migration_checkpoint_migrate").read())
+    assert state["counts"] == {"done": 6, "skipped": 1}
+
+
+def test_migrate_builds_index(tmpdir):
+    vault = tmpdir.mkdir("vault")
+    paths = write_vault(vault)
+    index_path = str(tmpdir.join("index"))
+    assert main(["--vault", str(vault), "--workers", "2",
+                 "--index-path", index_path, "index", "--ticks"]) == 0
+
+    index = VaultIndex(index_path)
+    assert len(index) == 7
+    entry = index.get(7)
+    rfile = paths.replay_file(7)
+    assert entry["path"] == rfile
+    assert entry["file_size"] == os.stat(rfile).st_size
+    assert entry["data_size"] == len(example_replay.data)
+    assert entry["ticks"] > 0
+    assert entry["compression"] is None
+    assert [e["game_id"] for e in index.find(compression="zstd")] == \
+        GAME_IDS
+
+    # Recompressing updates the index, keeping what it doesn't know
+    assert main(["--vault", str(vault), "--workers", "2",
+                 "--index-path", index_path, "recompress"]) == 0
+    entry = index.get(7)
+    assert entry["compression_level"] == 19
+    assert entry["ticks"] > 0
+    assert entry["file_size"] == os.stat(rfile).st_size
+
+
+def test_migrate_index_needs_path(tmpdir):
+    assert main(["--vault", str(tmpdir), "index"]) == 1
@@ -0,0 +1,256 @@
+import pytest
+import asynctest
+import asyncio
+from asynctest.helpers import exhaust_callbacks
+from tests import timeout, TimeSkipper
+
+from replayserver.bookkeeping.pending import PendingJournal, \
+    CircuitBreaker, PendingBookkeeping
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
+
+
+def test_journal_add_and_load(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = PendingJournal(path)
+    assert journal.load() == []
+    journal.add("foo", {"bar": 1}, 100)
+    journal.add("baz", {}, 200)
+
+    entries = PendingJournal(path).load()
+    assert [e["op"] for e in entries] == ["foo", "baz"]
+    assert entries[0]["args"] == {"bar": 1}
+    assert entries[0]["created"] == 100
+
+
+def test_journal_mark_done(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = PendingJournal(path)
+    first = journal.add("foo", {}, 100)
+    journal.add("bar", {}, 100)
+    journal.mark_done(first["id"])
+
+    entries = PendingJournal(path).load()
+    assert [e["op"] for e in entries] == ["bar"]
+
+
+def test_journal_ignores_truncated_entry(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = PendingJournal(path)
+    journal.add("foo", {}, 100)
+    with open(path, "ab") as f:
+        f.write(b'{"id": 1, "op": "ba')
+
+    journal = PendingJournal(path)
+    entries = journal.load()
+    assert [e["op"] for e in entries] == ["foo"]
+
+
+def test_journal_ids_unique_after_reload(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = PendingJournal(path)
+    first = journal.add("foo", {}, 100)
+    journal.mark_done(first["id"])
+
+    journal = PendingJournal(path)
+    journal.load()
+    second = journal.add("bar", {}, 100)
+    assert second["id"] != first["id"]
+
+
+def test_journal_compact(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = PendingJournal(path)
+    journal.add("foo", {}, 100)
+    second = journal.add("bar", {}, 100)
+    journal.compact([second])
+    assert [e["op"] for e in PendingJournal(path).load()] == ["bar"]
+    journal.compact([])
+    assert PendingJournal(path).load() == []
+
+
+def test_circuit_breaker_opens_after_threshold():
+    now = 0
+    breaker = CircuitBreaker(2, 10, 25, lambda: now)
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert breaker.time_until_closed() == 10
+
+    now = 10
+    assert not breaker.is_open()
+    # Failing again backs off further, up to a maximum
+    breaker.record_failure()
+    assert breaker.time_until_closed() == 20
+    now = 30
+    breaker.record_failure()
+    assert breaker.time_until_closed() == 25
+
+
+def test_circuit_breaker_closes_on_success():
+    now = 0
+    breaker = CircuitBreaker(1, 10, 25, lambda: now)
+    breaker.record_failure()
+    assert breaker.is_open()
+    breaker.record_success()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.time_until_closed() == 10
+
+
+@pytest.fixture
+def mock_journal():
+    class J:
+        def load():
+            pass
+
+        def compact():
+            pass
+
+        def add():
+            pass
+
+        def mark_done():
+            pass
+
+    next_id = 0
+
+    def add(op, args, created):
+        nonlocal next_id
+        next_id += 1
+        return {"id": next_id, "op": op, "args": args, "created": created}
+
+    journal = asynctest.Mock(spec=J)
+    journal.load.return_value = []
+    journal.add.side_effect = add
+    return journal
+
+
+def pending_with(journal, event_loop, threshold=1, lifetime=1000000):
+    breaker = CircuitBreaker(threshold, 10, 100, event_loop.time)
+    return PendingBookkeeping(journal, breaker, 10, 100, lifetime,
+                              event_loop.time)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_attempt_passes_results(event_loop, mock_journal):
+    pending = pending_with(mock_journal, event_loop)
+
+    async def op():
+        return 42
+
+    assert await pending.attempt(op) == 42
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_attempt_fails_fast_when_db_down(event_loop,
+                                                       mock_journal):
+    pending = pending_with(mock_journal, event_loop)
+    op = asynctest.CoroutineMock(side_effect=DatabaseUnavailableError)
+
+    with pytest.raises(DatabaseUnavailableError):
+        await pending.attempt(op)
+    with pytest.raises(DatabaseUnavailableError):
+        await pending.attempt(op)
+    op.assert_called_once()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_attempt_other_errors_keep_db_up(event_loop,
+                                                       mock_journal):
+    pending = pending_with(mock_journal, event_loop)
+    op = asynctest.CoroutineMock(side_effect=BookkeepingError)
+
+    for _ in range(3):
+        with pytest.raises(BookkeepingError):
+            await pending.attempt(op)
+    assert op.call_count == 3
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_defer_unknown_op(event_loop, mock_journal):
+    pending = pending_with(mock_journal, event_loop)
+    with pytest.raises(ValueError):
+        await pending.defer("foo", bar=1)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_retries_deferred_ops(event_loop, mock_journal):
+    # Journal calls go to a thread, so only skip time while nothing's there.
+    skipper = TimeSkipper(event_loop)
+    pending = pending_with(mock_journal, event_loop)
+    handler = asynctest.CoroutineMock(
+        side_effect=[DatabaseUnavailableError, DatabaseUnavailableError,
+                     None])
+    pending.add_handler("foo", handler)
+    await pending.start()
+
+    await pending.defer("foo", bar=1)
+    assert len(pending) == 1
+    await skipper.advance(1)
+    assert handler.call_count == 1
+    await skipper.advance(10)
+    assert handler.call_count == 2
+    await skipper.advance(20)
+    assert handler.call_count == 3
+    assert len(pending) == 0
+    handler.assert_called_with(bar=1)
+    while mock_journal.compact.call_args != asynctest.call([]):
+        await skipper.advance(0.01)
+    await pending.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_drops_ops_failing_for_other_reasons(
+        event_loop, mock_journal):
+    pending = pending_with(mock_journal, event_loop)
+    handler = asynctest.CoroutineMock(side_effect=BookkeepingError)
+    pending.add_handler("foo", handler)
+    await pending.start()
+
+    await pending.defer("foo", bar=1)
+    while len(pending) > 0:
+        await asyncio.sleep(0.01)
+    handler.assert_called_once_with(bar=1)
+    await pending.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_loads_journal_on_start(event_loop, mock_journal):
+    pending = pending_with(mock_journal, event_loop, lifetime=10 ** 12)
+    handler = asynctest.CoroutineMock()
+    pending.add_handler("foo", handler)
+    entries = [{"id": 1, "op": "foo", "args": {"bar": 1}, "created": 0},
+               {"id": 2, "op": "baz", "args": {}, "created": 0}]
+    mock_journal.load.return_value = entries
+    await pending.start()
+    await exhaust_callbacks(event_loop)
+    await asyncio.sleep(0.1)
+
+    handler.assert_awaited_once_with(bar=1)
+    mock_journal.compact.assert_any_call(entries)
+    await pending.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_pending_gives_up_on_old_ops(event_loop, mock_journal):
+    pending = pending_with(mock_journal, event_loop, lifetime=10)
+    handler = asynctest.CoroutineMock()
+    pending.add_handler("foo", handler)
+    mock_journal.load.return_value = [
+        {"id": 1, "op": "foo", "args": {}, "created": 0}]
+    await pending.start()
+    await asyncio.sleep(0.1)
+
+    handler.assert_not_awaited()
+    assert len(pending) == 0
+    await pending.stop()
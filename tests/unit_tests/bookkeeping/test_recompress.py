@@ -0,0 +1,110 @@
+import pytest
+import asynctest
+import asyncio
+from tests import timeout, TimeSkipper
+
+from replayserver.bookkeeping.recompress import IdleRecompressor
+from replayserver.errors import BookkeepingError
+
+
+@pytest.fixture
+def mock_journal():
+    class J:
+        def load():
+            pass
+
+        def compact():
+            pass
+
+        def add():
+            pass
+
+        def mark_done():
+            pass
+
+    next_id = 0
+
+    def add(op, args, created):
+        nonlocal next_id
+        next_id += 1
+        return {"id": next_id, "op": op, "args": args, "created": created}
+
+    journal = asynctest.Mock(spec=J)
+    journal.load.return_value = []
+    journal.add.side_effect = add
+    return journal
+
+
+@pytest.fixture
+def mock_saver():
+    class S:
+        async def recompress_replay():
+            pass
+
+        def compression_idle_time():
+            pass
+
+    saver = asynctest.Mock(spec=S, target_compression_level=19)
+    saver.compression_idle_time.return_value = 0
+    return saver
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_recompressor_ignores_replays_at_target_level(mock_journal,
+                                                            mock_saver):
+    recompressor = IdleRecompressor(mock_journal, mock_saver, 10)
+    await recompressor.replay_saved(1, 19)
+    mock_journal.add.assert_not_called()
+    assert len(recompressor) == 0
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_recompressor_waits_for_idle(event_loop, mock_journal,
+                                           mock_saver):
+    # Journal calls go to a thread, so only skip time while nothing's there.
+    skipper = TimeSkipper(event_loop)
+    mock_saver.compression_idle_time.side_effect = \
+        lambda: max(0, event_loop.time() - 15)
+
+    recompressor = IdleRecompressor(mock_journal, mock_saver, 10)
+    await recompressor.start()
+    await recompressor.replay_saved(1, 3)
+    mock_journal.add.assert_called_once_with("recompress", {"game_id": 1},
+                                             asynctest.ANY)
+    assert len(recompressor) == 1
+
+    await skipper.advance(20)
+    mock_saver.recompress_replay.assert_not_awaited()
+    await skipper.advance(10)
+    mock_saver.recompress_replay.assert_awaited_once_with(1)
+    assert len(recompressor) == 0
+    while mock_journal.compact.call_args != asynctest.call([]):
+        await skipper.advance(0.01)
+    await recompressor.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_recompressor_resumes_from_journal(mock_journal, mock_saver):
+    mock_saver.compression_idle_time.return_value = 100
+    mock_saver.recompress_replay.side_effect = [BookkeepingError, None]
+    entries = [{"id": 1, "op": "recompress", "args": {"game_id": 1},
+                "created": 0},
+               {"id": 2, "op": "recompress", "args": {"game_id": 2},
+                "created": 0}]
+    mock_journal.load.return_value = entries
+
+    recompressor = IdleRecompressor(mock_journal, mock_saver, 10)
+    await recompressor.start()
+    while mock_journal.compact.call_args != asynctest.call([]):
+        await asyncio.sleep(0.01)
+
+    mock_journal.compact.assert_any_call(entries)
+    # Some mock versions don't record awaits that raised.
+    mock_saver.recompress_replay.assert_has_calls(
+        [asynctest.call(1), asynctest.call(2)])
+    mock_journal.mark_done.assert_called_once_with(1)
+    assert len(recompressor) == 0
+    await recompressor.stop()
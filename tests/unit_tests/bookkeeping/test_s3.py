@@ -0,0 +1,257 @@
+import io
+import os
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from replayserver.bookkeeping.s3 import Retrying, MultipartUploadWriter, \
+    S3ReplayStore
+from replayserver.bookkeeping.storage import ReplayFilePaths, \
+    ReplayCompressor, CompressionLevelPolicy
+from replayserver.errors import BookkeepingError
+
+
+class ClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Client:
+    "In-memory stand-in for a boto3 S3 client."
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.calls = []
+        self.failures = {}
+
+    def _call(self, name):
+        self.calls.append(name)
+        if self.failures.get(name):
+            self.failures[name] -= 1
+            raise ClientError("500")
+
+    def put_object(self, Bucket, Key, Body):
+        self._call("put_object")
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def head_object(self, Bucket, Key):
+        self._call("head_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError("404")
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self._call("get_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError("NoSuchKey")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._call("create_multipart_upload")
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call("upload_part")
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"etag{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self._call("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        assert [p["ETag"] for p in MultipartUpload["Parts"]] == \
+            [f"etag{n}" for n in numbers]
+        self.objects[(Bucket, Key)] = b"".join(parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call("abort_multipart_upload")
+        self.uploads.pop(UploadId)
+        self.aborted.append(UploadId)
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(2)
+    yield executor
+    executor.shutdown()
+
+
+def no_retries():
+    return Retrying(0, 0, lambda t: None)
+
+
+def test_retrying_backs_off():
+    slept = []
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ClientError("500")
+        return "ok"
+
+    assert Retrying(3, 1, slept.append)("get", fn) == "ok"
+    assert slept == [1, 2]
+
+
+def test_retrying_gives_up():
+    def fn():
+        raise ClientError("500")
+
+    with pytest.raises(BookkeepingError):
+        Retrying(2, 1, lambda t: None)("get", fn)
+
+
+def test_retrying_does_not_retry_missing_objects():
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        raise ClientError("404")
+
+    with pytest.raises(ClientError):
+        Retrying(2, 1, lambda t: None)("head", fn)
+    assert len(attempts) == 1
+
+
+def test_retrying_rejects_negative_retries():
+    with pytest.raises(ValueError):
+        Retrying(-1, 1)
+
+
+def test_upload_writer_small_object(executor):
+    client = FakeS3Client()
+    writer = MultipartUploadWriter(client, "b", "k", 10, executor,
+                                   no_retries())
+    writer.write(b"foo")
+    writer.write(memoryview(b"bar"))
+    writer.close()
+    assert client.objects == {("b", "k"): b"foobar"}
+    assert client.calls == ["put_object"]
+
+
+def test_upload_writer_multipart(executor):
+    client = FakeS3Client()
+    writer = MultipartUploadWriter(client, "b", "k", 4, executor,
+                                   no_retries())
+    data = bytes(range(30))
+    for i in range(0, 30, 3):
+        writer.write(data[i:i + 3])
+    writer.close()
+    assert client.objects == {("b", "k"): data}
+    assert client.calls.count("upload_part") == 8
+    assert client.uploads == {}
+
+
+def test_upload_writer_retries_parts(executor):
+    client = FakeS3Client()
+    client.failures["upload_part"] = 2
+    writer = MultipartUploadWriter(client, "b", "k", 4, executor,
+                                   Retrying(2, 0, lambda t: None))
+    writer.write(bytes(10))
+    writer.close()
+    assert client.objects == {("b", "k"): bytes(10)}
+
+
+def test_upload_writer_abort(executor):
+    client = FakeS3Client()
+    writer = MultipartUploadWriter(client, "b", "k", 4, executor,
+                                   no_retries())
+    writer.write(bytes(10))
+    writer.abort()
+    assert client.objects == {}
+    assert client.aborted == ["0"]
+
+
+def test_upload_writer_backpressure_is_not_compression_time(executor):
+    class SlowClient(FakeS3Client):
+        def upload_part(self, *args, **kwargs):
+            time.sleep(0.05)
+            return super().upload_part(*args, **kwargs)
+
+    class Levels(CompressionLevelPolicy):
+        def record(self, level, size, elapsed):
+            recorded.append(elapsed)
+
+    recorded = []
+    client = SlowClient()
+    writer = MultipartUploadWriter(client, "b", "k", 64 * 1024, executor,
+                                   no_retries())
+    compressor = ReplayCompressor(Levels.fixed(1))
+    compressor.compress_to(writer, os.urandom(1024 * 1024), 1)
+    writer.close()
+    # Writes waited for several slow parts, compressing itself is quick.
+    assert client.calls.count("upload_part") > 10
+    assert recorded[0] < 0.05
+
+
+@pytest.fixture
+def s3_store(executor):
+    client = FakeS3Client()
+    store = S3ReplayStore(client, "bucket", ReplayFilePaths.build("replays"),
+                          4, executor, no_retries())
+    return client, store
+
+
+@pytest.mark.asyncio
+async def test_s3_replay_store_write_new(s3_store):
+    client, store = s3_store
+    key = "replays/0/0/0/12/1234.fafreplay"
+    assert store.location(1234) == f"s3://bucket/{key}"
+    assert await store.write_new(1234, lambda f: f.write(b"foobar")) == 6
+    assert client.objects == {("bucket", key): b"foobar"}
+
+    with pytest.raises(BookkeepingError):
+        await store.write_new(1234, lambda f: f.write(b"baz"))
+    assert client.uploads == {}
+
+
+@pytest.mark.asyncio
+async def test_s3_replay_store_aborts_failed_write(s3_store):
+    client, store = s3_store
+
+    def write(f):
+        f.write(bytes(10))
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await store.write_new(1, write)
+    assert client.objects == {}
+    assert client.aborted == ["0"]
+
+
+@pytest.mark.asyncio
+async def test_s3_replay_store_rewrite(s3_store):
+    client, store = s3_store
+    with pytest.raises(BookkeepingError):
+        await store.rewrite(1, lambda src, dst: dst.write(b"foo"))
+
+    await store.write_new(1, lambda f: f.write(b"foo"))
+    assert await store.rewrite(1, lambda src, dst: None) is None
+    await store.rewrite(1, lambda src, dst: dst.write(src.read() + b"bar"))
+    assert list(client.objects.values()) == [b"foobar"]
+
+
+@pytest.mark.asyncio
+async def test_s3_replay_store_with_moto(executor):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    with moto.mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        # S3 doesn't accept parts smaller than 5MiB
+        store = S3ReplayStore(client, "bucket",
+                              ReplayFilePaths.build("replays"),
+                              5 * 1024 * 1024, executor, no_retries())
+        data = bytes(range(256)) * 50000
+        await store.write_new(1, lambda f: f.write(data))
+        await store.rewrite(1, lambda src, dst: dst.write(src.read()[::-1]))
+        response = client.get_object(Bucket="bucket",
+                                     Key="replays/0/0/0/0/1.fafreplay")
+        assert response["Body"].read() == data[::-1]
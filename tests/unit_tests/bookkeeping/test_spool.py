@@ -0,0 +1,191 @@
+import pytest
+import asynctest
+import asyncio
+import os
+from tests import timeout
+from tests.replays import example_replay
+
+from replayserver.bookkeeping.spool import ReplaySpool, SpoolingBookkeeper, \
+    BookkeepingWorker
+from replayserver.errors import BookkeepingError
+
+
+def set_example_stream_data(stream, mock_replay_headers):
+    stream.set_header(mock_replay_headers(example_replay))
+    stream.feed_data(b"bar")
+    stream.finish()
+
+
+@pytest.mark.asyncio
+async def test_spool_round_trip(tmpdir, outside_source_stream,
+                                mock_replay_headers):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    spool = ReplaySpool(str(tmpdir))
+    await spool.put(1111, outside_source_stream)
+    assert await spool.ready() == [1111]
+
+    stream = await spool.load(1111)
+    assert stream.ended()
+    assert stream.header.data == example_replay.header_data
+    assert stream.header.struct == example_replay.header
+    assert stream.data.bytes() == b"bar"
+
+    await spool.remove(1111)
+    assert await spool.ready() == []
+
+
+@pytest.mark.asyncio
+async def test_spool_replay_without_header(tmpdir, outside_source_stream):
+    outside_source_stream.finish()
+    spool = ReplaySpool(str(tmpdir))
+    await spool.put(1, outside_source_stream)
+    stream = await spool.load(1)
+    assert stream.header is None
+    assert stream.data.bytes() == b""
+
+
+@pytest.mark.asyncio
+async def test_spool_ignores_other_files(tmpdir):
+    for name in ["2.replay", "10.replay", "3.replay.tmp", "4.replay.broken",
+                 "foo.replay"]:
+        tmpdir.join(name).write("")
+    spool = ReplaySpool(str(tmpdir))
+    assert await spool.ready() == [2, 10]
+
+    bookkeeper = SpoolingBookkeeper(spool)
+    await bookkeeper.start()
+    assert not tmpdir.join("3.replay.tmp").exists()
+
+
+@pytest.mark.asyncio
+async def test_spooling_bookkeeper_logs_errors(tmpdir, outside_source_stream,
+                                               mock_replay_headers):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    bookkeeper = SpoolingBookkeeper(ReplaySpool(str(tmpdir.join("nope"))))
+    await bookkeeper.save_replay(1, outside_source_stream)
+
+
+@pytest.fixture
+def mock_bookkeeper():
+    class B:
+        async def start():
+            pass
+
+        async def stop():
+            pass
+
+        async def save_replay():
+            pass
+
+    return asynctest.Mock(spec=B)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_worker_saves_spooled_replays(tmpdir, outside_source_stream,
+                                            mock_replay_headers,
+                                            mock_bookkeeper):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    spool = ReplaySpool(str(tmpdir))
+    await spool.put(1, outside_source_stream)
+    await spool.put(2, outside_source_stream)
+    tmpdir.join("3.replay").write("garbage")
+    mock_bookkeeper.save_replay.side_effect = [BookkeepingError, None]
+
+    worker = BookkeepingWorker(spool, mock_bookkeeper, 0.01, 1)
+    await worker.start()
+    while await spool.ready():
+        await asyncio.sleep(0.01)
+    await worker.stop()
+
+    # Some mock versions don't record awaits that raised, so check calls.
+    saved = {c[0][0]: c[0][1]
+             for c in mock_bookkeeper.save_replay.call_args_list}
+    assert saved.keys() == {1, 2}
+    for stream in saved.values():
+        assert stream.data.bytes() == b"bar"
+    assert tmpdir.join("3.replay.broken").exists()
+    mock_bookkeeper.start.assert_awaited_once()
+    mock_bookkeeper.stop.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_worker_stop_waits_for_saves(tmpdir, outside_source_stream,
+                                           mock_replay_headers,
+                                           mock_bookkeeper):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    spool = ReplaySpool(str(tmpdir))
+    await spool.put(1, outside_source_stream)
+    saving = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def save_replay(game_id, stream):
+        saving.set()
+        await finish.wait()
+
+    mock_bookkeeper.save_replay.side_effect = save_replay
+    worker = BookkeepingWorker(spool, mock_bookkeeper, 0.01, 1)
+    await worker.start()
+    await saving.wait()
+    stopping = asyncio.ensure_future(worker.stop())
+    await asyncio.sleep(0.05)
+    assert not stopping.done()
+    finish.set()
+    await stopping
+    assert await spool.ready() == []
+
+
+@pytest.mark.asyncio
+async def test_spool_claims(tmpdir, outside_source_stream,
+                            mock_replay_headers):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    spool = ReplaySpool(str(tmpdir))
+    await spool.put(1, outside_source_stream)
+    assert await spool.claim(1)
+    assert not await spool.claim(1)
+    assert await spool.ready() == []
+    assert (await spool.load(1, claimed=True)).data.bytes() == b"bar"
+
+    # Claims of processes that are gone are given back
+    tmpdir.join(f"2.{2 ** 22 + 1}.claimed").write("")
+    await spool.put(3, outside_source_stream)
+    await spool.claim(3)
+    spool.release_stale_claims()
+    assert await spool.ready() == [2]
+    await spool.remove(3, claimed=True)
+    assert sorted(os.listdir(str(tmpdir))) == [
+        f"1.{os.getpid()}.claimed", "2.replay"]
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_workers_share_spool(tmpdir, outside_source_stream,
+                                   mock_replay_headers):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    spool = ReplaySpool(str(tmpdir))
+    for game_id in range(10):
+        await spool.put(game_id, outside_source_stream)
+
+    class B:
+        async def start():
+            pass
+
+        async def stop():
+            pass
+
+        async def save_replay():
+            pass
+
+    bookkeepers = [asynctest.Mock(spec=B) for _ in range(2)]
+    workers = [BookkeepingWorker(spool, b, 0.01, 3) for b in bookkeepers]
+    for worker in workers:
+        await worker.start()
+    while os.listdir(str(tmpdir)):
+        await asyncio.sleep(0.01)
+    for worker in workers:
+        await worker.stop()
+
+    saved = [c[0][0] for b in bookkeepers
+             for c in b.save_replay.call_args_list]
+    assert sorted(saved) == list(range(10))
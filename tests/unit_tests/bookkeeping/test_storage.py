@@ -2,34 +2,50 @@ import pytest
 import asynctest
 import datetime
 import os
-import stat
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import struct
+import threading
+import time
+import zlib
+import zstandard as zstd
+
+from tests.replays import example_replay, diverging_1, unpack_replay_format_2
+from replayserver.bookkeeping.index import VaultIndex
+from replayserver.bookkeeping.storage import ReplayFilePaths, ReplaySaver, \
+    DirectoryCache, ReplayCommitter, ReplayCompressor, read_replay, \
+    CompressionLevelPolicy, LocalReplayStore
+from replayserver.errors import BookkeepingError, DatabaseUnavailableError
 
-from tests.replays import example_replay, unpack_replay_format_2
-from replayserver.bookkeeping.storage import ReplayFilePaths, ReplaySaver
-from replayserver.errors import BookkeepingError
 
-
-def test_replay_paths(tmpdir):
-    paths = ReplayFilePaths(str(tmpdir))
-    rpath = paths.get(1123456789)
+@pytest.mark.asyncio
+async def test_replay_paths(tmpdir):
+    paths = ReplayFilePaths.build(str(tmpdir))
+    tmp_path, rpath = await paths.get(1123456789)
     expected = tmpdir.join("11", "23", "45", "67",
                            "1123456789.fafreplay")
     assert rpath == str(expected)
-    assert expected.exists()
+    assert not expected.exists()
+    assert os.path.dirname(tmp_path) == os.path.dirname(rpath)
+    assert os.path.exists(tmp_path)
 
 
-def test_replay_paths_odd_ids(tmpdir):
-    paths = ReplayFilePaths(str(tmpdir))
+@pytest.mark.asyncio
+async def test_replay_paths_odd_ids(tmpdir):
+    paths = ReplayFilePaths.build(str(tmpdir))
 
-    rpath = paths.get(12345)
+    _, rpath = await paths.get(12345)
     assert rpath == str(tmpdir.join("0", "0", "1", "23",
                                     "12345.fafreplay"))
 
-    rpath = paths.get(0)
+    _, rpath = await paths.get(0)
     assert rpath == str(tmpdir.join("0", "0", "0", "0",
                                     "0.fafreplay"))
 
-    rpath = paths.get(101010101)
+    _, rpath = await paths.get(101010101)
     assert rpath == str(tmpdir.join("1", "1", "1", "1",
                                     "101010101.fafreplay"))
 
@@ -37,31 +53,66 @@ def test_replay_paths_odd_ids(tmpdir):
     # But I imagine same legacy code is used everywhere, so let's keep that
     # broken behaviour.
     # We didn't even break 8 digits yet anyway.
-    rpath = paths.get(111122223333)
+    _, rpath = await paths.get(111122223333)
     assert rpath == str(tmpdir.join("11", "22", "22", "33",
                                     "111122223333.fafreplay"))
 
 
-def test_replay_paths_same_folder(tmpdir):
-    paths = ReplayFilePaths(str(tmpdir))
-    paths.get(11111111)
-    paths.get(11111112)
-    assert tmpdir.join("0", "11", "11", "11", "11111111.fafreplay").exists()
-    assert tmpdir.join("0", "11", "11", "11", "11111112.fafreplay").exists()
+@pytest.mark.asyncio
+async def test_replay_paths_same_folder(tmpdir):
+    paths = ReplayFilePaths.build(str(tmpdir))
+    tmp1, rpath1 = await paths.get(11111111)
+    tmp2, rpath2 = await paths.get(11111112)
+    assert tmp1 != tmp2
+    assert os.path.dirname(rpath1) == os.path.dirname(rpath2)
 
 
-def test_replay_paths_second_access_not_allowed(tmpdir):
-    # We should not allow getting the same path twice to avoid overwriting or
-    # corrupting the existing replay
-    paths = ReplayFilePaths(str(tmpdir))
-    paths.get(1123456789)
+@pytest.mark.asyncio
+async def test_replay_paths_existing_replay_not_allowed(tmpdir):
+    # We should not allow getting the path of an existing replay to avoid
+    # overwriting or corrupting it
+    paths = ReplayFilePaths.build(str(tmpdir))
+    _, rpath = await paths.get(1123456789)
+    open(rpath, "a").close()
     with pytest.raises(BookkeepingError):
-        paths.get(1123456789)
+        await paths.get(1123456789)
+
+
+@pytest.mark.asyncio
+async def test_replay_paths_directory_removed(tmpdir):
+    paths = ReplayFilePaths.build(str(tmpdir))
+    await paths.get(11111111)
+    tmpdir.join("0").remove()
+    tmp_path, _ = await paths.get(11111112)
+    assert os.path.exists(tmp_path)
+
+
+def test_directory_cache_is_bounded():
+    cache = DirectoryCache(2)
+    cache.add("a")
+    cache.add("b")
+    assert "a" in cache
+    cache.add("c")
+    # "a" was used recently
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    cache.discard("c")
+    assert "c" not in cache
+
+
+def test_replay_paths_replay_file_creates_nothing(tmpdir):
+    paths = ReplayFilePaths.build(str(tmpdir))
+    rpath = paths.replay_file(1123456789)
+    expected = tmpdir.join("11", "23", "45", "67", "1123456789.fafreplay")
+    assert rpath == str(expected)
+    assert not tmpdir.join("11").exists()
 
 
 @pytest.fixture
 def mock_replay_paths():
-    return asynctest.Mock(spec=['get'])
+    return asynctest.Mock(spec=['get', 'replay_file'],
+                          get=asynctest.CoroutineMock())
 
 
 @pytest.fixture
@@ -94,15 +145,21 @@ def_game_stats = {
 def_mod_versions = {'1': 1}
 
 
+def fixed_compressor(level, dictionary=None):
+    return ReplayCompressor(CompressionLevelPolicy.fixed(level), dictionary)
+
+
 @pytest.fixture
 def standard_saver_args(mock_replay_paths, mock_database_queries, tmpdir):
     rfile = str(tmpdir.join("replay"))
-    open(rfile, "a").close()
-    mock_replay_paths.get.return_value = rfile
+    tmp_file = str(tmpdir.join(".replay.tmp"))
+    open(tmp_file, "a").close()
+    mock_replay_paths.get.return_value = (tmp_file, rfile)
     mock_database_queries.get_teams_in_game.return_value = def_teams_in_game
     mock_database_queries.get_game_stats.return_value = def_game_stats
     mock_database_queries.get_mod_versions.return_value = def_mod_versions
-    return mock_replay_paths, mock_database_queries
+    return (LocalReplayStore(mock_replay_paths, ReplayCommitter(0)),
+            fixed_compressor(19), mock_database_queries)
 
 
 def set_example_stream_data(outside_source_stream, mock_replay_headers):
@@ -144,25 +201,43 @@ async def test_replay_saver_no_header(standard_saver_args,
 
 
 @pytest.mark.asyncio
-async def test_replay_saver_readonly_file(standard_saver_args,
-                                          mock_replay_headers,
-                                          outside_source_stream, tmpdir):
+async def test_replay_saver_unwritable_file(standard_saver_args,
+                                            mock_replay_paths,
+                                            mock_replay_headers,
+                                            outside_source_stream, tmpdir):
     set_example_stream_data(outside_source_stream, mock_replay_headers)
 
-    rfile = str(tmpdir.join("replay"))
-    os.chmod(rfile, stat.S_IRUSR)
+    mock_replay_paths.get.return_value = (
+        str(tmpdir.join("nope", "replay.tmp")),
+        str(tmpdir.join("nope", "replay")))
 
     saver = ReplaySaver(*standard_saver_args)
     with pytest.raises(BookkeepingError):
         await saver.save_replay(1111, outside_source_stream)
 
 
+@pytest.mark.asyncio
+async def test_replay_saver_does_not_overwrite(standard_saver_args,
+                                               mock_replay_headers,
+                                               outside_source_stream,
+                                               tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    rfile = tmpdir.join("replay")
+    rfile.write(b"foo")
+
+    saver = ReplaySaver(*standard_saver_args)
+    with pytest.raises(BookkeepingError):
+        await saver.save_replay(1111, outside_source_stream)
+    assert rfile.read() == "foo"
+    assert not tmpdir.join(".replay.tmp").exists()
+
+
 @pytest.mark.asyncio
 async def test_replay_saver_null_team(standard_saver_args,
                                       mock_replay_headers,
                                       outside_source_stream, tmpdir):
     set_example_stream_data(outside_source_stream, mock_replay_headers)
-    mock_queries = standard_saver_args[1]
+    mock_queries = standard_saver_args[2]
     mock_queries.get_teams_in_game.return_value = {
         1: ["user1"], 2: ["user2"], None: ["SomeGuy"]
     }
@@ -172,3 +247,429 @@ async def test_replay_saver_null_team(standard_saver_args,
     rfile = str(tmpdir.join("replay"))
     head, rep = unpack_replay_format_2(open(rfile, "rb").read())
     assert head["teams"]["null"] == ["SomeGuy"]
+
+
+@pytest.fixture
+def mock_pending():
+    class P:
+        async def attempt():
+            pass
+
+        async def defer():
+            pass
+
+    async def attempt(fn):
+        return await fn()
+
+    return asynctest.Mock(spec=P, attempt=asynctest.CoroutineMock(
+        side_effect=attempt))
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_defers_info_when_db_fails(standard_saver_args,
+                                                      mock_replay_headers,
+                                                      mock_pending,
+                                                      outside_source_stream,
+                                                      tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    mock_queries = standard_saver_args[2]
+    mock_queries.get_game_stats.side_effect = DatabaseUnavailableError
+
+    saver = ReplaySaver(*standard_saver_args, mock_pending)
+    await saver.save_replay(1111, outside_source_stream)
+    mock_pending.defer.assert_awaited_once_with("replay_info", game_id=1111)
+
+    rfile = str(tmpdir.join("replay"))
+    head, rep = unpack_replay_format_2(open(rfile, "rb").read())
+    assert head['uid'] == 1111
+    assert 'teams' not in head
+    assert rep == example_replay.header_data + b"bar"
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_fails_without_game_stats(standard_saver_args,
+                                                     mock_replay_headers,
+                                                     mock_pending,
+                                                     outside_source_stream,
+                                                     tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    mock_queries = standard_saver_args[2]
+    mock_queries.get_game_stats.side_effect = BookkeepingError
+
+    # Database is fine, it just doesn't know the game. Don't retry.
+    saver = ReplaySaver(*standard_saver_args, mock_pending)
+    with pytest.raises(BookkeepingError):
+        await saver.save_replay(1111, outside_source_stream)
+    mock_pending.defer.assert_not_awaited()
+    assert not tmpdir.join("replay").exists()
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_update_replay_info(standard_saver_args,
+                                               mock_replay_paths,
+                                               mock_replay_headers,
+                                               mock_pending,
+                                               outside_source_stream,
+                                               tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    _, _, mock_queries = standard_saver_args
+    mock_queries.get_game_stats.side_effect = [
+        DatabaseUnavailableError, def_game_stats]
+    mock_replay_paths.replay_file.return_value = str(tmpdir.join("replay"))
+
+    saver = ReplaySaver(*standard_saver_args, mock_pending)
+    await saver.save_replay(1111, outside_source_stream)
+    await saver.update_replay_info(1111)
+
+    rfile = str(tmpdir.join("replay"))
+    head, rep = unpack_replay_format_2(open(rfile, "rb").read())
+    assert head['teams'] == {"1": ["user1"], "2": ["user2"]}
+    assert head['featured_mod_versions'] == def_mod_versions
+    assert rep == example_replay.header_data + b"bar"
+
+
+def example_dictionary():
+    samples = [bytes(r.data) for r in diverging_1 + [example_replay]] * 4
+    return zstd.train_dictionary(8192, samples)
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_with_dictionary(standard_saver_args,
+                                            mock_replay_headers,
+                                            outside_source_stream, tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    dictionary = example_dictionary()
+    store, _, queries = standard_saver_args
+
+    saver = ReplaySaver(store, fixed_compressor(3, dictionary),
+                        queries)
+    await saver.save_replay(1111, outside_source_stream)
+
+    rfile = str(tmpdir.join("replay"))
+    with pytest.raises(BookkeepingError):
+        read_replay(rfile)
+    head, rep = read_replay(rfile, {dictionary.dict_id(): dictionary})
+    assert head['compression_dictionary'] == dictionary.dict_id()
+    assert rep == example_replay.header_data + b"bar"
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_update_keeps_compression(standard_saver_args,
+                                                     mock_replay_paths,
+                                                     mock_replay_headers,
+                                                     mock_pending,
+                                                     outside_source_stream,
+                                                     tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    dictionary = example_dictionary()
+    store, _, queries = standard_saver_args
+    queries.get_game_stats.side_effect = [DatabaseUnavailableError,
+                                          def_game_stats]
+    mock_replay_paths.replay_file.return_value = str(tmpdir.join("replay"))
+
+    saver = ReplaySaver(store, fixed_compressor(3, dictionary),
+                        queries, mock_pending)
+    await saver.save_replay(1111, outside_source_stream)
+    # Changing compression settings shouldn't affect replays already saved
+    saver = ReplaySaver(store, fixed_compressor(3), queries,
+                        mock_pending)
+    await saver.update_replay_info(1111)
+
+    rfile = str(tmpdir.join("replay"))
+    head, rep = read_replay(rfile, {dictionary.dict_id(): dictionary})
+    assert head['compression_dictionary'] == dictionary.dict_id()
+    assert head['teams'] == {"1": ["user1"], "2": ["user2"]}
+    assert rep == example_replay.header_data + b"bar"
+
+
+def test_compression_level_policy_backs_off():
+    levels = CompressionLevelPolicy(9, 12, 10, lambda: 0)
+    assert levels.choose() == 12
+    # Slowly approaches measured values
+    for i in range(100):
+        levels.record(12, 2 ** 20, 1)
+        levels.record(11, 3 * 2 ** 20, 1)
+        levels.record(10, 10 * 2 ** 20, 1)
+
+    levels.queue(5 * 2 ** 20)
+    assert levels.choose() == 12
+    levels.queue(20 * 2 ** 20)
+    assert levels.choose() == 11
+    levels.queue(50 * 2 ** 20)
+    assert levels.choose() == 10
+    levels.queue(2 ** 40)
+    assert levels.choose() == 9
+
+
+def test_compression_level_policy_idle_time():
+    now = 0
+    levels = CompressionLevelPolicy(3, 19, 10, lambda: now)
+    now = 10
+    assert levels.idle_time() == 10
+    levels.queue(100)
+    now = 20
+    assert levels.idle_time() == 0
+    levels.unqueue(100)
+    now = 25
+    assert levels.idle_time() == 5
+
+
+def test_compressor_measures_only_compression():
+    class Levels(CompressionLevelPolicy):
+        def record(self, level, size, elapsed):
+            recorded.append(elapsed)
+
+    class SlowFile(io.BytesIO):
+        def write(self, data):
+            time.sleep(0.1)
+            return super().write(data)
+
+    recorded = []
+    compressor = ReplayCompressor(Levels.fixed(3))
+    out = SlowFile()
+    data = b"foo" * 2 ** 20
+    compressor.compress_to(out, data, 3)
+    assert zstd.ZstdDecompressor().decompress(out.getvalue()) == data
+    # Slow storage shouldn't make us lower the compression level.
+    assert len(recorded) == 1
+    assert recorded[0] < 0.1
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_adapts_level(standard_saver_args,
+                                         mock_replay_headers,
+                                         outside_source_stream, tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    store, _, queries = standard_saver_args
+    levels = CompressionLevelPolicy(3, 19, 10, lambda: 0)
+    levels.queue(2 ** 40)
+
+    saver = ReplaySaver(store, ReplayCompressor(levels), queries)
+    entry = await saver.save_replay(1111, outside_source_stream)
+    assert entry["compression_level"] == 3
+    assert entry["data_size"] == len(example_replay.header_data) + 3
+    head, rep = read_replay(str(tmpdir.join("replay")))
+    assert head['compression_level'] == 3
+    assert rep == example_replay.header_data + b"bar"
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_recompress_replay(standard_saver_args,
+                                              mock_replay_paths,
+                                              mock_replay_headers,
+                                              outside_source_stream, tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    store, _, queries = standard_saver_args
+    mock_replay_paths.replay_file.return_value = str(tmpdir.join("replay"))
+    rfile = str(tmpdir.join("replay"))
+
+    saver = ReplaySaver(store, fixed_compressor(1), queries)
+    await saver.save_replay(1111, outside_source_stream)
+    saver = ReplaySaver(store, fixed_compressor(19), queries)
+    await saver.recompress_replay(1111)
+
+    head, rep = read_replay(rfile)
+    assert head['compression_level'] == 19
+    assert head['teams'] == {"1": ["user1"], "2": ["user2"]}
+    assert rep == example_replay.header_data + b"bar"
+    # Replays already at target level are left alone
+    mtime = os.stat(rfile).st_mtime_ns
+    await saver.recompress_replay(1111)
+    assert os.stat(rfile).st_mtime_ns == mtime
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_updates_index_on_rewrite(standard_saver_args,
+                                                     mock_replay_paths,
+                                                     mock_replay_headers,
+                                                     mock_pending,
+                                                     outside_source_stream,
+                                                     tmpdir):
+    set_example_stream_data(outside_source_stream, mock_replay_headers)
+    store, _, queries = standard_saver_args
+    queries.get_game_stats.side_effect = [DatabaseUnavailableError,
+                                          def_game_stats]
+    rfile = str(tmpdir.join("replay"))
+    mock_replay_paths.replay_file.return_value = rfile
+    index = VaultIndex(str(tmpdir.join("index")))
+
+    saver = ReplaySaver(store, fixed_compressor(1), queries,
+                        mock_pending, index)
+    entry = await saver.save_replay(1111, outside_source_stream)
+    # Saving doesn't index, bookkeeper does it once it knows ticks
+    assert index.get(1111) is None
+    index.put(dict(entry, ticks=10))
+    assert index.get(1111)["mapname"] is None
+
+    await saver.update_replay_info(1111)
+    indexed = index.get(1111)
+    assert indexed["mapname"] == def_game_stats["mapname"]
+    assert indexed["ticks"] == 10
+    assert indexed["file_size"] == os.stat(rfile).st_size
+
+    saver = ReplaySaver(store, fixed_compressor(19), queries,
+                        mock_pending, index)
+    await saver.recompress_replay(1111)
+    indexed = index.get(1111)
+    assert indexed["compression_level"] == 19
+    assert indexed["file_size"] == os.stat(rfile).st_size
+    with open(rfile, "rb") as f:
+        assert indexed["checksum"] == hashlib.sha256(f.read()).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_replay_saver_recompress_broken_replay(standard_saver_args,
+                                                     mock_replay_paths,
+                                                     tmpdir):
+    store, _, queries = standard_saver_args
+    rfile = tmpdir.join("replay")
+    rfile.write(b'{"compression": "zstd", "compression_level": 1}\nfoo')
+    mock_replay_paths.replay_file.return_value = str(rfile)
+
+    saver = ReplaySaver(store, fixed_compressor(19), queries)
+    with pytest.raises(BookkeepingError):
+        await saver.recompress_replay(1111)
+
+
+def test_read_replay_legacy_format(tmpdir):
+    data = example_replay.data
+    qcompressed = struct.pack(">i", len(data)) + zlib.compress(data)
+    rfile = tmpdir.join("replay")
+    rfile.write(json.dumps({"uid": 1}).encode() + b"\n" +
+                base64.encodebytes(qcompressed), mode="wb")
+
+    head, rep = read_replay(str(rfile))
+    assert head == {"uid": 1}
+    assert rep == data
+
+
+def test_replay_paths_all_replay_files(tmpdir):
+    paths = ReplayFilePaths.build(str(tmpdir))
+    for path in [paths.replay_file(1), paths.replay_file(1234567)]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+    open(os.path.join(str(tmpdir), ".pending_bookkeeping"), "w").close()
+
+    assert sorted(paths.all_replay_files()) == sorted(
+        [paths.replay_file(1), paths.replay_file(1234567)])
+
+
+@pytest.mark.asyncio
+async def test_replay_committer_moves_files(tmpdir):
+    committer = ReplayCommitter(0)
+    tmp_file = tmpdir.join("replay.tmp")
+    tmp_file.write(b"foo")
+    await committer.commit(str(tmp_file), str(tmpdir.join("replay")))
+    assert not tmp_file.exists()
+    assert tmpdir.join("replay").read() == "foo"
+
+
+@pytest.mark.asyncio
+async def test_replay_committer_replace(tmpdir):
+    committer = ReplayCommitter(0)
+    tmpdir.join("replay").write(b"foo")
+    tmp_file = tmpdir.join("replay.tmp")
+    tmp_file.write(b"bar")
+    await committer.commit(str(tmp_file), str(tmpdir.join("replay")),
+                           replace=True)
+    assert tmpdir.join("replay").read() == "bar"
+
+
+@pytest.mark.asyncio
+async def test_replay_committer_batches_commits(tmpdir, mocker):
+    committer = ReplayCommitter(0.01)
+    sync = mocker.spy(committer, "_sync_batch")
+    commits = []
+    for i in range(5):
+        tmp_file = tmpdir.join(f"{i}.tmp")
+        tmp_file.write(b"foo")
+        commits.append(committer.commit(str(tmp_file),
+                                        str(tmpdir.join(str(i)))))
+    await asyncio.gather(*commits)
+    assert sync.call_count == 1
+    for i in range(5):
+        assert tmpdir.join(str(i)).exists()
+
+
+@pytest.mark.asyncio
+async def test_replay_committer_fails_individual_commits(tmpdir):
+    committer = ReplayCommitter(0.01)
+    tmpdir.join("1").write(b"foo")
+    for i in range(2):
+        tmpdir.join(f"{i}.tmp").write(b"bar")
+    ok = committer.commit(str(tmpdir.join("0.tmp")), str(tmpdir.join("0")))
+    bad = committer.commit(str(tmpdir.join("1.tmp")), str(tmpdir.join("1")))
+    results = await asyncio.gather(ok, bad, return_exceptions=True)
+    assert results[0] is None
+    assert isinstance(results[1], BookkeepingError)
+    assert tmpdir.join("0").read() == "bar"
+    assert tmpdir.join("1").read() == "foo"
+
+
+@pytest.mark.asyncio
+async def test_replay_committer_ignores_directory_sync_failure(tmpdir,
+                                                               mocker):
+    def sync_file(path):
+        if os.path.isdir(path):
+            raise OSError
+
+    mocker.patch("replayserver.bookkeeping.storage.sync_file", sync_file)
+    committer = ReplayCommitter(0)
+    tmpdir.join("replay.tmp").write(b"foo")
+    await committer.commit(str(tmpdir.join("replay.tmp")),
+                           str(tmpdir.join("replay")))
+    assert tmpdir.join("replay").read() == "foo"
+
+
+@pytest.mark.asyncio
+async def test_local_replay_store_write_new(tmpdir):
+    store = LocalReplayStore(ReplayFilePaths.build(str(tmpdir)),
+                             ReplayCommitter(0))
+    assert await store.write_new(1, lambda f: f.write(b"foo")) == 3
+    with open(store.location(1), "rb") as f:
+        assert f.read() == b"foo"
+    with pytest.raises(BookkeepingError):
+        await store.write_new(1, lambda f: f.write(b"bar"))
+
+
+@pytest.mark.asyncio
+async def test_local_replay_store_rewrite(tmpdir):
+    store = LocalReplayStore(ReplayFilePaths.build(str(tmpdir)),
+                             ReplayCommitter(0))
+    await store.write_new(1, lambda f: f.write(b"foo"))
+
+    def fail(src, dst):
+        dst.write(b"partial")
+        raise IOError
+
+    with pytest.raises(IOError):
+        await store.rewrite(1, fail)
+    assert await store.rewrite(1, lambda src, dst: None) is None
+    with open(store.location(1), "rb") as f:
+        assert f.read() == b"foo"
+
+    await store.rewrite(1, lambda src, dst: dst.write(src.read() + b"bar"))
+    with open(store.location(1), "rb") as f:
+        assert f.read() == b"foobar"
+    assert os.listdir(os.path.dirname(store.location(1))) == ["1.fafreplay"]
+
+
+@pytest.mark.asyncio
+async def test_local_replay_store_concurrent_rewrites(tmpdir):
+    store = LocalReplayStore(ReplayFilePaths.build(str(tmpdir)),
+                             ReplayCommitter(0))
+    await store.write_new(1, lambda f: f.write(b"foo"))
+    both_writing = threading.Barrier(2, timeout=1)
+
+    def rewrite_with(data):
+        def rewrite(src, dst):
+            dst.write(data)
+            both_writing.wait()
+            return True
+        return rewrite
+
+    await asyncio.gather(store.rewrite(1, rewrite_with(b"bar")),
+                         store.rewrite(1, rewrite_with(b"baz")))
+    with open(store.location(1), "rb") as f:
+        assert f.read() in [b"bar", b"baz"]
+    assert os.listdir(os.path.dirname(store.location(1))) == ["1.fafreplay"]
@@ -0,0 +1,31 @@
+import asynctest
+
+from replayserver.receive.cutoff import AdaptiveCutoff
+from replayserver.streams import MemoryBudget
+
+
+def mock_budget(pressure):
+    budget = asynctest.Mock(spec=MemoryBudget)
+    budget.pressure.return_value = pressure
+    return budget
+
+
+def test_adaptive_cutoff_follows_pressure():
+    cutoff = AdaptiveCutoff(mock_budget(0), 1000, 5000)
+    assert cutoff.for_writers(2) == 5000
+    cutoff = AdaptiveCutoff(mock_budget(0.5), 1000, 5000)
+    assert cutoff.for_writers(2) == 3000
+    cutoff = AdaptiveCutoff(mock_budget(1), 1000, 5000)
+    assert cutoff.for_writers(2) == 1000
+
+
+def test_adaptive_cutoff_shrinks_with_writers():
+    cutoff = AdaptiveCutoff(mock_budget(0), 1000, 5000)
+    assert cutoff.for_writers(1) == 5000
+    assert cutoff.for_writers(4) == 3000
+    assert cutoff.for_writers(8) == 2000
+
+
+def test_adaptive_cutoff_min_not_above_max():
+    cutoff = AdaptiveCutoff(mock_budget(1), 6000, 5000)
+    assert cutoff.for_writers(2) == 5000
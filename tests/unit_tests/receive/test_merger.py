@@ -2,9 +2,10 @@ import pytest
 import asyncio
 import asynctest
 from asynctest.helpers import exhaust_callbacks
-from tests import timeout
+from tests import timeout, fast_forward_time
 
 from replayserver.receive.merger import Merger, ReplayStreamReader
+from replayserver.streams import OutsideSourceReplayStream
 from replayserver.errors import CannotAcceptConnectionError, \
     BadConnectionError, MalformedDataError
 
@@ -18,12 +19,15 @@ def mock_header_read():
 def mock_merge_strategy(mocker):
     # A little unspoken assumption that merger only uses these methods.
     class S:
-        async def track_stream():
+        def track_stream():
             pass
 
         def finalize():
             pass
 
+        def set_cmp_cutoff():
+            pass
+
     return asynctest.Mock(spec=S)
 
 
@@ -36,7 +40,11 @@ def mock_readers():
             pass
 
     def build():
-        return asynctest.Mock(spec=R)
+        reader = asynctest.Mock(spec=R)
+        reader.stream = OutsideSourceReplayStream()
+        # Like the real reader, always finish the stream
+        reader.read.side_effect = reader.stream.finish
+        return reader
 
     return build
 
@@ -153,7 +161,8 @@ async def test_merger_one_connection_lifetime(outside_source_stream,
     await merger.handle_connection(connection)
 
     reader.read.assert_awaited()
-    mock_merge_strategy.track_stream.assert_awaited_with(reader.stream)
+    mock_merge_strategy.track_stream.assert_called_with(reader.stream)
+    assert merger.writer_memory() == [reader.stream.memory()]
 
     merger.stop_accepting_connections()
     await merger.wait_for_ended()
@@ -171,14 +180,19 @@ async def test_merger_read_exception(outside_source_stream,
     canonical_stream = outside_source_stream
     reader = mock_readers()
     mock_reader_builder.side_effect = [reader]
-    reader.read.side_effect = BadConnectionError
+
+    def read():
+        reader.stream.finish()
+        raise BadConnectionError
+
+    reader.read.side_effect = read
 
     merger = Merger(mock_reader_builder, mock_delayed_stream_builder,
                     mock_merge_strategy, canonical_stream)
     with pytest.raises(BadConnectionError):
         await merger.handle_connection(connection)
 
-    mock_merge_strategy.track_stream.assert_awaited_with(reader.stream)
+    mock_merge_strategy.track_stream.assert_called_with(reader.stream)
     merger.stop_accepting_connections()
     await merger.wait_for_ended()
 
@@ -242,7 +256,7 @@ async def test_merger_no_connection_wait_active_connection(
 
     async def long_read():
         await asyncio.sleep(0.05)
-        return
+        reader.stream.finish()
 
     reader.read.side_effect = long_read
 
@@ -264,3 +278,29 @@ async def test_merger_no_connection_wait_active_connection(
 
     merger.stop_accepting_connections()
     await merger.wait_for_ended()
+
+
+@pytest.mark.asyncio
+@fast_forward_time(1, 30)
+@timeout(20)
+async def test_merger_adapts_cutoff(event_loop,
+                                    outside_source_stream,
+                                    mock_merge_strategy,
+                                    mock_reader_builder,
+                                    mock_delayed_stream_builder,
+                                    mock_readers,
+                                    mock_connections):
+    reader = mock_readers()
+    mock_reader_builder.side_effect = [reader]
+    cutoff = asynctest.Mock(spec=["for_writers"])
+    cutoff.for_writers.return_value = 1234
+
+    merger = Merger(mock_reader_builder, mock_delayed_stream_builder,
+                    mock_merge_strategy, outside_source_stream, cutoff)
+    await merger.handle_connection(mock_connections())
+    await asyncio.sleep(Merger.CUTOFF_INTERVAL + 1)
+    cutoff.for_writers.assert_called_with(1)
+    mock_merge_strategy.set_cmp_cutoff.assert_called_with(1234)
+
+    merger.stop_accepting_connections()
+    await merger.wait_for_ended()
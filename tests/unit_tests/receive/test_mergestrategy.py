@@ -1,7 +1,8 @@
 import pytest
 
 from replayserver.receive.mergestrategy import QuorumMergeStrategy
-from replayserver.streams import ReplayStream, ConcreteDataMixin
+from replayserver.streams import ReplayStream, ConcreteDataMixin, \
+    OutsideSourceReplayStream
 
 
 # Technically we shouldn't rely on abstract classes being good, and should use
@@ -345,3 +346,51 @@ def test_quorum_strategy_accepts_cutoff(outside_source_stream):
     stream3._add_data(b"aaadefgh")
     strat.new_data(stream3)
     assert outside_source_stream.data.bytes() == b"abcdefgh"
+
+
+def test_quorum_strategy_cutoff_can_grow(outside_source_stream):
+    config = MockStrategyConfig()
+    config.stream_comparison_cutoff = 2
+    strat = QuorumMergeStrategy.build(outside_source_stream, config)
+
+    stream1 = MockStream()
+    stream2 = MockStream()
+    stream3 = MockStream()
+    for s in [stream1, stream2, stream3]:
+        s._header = "Header"
+        strat.stream_added(s)
+
+    stream1._add_data(b"abcdefgh")
+    strat.new_data(stream1)
+    stream2._add_data(b"abcdefgh")
+    strat.new_data(stream2)
+    assert outside_source_stream.data.bytes() == b"abcdefgh"
+
+    # Stream 3 was trimmed with the smaller cutoff, growing it shouldn't make
+    # us compare discarded data.
+    strat.set_cmp_cutoff(100)
+    stream3._add_data(b"XXXXXXghi")
+    strat.new_data(stream3)
+    stream1._ended = True
+    strat.stream_removed(stream1)
+    stream2._ended = True
+    strat.stream_removed(stream2)
+    stream3._ended = True
+    strat.stream_removed(stream3)
+    strat.finalize()
+    assert outside_source_stream.data.bytes() == b"abcdefghi"
+
+
+def test_strategy_tracks_stream_with_callbacks(outside_source_stream):
+    strat = QuorumMergeStrategy.build(outside_source_stream,
+                                      MockStrategyConfig())
+    stream = OutsideSourceReplayStream()
+    strat.track_stream(stream)
+    stream.set_header("Header")
+    stream.feed_data(b"Best ")
+    stream.feed_data(b"friends")
+    assert outside_source_stream.data.bytes() == b"Best friends"
+    stream.finish()
+    strat.finalize()
+    assert outside_source_stream.header == "Header"
+    assert outside_source_stream.ended()
@@ -5,6 +5,7 @@ from asynctest.helpers import exhaust_callbacks
 from tests import timeout
 
 from replayserver.send.sender import Sender, ReplayStreamWriter
+from replayserver.streams.spill import SpillFile
 from replayserver.errors import CannotAcceptConnectionError
 
 
@@ -129,3 +130,66 @@ async def test_stream_writer_empty_data(mock_connections,
     outside_source_stream.finish()
     await sender.send_to(connection)
     connection.write.assert_has_awaits([asynctest.call(b"Header")])
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_stream_writer_sends_spilled_data(mock_connections,
+                                                outside_source_stream,
+                                                mock_replay_headers,
+                                                monkeypatch, tmpdir):
+    monkeypatch.setattr(SpillFile, "READ_SIZE", 3)
+    mock_header = mock_replay_headers()
+    connection = mock_connections()
+    mock_header.data = b"Header"
+    outside_source_stream.set_header(mock_header)
+    outside_source_stream.feed_data(b"Data1234")
+    outside_source_stream.finish()
+    spill = await SpillFile.create(str(tmpdir),
+                                   outside_source_stream.data.bytes())
+    outside_source_stream.spill(spill)
+
+    sender = ReplayStreamWriter(outside_source_stream)
+    await sender.send_to(connection)
+    connection.write.assert_has_awaits([asynctest.call(b"Header"),
+                                        asynctest.call(b"Dat"),
+                                        asynctest.call(b"a12"),
+                                        asynctest.call(b"34")])
+    spill.close()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_stream_writer_tracks_lowest_position(mock_connections,
+                                                    outside_source_stream,
+                                                    mock_replay_headers,
+                                                    event_loop):
+    mock_header = mock_replay_headers()
+    mock_header.data = b"Header"
+    outside_source_stream.set_header(mock_header)
+    outside_source_stream.feed_data(b"Data")
+    slow, fast = mock_connections(), mock_connections()
+    slow_write = asyncio.Event()
+
+    async def write(data):
+        if data != b"Header":
+            await slow_write.wait()
+        return True
+
+    slow.write.side_effect = write
+    sender = ReplayStreamWriter(outside_source_stream)
+    assert sender.lowest_position() is None
+    s = asyncio.ensure_future(sender.send_to(slow))
+    f = asyncio.ensure_future(sender.send_to(fast))
+    await exhaust_callbacks(event_loop)
+    outside_source_stream.feed_data(b"More")
+    await exhaust_callbacks(event_loop)
+    assert sender.lowest_position() == 0
+
+    slow_write.set()
+    await exhaust_callbacks(event_loop)
+    assert sender.lowest_position() == 8
+    outside_source_stream.finish()
+    await s
+    await f
+    assert sender.lowest_position() is None
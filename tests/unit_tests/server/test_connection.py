@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import asynctest
 from asyncio.streams import StreamReader, StreamWriter
@@ -217,6 +218,26 @@ async def test_connection_header_no_data(conn_with_data):
         await ConnectionHeader.read(mock_conn, 60)
 
 
+@pytest.mark.asyncio
+@timeout(1)
+async def test_connection_header_times_out(event_loop, mock_stream_writers):
+    conn = Connection(StreamReader(loop=event_loop), mock_stream_writers(), 0)
+    with pytest.raises(MalformedDataError):
+        await ConnectionHeader.read(conn, 0.05)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_connection_header_read_can_be_cancelled(
+        event_loop, mock_stream_writers):
+    conn = Connection(StreamReader(loop=event_loop), mock_stream_writers(), 0)
+    f = asyncio.ensure_future(ConnectionHeader.read(conn, 60))
+    await asyncio.sleep(0.01)
+    f.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await f
+
+
 @pytest.mark.asyncio
 @timeout(1)
 async def test_connection_header_replay_info(conn_with_data):
@@ -298,3 +319,13 @@ async def test_connection_header_read_times_out(event_loop,
     mock_conn._feed_data(b"G/-1/fo")
     with pytest.raises(MalformedDataError):
         await ConnectionHeader.read(mock_conn, timeout=5)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_connection_header_to_bytes(rw_pairs_with_data):
+    data = b"P/1/Name of the game\0"
+    r, w = rw_pairs_with_data(data)
+    conn = Connection(r, w, 0)
+    header = await ConnectionHeader.read(conn, 1)
+    assert header.to_bytes() == data
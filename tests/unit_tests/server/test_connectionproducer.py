@@ -1,8 +1,11 @@
 import pytest
 import asyncio
+import socket
 from tests import timeout
 
+from replayserver import metrics
 from replayserver.server.connectionproducer import ConnectionProducer
+from replayserver.server.sockopts import SocketOptions
 
 
 @pytest.mark.asyncio
@@ -103,3 +106,98 @@ async def test_connection_closes_does_not_allow_more_data():
     w.write(b"foo" * 1000)
     await w.drain()
     await handle_done.wait()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_connectionproducer_parks_idle_connections():
+    handle_done = asyncio.locks.Event()
+
+    async def handle_conn(conn):
+        d = await conn.readexactly(6)
+        assert d == b"barbaz"
+        await conn.write(b"foo")
+        handle_done.set()
+
+    c = ConnectionProducer(handle_conn, 6664, 0.1, park_timeout=10)
+    await c.start()
+
+    r, w = await asyncio.open_connection('127.0.0.1', 6664)
+    await asyncio.sleep(0.05)
+    assert c.parked_count() == 1
+    assert metrics.parked_connection_bytes._value.get() > 0
+    assert not handle_done.is_set()
+
+    w.write(b"bar")
+    await w.drain()
+    await asyncio.sleep(0.05)
+    assert c.parked_count() == 0
+    w.write(b"baz")
+    await w.drain()
+    d = await r.readexactly(3)
+    assert d == b"foo"
+    await handle_done.wait()
+    w.close()
+    await c.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_connectionproducer_parked_connection_timeout():
+    async def handle_conn(conn):
+        assert False
+
+    c = ConnectionProducer(handle_conn, 6665, 0.1, park_timeout=0.1)
+    await c.start()
+
+    r, w = await asyncio.open_connection('127.0.0.1', 6665)
+    assert await r.read() == b""
+    assert c.parked_count() == 0
+
+    # Connection that quits without sending anything is just dropped.
+    r, w = await asyncio.open_connection('127.0.0.1', 6665)
+    await asyncio.sleep(0.05)
+    w.close()
+    await asyncio.sleep(0.05)
+    assert c.parked_count() == 0
+    await c.stop()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_connectionproducer_stop_closes_parked():
+    async def handle_conn(conn):
+        assert False
+
+    c = ConnectionProducer(handle_conn, 6666, 0.1, park_timeout=10)
+    await c.start()
+
+    r, w = await asyncio.open_connection('127.0.0.1', 6666)
+    await asyncio.sleep(0.05)
+    await c.stop()
+    assert await r.read() == b""
+    assert c.parked_count() == 0
+
+
+@pytest.mark.asyncio
+@timeout(1)
+@pytest.mark.parametrize("park_timeout", [None, 10])
+async def test_connectionproducer_applies_accept_options(park_timeout):
+    keepalive = []
+
+    async def handle_conn(conn):
+        sock = conn.writer.get_extra_info("socket")
+        keepalive.append(sock.getsockopt(socket.SOL_SOCKET,
+                                         socket.SO_KEEPALIVE))
+
+    c = ConnectionProducer(handle_conn, 6667, 0.1, park_timeout,
+                           SocketOptions(keepalive_time=3600))
+    await c.start()
+    r, w = await asyncio.open_connection('127.0.0.1', 6667)
+    w.write(b"foo")
+    await w.drain()
+    while not keepalive:
+        await asyncio.sleep(0.01)
+    assert keepalive[0]
+    w.close()
+    await c.stop()
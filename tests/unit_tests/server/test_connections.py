@@ -3,7 +3,9 @@ import asyncio
 import asynctest
 from tests import timeout
 
+from replayserver.server.connection import ConnectionHeader
 from replayserver.server.connections import Connections
+from replayserver.server.sockopts import SocketOptions
 from replayserver.errors import BadConnectionError, EmptyConnectionError
 
 
@@ -115,3 +117,28 @@ async def test_connections_empty_connection_is_handled(
     connection.close.assert_called()
     connection.wait_closed.assert_awaited()
     await conns.wait_until_empty()
+
+
+@pytest.mark.asyncio
+@timeout(0.1)
+async def test_connections_sets_socket_options_by_type(
+        mock_replays, mock_header_read, mock_connections,
+        mock_connection_headers):
+    reader_options = SocketOptions(tcp_nodelay=True)
+    writer_options = SocketOptions()
+    conns = Connections(mock_header_read, mock_replays, {
+        ConnectionHeader.Type.READER: reader_options,
+        ConnectionHeader.Type.WRITER: writer_options})
+
+    connection = mock_connections()
+    mock_header_read.return_value = mock_connection_headers(
+        ConnectionHeader.Type.READER, 1)
+    await conns.handle_connection(connection)
+    connection.set_socket_options.assert_called_with(reader_options)
+
+    # Empty options are not applied at all
+    connection = mock_connections()
+    mock_header_read.return_value = mock_connection_headers(
+        ConnectionHeader.Type.WRITER, 1)
+    await conns.handle_connection(connection)
+    connection.set_socket_options.assert_not_called()
@@ -0,0 +1,147 @@
+import pytest
+import asyncio
+import asynctest
+from tests import timeout
+from tests.replays import example_replay
+
+from replayserver.bookkeeping.bookkeeper import Bookkeeper
+from replayserver.bookkeeping.spool import ReplaySpool
+from replayserver.errors import BookkeepingError
+from replayserver.server.journal import ReplayJournals
+from replayserver.streams import OutsideSourceReplayStream
+
+
+@pytest.mark.asyncio
+async def test_journal_writes_new_data(tmpdir, mock_replay_headers):
+    spool = ReplaySpool(str(tmpdir))
+    journals = ReplayJournals(spool, 1)
+    stream = OutsideSourceReplayStream()
+    journal = journals.track(1, stream)
+
+    # Nothing is written before we have a header
+    await journals.flush()
+    assert await spool.ready() == []
+
+    stream.set_header(mock_replay_headers(example_replay))
+    stream.feed_data(b"foo")
+    await journals.flush()
+    stream.feed_data(b"bar")
+    stream.feed_data(b"baz")
+    await journals.flush()
+    await journals.flush()
+
+    recovered = await spool.load(1)
+    assert recovered.header.data == example_replay.header_data
+    assert recovered.header.struct == example_replay.header
+    assert recovered.data.bytes() == b"foobarbaz"
+
+    await journal.close()
+    assert await spool.ready() == []
+    # Closed journals are not written to
+    stream.feed_data(b"qux")
+    await journals.flush()
+    assert await spool.ready() == []
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_journal_flushes_periodically(tmpdir, mock_replay_headers):
+    spool = ReplaySpool(str(tmpdir))
+    journals = ReplayJournals(spool, 0.01)
+    stream = OutsideSourceReplayStream()
+    journals.track(1, stream)
+    stream.set_header(mock_replay_headers(example_replay))
+    stream.feed_data(b"foo")
+
+    await journals.start()
+    while not await spool.ready():
+        await asyncio.sleep(0.01)
+    stream.feed_data(b"bar")
+    await journals.stop()
+    assert (await spool.load(1)).data.bytes() == b"foobar"
+
+
+@pytest.mark.asyncio
+async def test_journal_recovers_replays(tmpdir, mock_replay_headers,
+                                        mock_bookkeeper):
+    spool = ReplaySpool(str(tmpdir))
+    journals = ReplayJournals(spool, 1)
+    for game_id in [1, 2]:
+        stream = OutsideSourceReplayStream()
+        journals.track(game_id, stream)
+        stream.set_header(mock_replay_headers(example_replay))
+        stream.feed_data(b"foo")
+    await journals.flush()
+    tmpdir.join("3.replay").write("garbage")
+    mock_bookkeeper.save_replay.side_effect = [False, True]
+
+    # Simulating a restart
+    journals = ReplayJournals(spool, 1)
+    await journals.recover(mock_bookkeeper)
+    # Some mock versions don't record awaits that raised, so check calls.
+    calls = mock_bookkeeper.save_replay.call_args_list
+    assert [c[0][0] for c in calls] == [1, 2]
+    assert calls[1][0][1].data.bytes() == b"foo"
+    # Journal of the replay we failed to save is kept for next time
+    assert await spool.ready() == [1]
+
+    mock_bookkeeper.save_replay.side_effect = None
+    mock_bookkeeper.save_replay.return_value = True
+    await journals.recover(mock_bookkeeper)
+    assert mock_bookkeeper.save_replay.call_args[0][0] == 1
+    assert await spool.ready() == []
+
+
+@pytest.mark.asyncio
+async def test_journal_kept_when_bookkeeper_fails_to_save(
+        tmpdir, mock_replay_headers):
+    spool = ReplaySpool(str(tmpdir))
+    journals = ReplayJournals(spool, 1)
+    stream = OutsideSourceReplayStream()
+    journals.track(1, stream)
+    stream.set_header(mock_replay_headers(example_replay))
+    stream.feed_data(b"foo")
+    await journals.flush()
+
+    class S:
+        async def save_replay():
+            pass
+
+    saver = asynctest.Mock(spec=S)
+    saver.save_replay.side_effect = BookkeepingError
+    queries = asynctest.Mock(update_game_stats=asynctest.CoroutineMock())
+    bookkeeper = Bookkeeper(queries, saver, asynctest.Mock(), None)
+    journals = ReplayJournals(spool, 1)
+    await journals.recover(bookkeeper)
+    saver.save_replay.assert_called_once()
+    assert await spool.ready() == [1]
+
+
+@pytest.mark.asyncio
+async def test_journal_rewrites_data_after_failed_write(tmpdir,
+                                                        mock_replay_headers):
+    spool = ReplaySpool(str(tmpdir))
+    journals = ReplayJournals(spool, 1)
+    stream = OutsideSourceReplayStream()
+    journals.track(1, stream)
+    stream.set_header(mock_replay_headers(example_replay))
+    stream.feed_data(b"foo")
+    await journals.flush()
+
+    # Make the next write fail
+    rfile = tmpdir.join("1.replay")
+    rfile.move(tmpdir.join("moved"))
+    rfile.mkdir()
+    stream.feed_data(b"bar")
+    await journals.flush()
+    rfile.remove()
+    tmpdir.join("moved").move(rfile)
+    # Leftovers of a write that failed halfway
+    rfile.write(b"ba", mode="ab")
+
+    stream.feed_data(b"baz")
+    await journals.flush()
+
+    recovered = await spool.load(1)
+    assert recovered.header.data == example_replay.header_data
+    assert recovered.data.bytes() == b"foobarbaz"
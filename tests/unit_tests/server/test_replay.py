@@ -45,6 +45,12 @@ def mock_sender(blockable_coroutines):
         def stop_accepting_connections():
             pass
 
+        def ended():
+            pass
+
+        def lowest_position():
+            pass
+
         async def wait_for_ended():
             pass
 
@@ -205,3 +211,76 @@ async def test_replay_keeps_proper_event_order(
     await exhaust_callbacks(event_loop)
     sender.wait_for_ended._lock.set()
     await replay.wait_for_ended()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_replay_spills_stream_for_readers(
+        event_loop, replay_deps, outside_source_stream, mock_replay_headers,
+        tmpdir):
+    merger, sender, bookkeeper = replay_deps
+    merger.canonical_stream = outside_source_stream
+    outside_source_stream.set_header(mock_replay_headers())
+    outside_source_stream.feed_data(b"foo")
+    outside_source_stream.finish()
+    sender.ended.return_value = False
+
+    conf = MockReplayConfig(100, 100)
+    replay = Replay(*replay_deps, conf, 1, spill_path=str(tmpdir))
+    merger.wait_for_ended._lock.set()
+    while not sender.wait_for_ended.called:
+        await asyncio.sleep(0.01)
+    bookkeeper.save_replay.assert_awaited()
+
+    with pytest.raises(IndexError):
+        outside_source_stream.data.bytes()
+    assert await outside_source_stream.read(0, 10) == b"foo"
+    sender.wait_for_ended._lock.set()
+    await replay.wait_for_ended()
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_replay_does_not_spill_without_readers(
+        event_loop, replay_deps, outside_source_stream, tmpdir, mocker):
+    merger, sender, bookkeeper = replay_deps
+    merger.canonical_stream = outside_source_stream
+    outside_source_stream.feed_data(b"foo")
+    outside_source_stream.finish()
+    sender.ended.return_value = True
+    spill = mocker.spy(outside_source_stream, "spill")
+
+    conf = MockReplayConfig(100, 100)
+    replay = Replay(*replay_deps, conf, 1, spill_path=str(tmpdir))
+    merger.wait_for_ended._lock.set()
+    sender.wait_for_ended._lock.set()
+    await replay.wait_for_ended()
+    spill.assert_not_called()
+
+
+@pytest.mark.asyncio
+@fast_forward_time(1, 150)
+@timeout(120)
+async def test_replay_compresses_cold_data(event_loop, replay_deps,
+                                           outside_source_stream):
+    merger, sender, bookkeeper = replay_deps
+    merger.canonical_stream = outside_source_stream
+    outside_source_stream.compress_cold = asynctest.CoroutineMock()
+    outside_source_stream.feed_data(b"a" * 1000)
+    sender.lowest_position.return_value = None
+
+    conf = MockReplayConfig(1000, 1000)
+    replay = Replay(*replay_deps, conf, 1, cold_data_window=100)
+    await asyncio.sleep(Replay.COLD_DATA_INTERVAL + 1)
+    outside_source_stream.compress_cold.assert_awaited_once_with(900)
+
+    sender.lowest_position.return_value = 500
+    await asyncio.sleep(Replay.COLD_DATA_INTERVAL)
+    outside_source_stream.compress_cold.assert_awaited_with(500)
+
+    merger.wait_for_ended._lock.set()
+    sender.wait_for_ended._lock.set()
+    await replay.wait_for_ended()
+    outside_source_stream.compress_cold.reset_mock()
+    await asyncio.sleep(Replay.COLD_DATA_INTERVAL)
+    outside_source_stream.compress_cold.assert_not_awaited()
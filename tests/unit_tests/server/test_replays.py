@@ -6,6 +6,8 @@ from asynctest.helpers import exhaust_callbacks
 from tests import timeout
 from replayserver.server.connection import ConnectionHeader
 from replayserver.server.replays import Replays
+from replayserver.server.replay import ReplayMemory
+from replayserver.streams import StreamMemory
 from replayserver.errors import CannotAcceptConnectionError
 
 
@@ -19,6 +21,9 @@ def mock_replays(blockable_coroutines):
             def close():
                 pass
 
+            def memory():
+                pass
+
             async def wait_for_ended():
                 pass
 
@@ -141,3 +146,30 @@ async def test_connections_are_not_accepted_when_closing(
 
     mock_replay.wait_for_ended._lock.set()
     await f
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_replays_memory_usage(
+        mock_replays, mock_replay_builder, mock_conn_plus_head):
+    replay_list = []
+    for held in [10, 30, 20]:
+        replay = mock_replays()
+        replay.memory.return_value = ReplayMemory(
+            StreamMemory(held, 0, held),
+            [StreamMemory(1, 0, 1), StreamMemory(2, 0, 2)])
+        replay_list.append(replay)
+    mock_replay_builder.side_effect = replay_list
+    replays = Replays(mock_replay_builder)
+    for game_id in range(3):
+        conn = mock_conn_plus_head(ConnectionHeader.Type.WRITER, game_id)
+        await replays.handle_connection(*conn)
+
+    assert replays.memory_usage() == {"canonical": 60, "writers": 9}
+    top = replays.top_memory_usage(2)
+    assert [game_id for game_id, _ in top] == [1, 2]
+    assert top[0][1].held() == 33
+
+    for replay in replay_list:
+        replay.wait_for_ended._lock.set()
+    await replays.stop_all()
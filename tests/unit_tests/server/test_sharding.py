@@ -0,0 +1,233 @@
+import asyncio
+import asynctest
+import os
+import pytest
+from types import SimpleNamespace
+from tests import timeout
+
+from replayserver.errors import MalformedDataError, \
+    CannotAcceptConnectionError, WorkerExitedError
+from replayserver.server.connection import ConnectionHeader
+from replayserver.server.connectionproducer import ConnectionProducer
+from replayserver.server.sharding import Shard, ShardAcceptor, \
+    ShardConnectionProducer, ThreadShard, Supervisor, shard_config, \
+    redistribute_journals
+
+
+@pytest.fixture
+def mock_shards():
+    class S:
+        async def hand_off(self, fd, data):
+            pass
+
+    return lambda: asynctest.Mock(spec=S)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_sharding_hands_off_connection(unused_tcp_port):
+    handle_done = asyncio.locks.Event()
+
+    async def handle_conn(conn):
+        header = await ConnectionHeader.read(conn, 1)
+        assert header.type == ConnectionHeader.Type.WRITER
+        assert header.game_id == 5
+        data = await conn.readexactly(10)
+        assert data == b"helloworld"
+        await conn.write(b"foo")
+        handle_done.set()
+
+    shard = Shard.build(0)
+    acceptor = ShardAcceptor.build([shard], 1)
+    producer = ConnectionProducer(acceptor.handle_connection,
+                                  unused_tcp_port, 0.1)
+    worker = ShardConnectionProducer(handle_conn, shard._worker_channel, 0.1)
+    await producer.start()
+    await worker.start()
+
+    r, w = await asyncio.open_connection('127.0.0.1', unused_tcp_port)
+    # Leftover data past the header goes along with the socket.
+    w.write(b"P/5/Game\0hello")
+    await w.drain()
+    await asyncio.sleep(0.05)
+    w.write(b"world")
+    await w.drain()
+    assert await r.readexactly(3) == b"foo"
+    await handle_done.wait()
+
+    w.close()
+    await producer.stop()
+    await worker.stop()
+    shard.close()
+
+
+class EchoServer:
+    "Stand-in for a worker's Server, replies with the game id it got."
+
+    def __init__(self, config, dep_connection_producer):
+        self.config = config
+        self._producer = dep_connection_producer(self._handle, None, 0.1)
+        self._stopped = asyncio.locks.Event()
+
+    async def _handle(self, conn):
+        header = await ConnectionHeader.read(conn, 1)
+        await conn.write(str(header.game_id).encode())
+        conn.close(immediate=True)
+
+    async def run(self):
+        await self._producer.start()
+        await self._stopped.wait()
+
+    async def stop(self):
+        await self._producer.stop()
+        self._stopped.set()
+
+    def log_memory_usage(self):
+        pass
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_sharding_thread_shard(unused_tcp_port):
+    servers = []
+
+    def build_worker(config, dep_connection_producer):
+        server = EchoServer(config, dep_connection_producer)
+        servers.append(server)
+        return server
+
+    config = SimpleNamespace(replay=SimpleNamespace(
+        journal_path="", writer_memory_budget=None))
+    shard = ThreadShard.build(0)
+    shard.spawn(build_worker, config, [shard])
+    assert servers[0].config.replay is not config.replay
+    exited = []
+    shard.watch(exited.append)
+
+    acceptor = ShardAcceptor.build([shard], 1)
+    producer = ConnectionProducer(acceptor.handle_connection,
+                                  unused_tcp_port, 0.1)
+    await producer.start()
+    r, w = await asyncio.open_connection('127.0.0.1', unused_tcp_port)
+    w.write(b"G/12/Game\0")
+    await w.drain()
+    assert await r.read() == b"12"
+    w.close()
+    await producer.stop()
+
+    shard.stop()
+    await shard.wait_exited()
+    await asyncio.sleep(0)
+    assert exited == [shard]
+    assert shard.exitcode() == 0
+
+    # A stopped worker can't take connections anymore.
+    rfd, wfd = os.pipe()
+    with pytest.raises(CannotAcceptConnectionError):
+        await shard.hand_off(rfd, b"")
+    os.close(rfd)
+    os.close(wfd)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_sharding_acceptor_picks_shard_by_game_id(
+        mock_connections, mock_shards):
+    shards = [mock_shards() for _ in range(3)]
+    header = ConnectionHeader(ConnectionHeader.Type.READER, 7, "Game")
+    header_read = asynctest.CoroutineMock(return_value=header)
+    acceptor = ShardAcceptor(header_read, shards)
+    assert acceptor.shard_for(7) is shards[1]
+
+    conn = mock_connections()
+    fd = 42
+    conn.detach.return_value = (fd, b"data")
+    closed = []
+
+    with asynctest.patch("os.close", closed.append):
+        await acceptor.handle_connection(conn)
+    shards[1].hand_off.assert_awaited_with(fd, b"G/7/Game\0data")
+    shards[0].hand_off.assert_not_awaited()
+    assert closed == [fd]
+    conn.close.assert_called_with(immediate=True)
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_sharding_acceptor_drops_bad_connection(
+        mock_connections, mock_shards):
+    shards = [mock_shards()]
+    header_read = asynctest.CoroutineMock(side_effect=MalformedDataError)
+    acceptor = ShardAcceptor(header_read, shards)
+    conn = mock_connections()
+
+    await acceptor.handle_connection(conn)
+    conn.detach.assert_not_called()
+    shards[0].hand_off.assert_not_awaited()
+    conn.close.assert_called_with(immediate=True)
+    await acceptor.close_all()
+
+
+def test_shard_config(tmpdir):
+    config = SimpleNamespace(replay=SimpleNamespace(
+        journal_path=str(tmpdir), writer_memory_budget=1000))
+    shard_config(config, 2, 3)
+    assert config.replay.journal_path == str(tmpdir.join("shard2"))
+    assert tmpdir.join("shard2").isdir()
+    assert config.replay.writer_memory_budget == 333
+
+    config = SimpleNamespace(replay=SimpleNamespace(
+        journal_path="", writer_memory_budget=None))
+    shard_config(config, 2, 3)
+    assert config.replay.journal_path == ""
+    assert config.replay.writer_memory_budget is None
+
+
+def test_redistribute_journals(tmpdir):
+    tmpdir.join("shard0").mkdir()
+    tmpdir.join("shard0", "4.replay").write("a")
+    tmpdir.join("shard0", "5.replay").write("b")
+    # Left over from when we had more workers
+    tmpdir.join("shard3").mkdir()
+    tmpdir.join("shard3", "7.replay").write("c")
+    tmpdir.join("shard3", "notes").write("d")
+
+    redistribute_journals(str(tmpdir), 2)
+    assert sorted(os.listdir(str(tmpdir.join("shard0")))) == ["4.replay"]
+    assert sorted(os.listdir(str(tmpdir.join("shard1")))) == [
+        "5.replay", "7.replay"]
+    assert tmpdir.join("shard1", "7.replay").read() == "c"
+    assert os.listdir(str(tmpdir.join("shard3"))) == ["notes"]
+
+
+@pytest.mark.asyncio
+@timeout(1)
+async def test_supervisor_exits_when_worker_dies():
+    class FailingServer(EchoServer):
+        async def run(self):
+            await self._producer.start()
+            await asyncio.sleep(0.05)
+            raise Exception("Worker crashed")
+
+    config = SimpleNamespace(replay=SimpleNamespace(
+        journal_path="", writer_memory_budget=None))
+    shards = [ThreadShard.build(i) for i in range(2)]
+    producer = asynctest.Mock(spec=ConnectionProducer)
+    supervisor = Supervisor(producer, ShardAcceptor.build(shards, 1), shards,
+                            None)
+
+    def build_worker(config, dep_connection_producer):
+        if len(servers) == 0:
+            server = FailingServer(config, dep_connection_producer)
+        else:
+            server = EchoServer(config, dep_connection_producer)
+        servers.append(server)
+        return server
+
+    servers = []
+    supervisor.spawn_workers(build_worker, config)
+    with pytest.raises(WorkerExitedError):
+        await supervisor.run()
+    producer.stop.assert_awaited()
+    assert shards[0].exitcode() == 1
+    assert not shards[1]._thread.is_alive()
@@ -0,0 +1,55 @@
+import socket
+from unittest import mock
+
+from replayserver.server.sockopts import SocketOptions
+
+
+def test_socket_options_applied():
+    options = SocketOptions(tcp_nodelay=True, send_buffer=65536,
+                            receive_buffer=32768, notsent_lowat=16384,
+                            keepalive_time=3600)
+    assert options
+    with socket.socket() as sock:
+        options.apply(sock)
+        tcp = socket.IPPROTO_TCP
+        assert sock.getsockopt(tcp, socket.TCP_NODELAY)
+        # Linux doubles buffer sizes for bookkeeping overhead.
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 32768
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+            assert sock.getsockopt(tcp, socket.TCP_NOTSENT_LOWAT) == 16384
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert sock.getsockopt(tcp, socket.TCP_KEEPIDLE) == 3600
+
+
+def test_socket_options_unset_keep_defaults():
+    options = SocketOptions(tcp_nodelay=None)
+    assert not options
+    with socket.socket() as sock:
+        default = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        options.apply(sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP,
+                               socket.TCP_NODELAY) == default
+
+
+def test_socket_options_ignore_errors():
+    options = SocketOptions(tcp_nodelay=True)
+    sock = socket.socket()
+    sock.close()
+    options.apply(sock)
+    options.apply(None)
+
+
+def test_socket_options_applied_past_errors():
+    options = SocketOptions(tcp_nodelay=True, keepalive_time=3600)
+    sock = mock.Mock(spec=["setsockopt"])
+
+    def setsockopt(level, option, value):
+        if option == socket.TCP_NODELAY:
+            raise OSError
+
+    sock.setsockopt.side_effect = setsockopt
+    options.apply(sock)
+    sock.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                                    1)
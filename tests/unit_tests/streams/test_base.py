@@ -3,7 +3,8 @@ import asyncio
 from asynctest.helpers import exhaust_callbacks
 from tests import timeout
 from replayserver.streams import ReplayStream, ConcreteDataMixin, \
-    OutsideSourceReplayStream
+    OutsideSourceReplayStream, StreamMemory
+from replayserver.streams.spill import SpillFile
 
 
 def test_data_uses_right_stream_methods():
@@ -165,3 +166,80 @@ def test_outside_source_stream_discard():
         stream.data.view()
     with pytest.raises(IndexError):
         stream.data.view(1, 3)
+
+
+@pytest.mark.asyncio
+async def test_outside_source_stream_spill(tmpdir, monkeypatch):
+    monkeypatch.setattr(SpillFile, "READ_SIZE", 3)
+    stream = OutsideSourceReplayStream()
+    stream.set_header("header")
+    stream.feed_data(b"abcdefgh")
+    assert await stream.read(2, 3) == b"cde"
+    stream.finish()
+
+    spill = await SpillFile.create(str(tmpdir), stream.data.bytes())
+    # Spill files are unlinked right away
+    assert tmpdir.listdir() == []
+    stream.spill(spill)
+    with pytest.raises(IndexError):
+        stream.data.bytes()
+    assert len(stream.data) == 8
+    assert await stream.read(2, 5) == b"cde"
+    assert await stream.read(6, 5) == b"gh"
+    assert await stream.read(8, 5) == b""
+    spill.close()
+
+
+@pytest.mark.asyncio
+@timeout(0.1)
+async def test_outside_source_stream_wait_for_min_bytes(event_loop):
+    stream = OutsideSourceReplayStream()
+    f1 = asyncio.ensure_future(stream.wait_for_data(0, 4))
+    f2 = asyncio.ensure_future(stream.wait_for_data(1, 1))
+    f3 = asyncio.ensure_future(stream.wait_for_data(2, 10))
+    await exhaust_callbacks(event_loop)
+    stream.feed_data(b"ab")
+    await exhaust_callbacks(event_loop)
+    assert f2.done()
+    assert not f1.done()
+    assert not f3.done()
+    stream.feed_data(b"cd")
+    assert await f1 == 4
+    await exhaust_callbacks(event_loop)
+    assert not f3.done()
+    stream.finish()
+    assert await f3 == 2
+
+
+@pytest.mark.asyncio
+@timeout(0.1)
+async def test_outside_source_stream_cancelled_waiter(event_loop):
+    stream = OutsideSourceReplayStream()
+    f1 = asyncio.ensure_future(stream.wait_for_data(0))
+    f2 = asyncio.ensure_future(stream.wait_for_data(0))
+    await exhaust_callbacks(event_loop)
+    f1.cancel()
+    stream.feed_data(b"a")
+    assert await f2 == 1
+    assert stream._data_waiters == []
+
+
+def test_outside_source_stream_feed_from():
+    source = OutsideSourceReplayStream()
+    source.feed_data(b"abcdefgh")
+    sink = OutsideSourceReplayStream()
+    sink.feed_data(b"a")
+    sink.feed_from(source, 1, 5)
+    assert sink.data.bytes() == b"abcde"
+    # Source buffer is not held onto
+    source.discard(5)
+    source.feed_data(b"ij")
+    assert source.data[5:] == b"fghij"
+
+
+def test_outside_source_stream_memory():
+    stream = OutsideSourceReplayStream()
+    stream.feed_data(b"abcdefgh")
+    stream.discard(6)
+    stream.feed_data(b"ij")
+    assert stream.memory() == StreamMemory(held=4, discarded=6, peak=8)
@@ -0,0 +1,187 @@
+import asyncio
+import gc
+import pytest
+
+from replayserver.streams import MemoryBudget, SpillableReplayStream
+from replayserver.streams.spill import MappedSpill
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(MappedSpill, "SEGMENT_SIZE", 4)
+
+
+async def wait_until_spilled(stream):
+    while stream._data or stream._growing is not None:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_spillable_stream_access_to_spilled_data(tmpdir):
+    budget = MemoryBudget(100, str(tmpdir))
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcdefghij")
+    assert await stream.spill(str(tmpdir))
+    assert budget.total == 0
+    stream.feed_data(b"klm")
+    data = b"abcdefghijklm"
+
+    assert len(stream.data) == 13
+    assert stream.data.bytes() == data
+    for s in [slice(0, 2), slice(5, 13), slice(-6, -1), slice(0, 13, 2),
+              slice(4, 4)]:
+        assert stream.data[s] == data[s]
+        assert stream.future_data[s] == data[s]
+    for i in [0, 5, 12, -1]:
+        assert stream.data[i] == data[i]
+    view = stream.data.view(2, 10)
+    assert view == data[2:10]
+    view.release()
+    assert await stream.read(3, 4) == b"defg"
+    # Spill files are unlinked
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.asyncio
+async def test_spillable_stream_discard(tmpdir):
+    budget = MemoryBudget(100, str(tmpdir))
+    budget.UNSPILL_PRESSURE = 0
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcdefghij")
+    stream.discard(3)
+    assert budget.total == 7
+    await stream.spill(str(tmpdir))
+    stream.discard(5)
+    with pytest.raises(IndexError):
+        stream.data[1:3]
+    with pytest.raises(IndexError):
+        stream.data.bytes()
+    assert stream.data[5:10] == b"fghij"
+    assert stream._mapped is not None
+
+
+@pytest.mark.asyncio
+async def test_spillable_stream_moves_back_to_memory(tmpdir):
+    budget = MemoryBudget(20, str(tmpdir))
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcdefghij" * 2)
+    await stream.spill(str(tmpdir))
+    # 11 bytes would take us over half the budget
+    stream.discard(9)
+    assert stream._mapped is not None
+    stream.discard(10)
+    assert stream._mapped is None
+    assert budget.total == 10
+    stream.feed_data(b"k")
+    assert stream.data[10:21] == b"abcdefghijk"
+    with pytest.raises(IndexError):
+        stream.data[9:11]
+
+
+@pytest.mark.asyncio
+async def test_spilled_stream_grows(tmpdir, small_segments):
+    budget = MemoryBudget(100, str(tmpdir))
+    budget.UNSPILL_PRESSURE = 0
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcdef")
+    await stream.spill(str(tmpdir))
+    # Writes past the spill's room stay in memory until it grows
+    stream.feed_data(b"ghijklmnopq")
+    assert budget.total > 0
+    assert stream.data[2:17] == b"cdefghijklmnopq"
+    await wait_until_spilled(stream)
+    assert budget.total == 0
+    assert stream.data.bytes() == b"abcdefghijklmnopq"
+    assert stream.data.view(4, 8) == b"efgh"
+    assert stream.data.view(14, 17) == b"opq"
+
+
+@pytest.mark.asyncio
+async def test_spilled_stream_frees_discarded_data(tmpdir, small_segments):
+    budget = MemoryBudget(100, str(tmpdir))
+    budget.UNSPILL_PRESSURE = 0
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcdefghij")
+    await stream.spill(str(tmpdir))
+    assert len(stream._mapped._segments) == 3
+    stream.discard(7)
+    assert len(stream._mapped._segments) == 2
+    assert stream.data[7:10] == b"hij"
+    with pytest.raises(IndexError):
+        stream.data[6]
+    # Discarding everything spilled moves the stream back to memory
+    stream.feed_data(b"klmnopqrstuvw")
+    stream.discard(21)
+    assert stream._mapped is None
+    assert stream.data[21:23] == b"vw"
+
+
+@pytest.mark.asyncio
+async def test_spilled_stream_moves_back_when_it_cant_grow(tmpdir,
+                                                           small_segments):
+    directory = tmpdir.join("spill")
+    directory.mkdir()
+    budget = MemoryBudget(100, str(directory))
+    budget.UNSPILL_PRESSURE = 0
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcdef")
+    await stream.spill(str(directory))
+    directory.remove()
+    stream.feed_data(b"ghijklmnop")
+    while stream._mapped is not None:
+        await asyncio.sleep(0.01)
+    assert stream.data[0:16] == b"abcdefghijklmnop"
+    assert budget.total == 16
+
+
+@pytest.mark.asyncio
+async def test_spillable_stream_data_added_while_spilling(tmpdir):
+    budget = MemoryBudget(100, str(tmpdir))
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"abcde")
+    spill = asyncio.ensure_future(stream.spill(str(tmpdir)))
+    await asyncio.sleep(0)
+    stream.feed_data(b"fgh")
+    stream.discard(2)
+    await spill
+    stream.feed_data(b"ij")
+    assert stream.data[2:10] == b"cdefghij"
+    assert budget.total == 0
+
+
+@pytest.mark.asyncio
+async def test_budget_spills_least_recently_compared(tmpdir):
+    budget = MemoryBudget(25, str(tmpdir))
+    s1 = SpillableReplayStream(budget)
+    s2 = SpillableReplayStream(budget)
+    s3 = SpillableReplayStream(budget)
+    for s in [s1, s2, s3]:
+        s.feed_data(b"a" * 10)
+    s1.data[0:5]
+    await asyncio.sleep(0.01)
+    # s2 was accessed least recently, then s3
+    assert s1._mapped is None
+    assert s2._mapped is not None
+    assert s3._mapped is None
+    assert budget.total == 20
+
+
+@pytest.mark.asyncio
+async def test_budget_forgets_collected_streams(tmpdir):
+    budget = MemoryBudget(100, str(tmpdir))
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"a" * 10)
+    assert budget.total == 10
+    del stream
+    gc.collect()
+    assert budget.total == 0
+
+
+@pytest.mark.asyncio
+async def test_budget_stops_when_spilling_fails(tmpdir):
+    budget = MemoryBudget(5, str(tmpdir.join("nonexistent")))
+    stream = SpillableReplayStream(budget)
+    stream.feed_data(b"a" * 10)
+    await asyncio.sleep(0.01)
+    assert stream.can_spill()
+    assert stream.data[0:10] == b"a" * 10
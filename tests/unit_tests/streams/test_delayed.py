@@ -8,31 +8,15 @@ from replayserver.streams import DelayedReplayStream
 
 
 @pytest.fixture
-def mock_timestamp(blockable_coroutines):
-    wait = blockable_coroutines()
-    stamp_list = []
-
-    async def mock_stamps():
-        while True:
-            if stamp_list:
-                yield stamp_list.pop(0)
-            else:
-                await wait()
-                if not stamp_list:
-                    return
+def mock_timestamp():
+    listeners = []
 
     def next_stamp(pos):
-        stamp_list.append(pos)
-        wait._lock.set()
-        wait._lock.clear()
+        listeners[0](pos)
 
-    def end_stamps():
-        wait._lock.set()
-
-    mock_stamp = asynctest.Mock(spec=["timestamps"], _stamps=stamp_list,
-                                _resume_stamps=wait, _next_stamp=next_stamp,
-                                _end_stamps=end_stamps)
-    mock_stamp.timestamps.side_effect = mock_stamps
+    mock_stamp = asynctest.Mock(spec=["start", "end"],
+                                _next_stamp=next_stamp)
+    mock_stamp.start.side_effect = listeners.append
     return mock_stamp
 
 
@@ -53,9 +37,6 @@ async def test_delayed_stream_header(outside_source_stream, mock_timestamp,
     h = await f
     assert h == "Header"
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
@@ -63,7 +44,6 @@ async def test_stream_ends_before_header(outside_source_stream, mock_timestamp,
                                          event_loop):
     stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
     outside_source_stream.finish()
-    mock_timestamp._end_stamps()
     assert (await stream.wait_for_header()) is None
 
 
@@ -106,14 +86,11 @@ async def test_delayed_stream_data(outside_source_stream, mock_timestamp,
     assert len(stream.data) == 7
     assert stream.data.bytes() == b"abcdefg"
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
-async def test_stamps_ending_end_stream(outside_source_stream, mock_timestamp,
-                                        event_loop):
+async def test_source_ending_ends_stream(outside_source_stream, mock_timestamp,
+                                         event_loop):
     stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
 
     outside_source_stream.set_header("Header")
@@ -122,16 +99,14 @@ async def test_stamps_ending_end_stream(outside_source_stream, mock_timestamp,
     await exhaust_callbacks(event_loop)
     assert len(stream.data) == 5
 
-    mock_timestamp._end_stamps()
+    outside_source_stream.finish()
+    mock_timestamp.end.assert_called_once()
     await exhaust_callbacks(event_loop)
     assert stream.ended()
     d = await stream.wait_for_data(5)
     assert d == 0
     assert stream.data.bytes() == b"abcde"
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
@@ -154,9 +129,6 @@ async def test_delayed_stream_data_methods(outside_source_stream,
         stream.data[3]
     assert stream.future_data.bytes() == b"abcde"
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
-
 
 @pytest.mark.asyncio
 @timeout(0.1)
@@ -186,5 +158,20 @@ async def test_delayed_stream_discard(outside_source_stream,
     assert v == b"cdef"
     v.release()
 
-    mock_timestamp._end_stamps()
-    await exhaust_callbacks(event_loop)
+
+@pytest.mark.asyncio
+@timeout(0.1)
+async def test_delayed_stream_notifies_observers(outside_source_stream,
+                                                 mock_timestamp):
+    stream = DelayedReplayStream(outside_source_stream, mock_timestamp)
+    observer = asynctest.Mock(spec=["on_header", "on_data", "on_end"])
+    stream.add_observer(observer)
+
+    outside_source_stream.set_header("Header")
+    observer.on_header.assert_called_once_with(stream)
+    outside_source_stream.feed_data(b"abcde")
+    observer.on_data.assert_not_called()
+    mock_timestamp._next_stamp(3)
+    observer.on_data.assert_called_once_with(stream)
+    outside_source_stream.finish()
+    observer.on_end.assert_called_once_with(stream)
@@ -0,0 +1,75 @@
+import pytest
+from replayserver.streams import TieredReplayStream
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    monkeypatch.setattr(TieredReplayStream, "SEGMENT_SIZE", 4)
+    stream = TieredReplayStream()
+    stream.set_header("header")
+    stream.feed_data(b"abcdefghij")
+    return stream
+
+
+@pytest.mark.asyncio
+async def test_tiered_stream_compresses_whole_segments(stream):
+    await stream.compress_cold(7)
+    assert stream.cold_size() > 0
+    assert stream._cold_end == 4
+    await stream.compress_cold(9)
+    assert stream._cold_end == 8
+    # Nothing more to compress
+    await stream.compress_cold(9)
+    assert stream._cold_end == 8
+
+
+@pytest.mark.asyncio
+async def test_tiered_stream_access_to_cold_data(stream):
+    await stream.compress_cold(8)
+    stream.feed_data(b"klm")
+    data = b"abcdefghijklm"
+
+    assert len(stream.data) == 13
+    assert stream.data.bytes() == data
+    for s in [slice(0, 2), slice(3, 9), slice(5, 13), slice(9, 11),
+              slice(-6, -1), slice(0, 13, 2), slice(4, 4)]:
+        assert stream.data[s] == data[s]
+        assert stream.future_data[s] == data[s]
+    for i in [0, 5, 9, -1, -10]:
+        assert stream.data[i] == data[i]
+    view = stream.data.view(2, 10)
+    assert view == data[2:10]
+    view.release()
+    view = stream.data.view(9, 12)
+    assert view == data[9:12]
+    view.release()
+
+
+@pytest.mark.asyncio
+async def test_tiered_stream_read(stream):
+    await stream.compress_cold(8)
+    # Reads of cold data stop at segment end
+    assert await stream.read(1, 100) == b"bcd"
+    assert await stream.read(4, 2) == b"ef"
+    assert await stream.read(8, 100) == b"ij"
+
+
+@pytest.mark.asyncio
+async def test_tiered_stream_discard(stream):
+    await stream.compress_cold(8)
+    stream.discard(5)
+    with pytest.raises(IndexError):
+        stream.data[1:3]
+    assert stream.data[5:10] == b"fghij"
+    stream.discard_all()
+    assert stream.cold_size() == 0
+    with pytest.raises(IndexError):
+        stream.data[5:10]
+
+
+@pytest.mark.asyncio
+async def test_tiered_stream_memory_counts_compressed_data(stream):
+    await stream.compress_cold(8)
+    assert stream.memory().held == 2 + stream.cold_size()
+    stream.discard(4)
+    assert stream.memory().discarded == 8
@@ -0,0 +1,40 @@
+import asyncio
+import asynctest
+import pytest
+
+from replayserver import main
+
+
+@pytest.fixture
+def restore_policy():
+    policy = asyncio.get_event_loop_policy()
+    yield
+    asyncio.set_event_loop_policy(policy)
+
+
+def test_uvloop_policy_used(monkeypatch, restore_policy):
+    mock_uvloop = asynctest.Mock(spec=["EventLoopPolicy"])
+    policy = asyncio.DefaultEventLoopPolicy()
+    mock_uvloop.EventLoopPolicy.return_value = policy
+    monkeypatch.setattr(main, "uvloop", mock_uvloop)
+
+    main.setup_event_loop_policy(True)
+    assert asyncio.get_event_loop_policy() is policy
+
+
+def test_uvloop_not_used_unless_asked(monkeypatch, restore_policy):
+    mock_uvloop = asynctest.Mock(spec=["EventLoopPolicy"])
+    monkeypatch.setattr(main, "uvloop", mock_uvloop)
+    policy = asyncio.get_event_loop_policy()
+
+    main.setup_event_loop_policy(False)
+    assert asyncio.get_event_loop_policy() is policy
+    mock_uvloop.EventLoopPolicy.assert_not_called()
+
+
+def test_uvloop_missing_falls_back(monkeypatch, restore_policy):
+    monkeypatch.setattr(main, "uvloop", None)
+    policy = asyncio.get_event_loop_policy()
+
+    main.setup_event_loop_policy(True)
+    assert asyncio.get_event_loop_policy() is policy
@@ -0,0 +1,146 @@
+import asyncio
+import pytest
+from tests import fast_forward_time, timeout
+
+from replayserver.timers import TimerWheel, timer_wheel
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.05, 5)
+@timeout(3)
+async def test_timer_wheel_fires_on_time(event_loop):
+    wheel = TimerWheel(event_loop)
+    fired_at = []
+    wheel.call_later(1.23, lambda: fired_at.append(event_loop.time()))
+    assert len(wheel) == 1
+    await asyncio.sleep(2)
+    assert len(fired_at) == 1
+    assert 1.23 <= fired_at[0] <= 1.23 + 2 * TimerWheel.RESOLUTION
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.05, 5)
+@timeout(3)
+async def test_timer_wheel_cancel(event_loop):
+    wheel = TimerWheel(event_loop)
+    fired = []
+    timer = wheel.call_later(1, lambda: fired.append(1))
+    wheel.call_later(1, lambda: fired.append(2))
+    timer.cancel()
+    timer.cancel()
+    assert len(wheel) == 1
+    await asyncio.sleep(2)
+    assert fired == [2]
+    assert not timer.fired
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.05, 5)
+@timeout(3)
+async def test_timer_wheel_callback_cancels_due_timer(event_loop):
+    wheel = TimerWheel(event_loop)
+    fired = []
+    timers = []
+
+    def cancel_others():
+        fired.append(1)
+        for t in timers:
+            t.cancel()
+
+    timers.append(wheel.call_later(1, cancel_others))
+    timers.append(wheel.call_later(1, cancel_others))
+    await asyncio.sleep(2)
+    assert fired == [1]
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+@fast_forward_time(1, 300)
+@timeout(300)
+async def test_timer_wheel_longer_than_revolution(event_loop):
+    wheel = TimerWheel(event_loop)
+    revolution = TimerWheel.SLOTS * TimerWheel.RESOLUTION
+    fired_at = []
+    wheel.call_later(revolution * 2 + 5,
+                     lambda: fired_at.append(event_loop.time()))
+    wheel.call_later(5, lambda: fired_at.append(event_loop.time()))
+    await asyncio.sleep(revolution * 2 + 10)
+    assert len(fired_at) == 2
+    assert 5 <= fired_at[0] < 6
+    assert revolution * 2 + 5 <= fired_at[1] < revolution * 2 + 6
+
+
+@pytest.mark.asyncio
+@fast_forward_time(0.05, 5)
+@timeout(3)
+async def test_timer_wheel_restarts_after_idle(event_loop):
+    wheel = TimerWheel(event_loop)
+    fired_at = []
+    wheel.call_later(0.5, lambda: fired_at.append(event_loop.time()))
+    await asyncio.sleep(1.27)
+    wheel.call_later(0.5, lambda: fired_at.append(event_loop.time()))
+    await asyncio.sleep(1)
+    assert len(fired_at) == 2
+    assert 1.77 <= fired_at[1] <= 1.77 + 2 * TimerWheel.RESOLUTION
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel_per_loop(event_loop):
+    assert timer_wheel() is timer_wheel()
+    assert timer_wheel()._loop is event_loop
+
+
+class ManualLoop:
+    "Loop whose time we set ourselves, and that only records call_at."
+
+    class Handle:
+        def __init__(self, when, callback):
+            self.when = when
+            self.callback = callback
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.now = 0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = self.Handle(when, callback)
+        self.handles.append(handle)
+        return handle
+
+    def scheduled(self):
+        return [h for h in self.handles if not h.cancelled]
+
+    def run_next(self):
+        handle = min(self.scheduled(), key=lambda h: h.when)
+        self.handles.remove(handle)
+        self.now = max(self.now, handle.when)
+        handle.callback()
+
+
+def test_timer_wheel_callback_rearms_itself():
+    loop = ManualLoop()
+    wheel = TimerWheel(loop)
+    fired_at = []
+
+    def rearm():
+        fired_at.append(loop.now)
+        wheel.call_later(1, rearm)
+
+    wheel.call_later(1, rearm)
+    # The loop lags, so a single tick covers many slots.
+    loop.now = 3
+    loop.run_next()
+    assert fired_at == [3]
+    assert len(loop.scheduled()) == 1
+    while len(fired_at) < 2:
+        loop.run_next()
+    assert 4 <= fired_at[1] <= 4 + 2 * TimerWheel.RESOLUTION
+    assert len(loop.scheduled()) == 1